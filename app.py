@@ -1,8 +1,25 @@
 import json
 import logging
-from flask import Flask, render_template, request, jsonify
+import math
+import os
+from dotenv import load_dotenv
+
+# Before any service is imported: they read their settings from the environment
+load_dotenv()
+
+from flask import Flask, Response, render_template, request, jsonify
 from flask_sock import Sock
-from services.llm_service import send_mqtt_command
+from services.admission import admission, Overloaded
+from services.audio_gate import relay_audio
+from services.batch_transcription import JobError, batch_transcriber, job_events
+from services.device_shadow import (FAILED, MAX_BULK_TOPICS, UNCHANGED, send_device_command, send_device_commands,
+                                    valid_topic)
+from services.image_jobs import image_jobs
+from services.metrics_service import metrics_snapshot
+from services.service_registry import service_registry
+from services.session_service import VoiceSession, parse_session_config
+from services.transcriber import open_transcriber
+from services.tts_service import prewarm_tts_cache_async
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,191 +32,129 @@ sock = Sock(app)
 def control_device():
     data = request.json
     topic = data.get('topic')
+    # Bulk variant: the same command to every topic in `topics`, over one broker connection
+    topics = data.get('topics')
     command = data.get('command')
     # Use public Mosquitto broker by default
     mqtt_host = data.get('mqttHost') or "broker.hivemq.com"
     mqtt_port = int(data.get('mqttPort') or 1883)
     mqtt_user = data.get('mqttUser') or None
     mqtt_pass = data.get('mqttPass') or None
-    if not topic or not command:
+    if not (topic or topics) or not command:
         return jsonify({'success': False, 'error': 'Missing required fields'}), 400
-    ok = send_mqtt_command(command, topic, mqtt_host, mqtt_port, mqtt_user, mqtt_pass)
-    return jsonify({'success': ok})
-import json
-import logging
-from flask import Flask, render_template
-from flask_sock import Sock
+    if topics is not None and (not isinstance(topics, list) or len(topics) > MAX_BULK_TOPICS
+                               or not all(valid_topic(t) for t in topics)):
+        return jsonify({'success': False, 'error': f'topics must be a list of at most {MAX_BULK_TOPICS} topic names'}), 400
+    if topics is None and not valid_topic(topic):
+        return jsonify({'success': False, 'error': 'topic must be a topic name without wildcards'}), 400
+    try:
+        ticket = admission.admit('device', request.remote_addr)
+    except Overloaded as e:
+        return _overloaded(e)
+    with ticket:
+        if topics is not None:
+            results = send_device_commands(command, topics, mqtt_host, mqtt_port, mqtt_user, mqtt_pass)
+            return jsonify({'success': FAILED not in results.values(), 'results': results})
+        outcome = send_device_command(command, topic, mqtt_host, mqtt_port, mqtt_user, mqtt_pass)
+    # `changed` is False when the device was already in that state and nothing was published
+    return jsonify({'success': outcome != FAILED, 'changed': outcome not in (FAILED, UNCHANGED)})
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+def _overloaded(e):
+    return (jsonify({'success': False, 'error': str(e), 'retry_after_ms': round(e.retry_after * 1000)}), 429,
+            {'Retry-After': str(math.ceil(e.retry_after))})
 
-app = Flask(__name__)
-sock = Sock(app)
+# SDKs, shared clients and the TTS cache load in the background while the server starts
+service_registry.warm_up()
 
 @app.route("/")
 def index():
     return render_template("index.html")
 
+@app.route("/metrics")
+def metrics():
+    return jsonify(metrics_snapshot())
+
+# Batch transcription of recordings (AssemblyAI pre-recorded API)
+@app.route('/transcriptions', methods=['POST'])
+def create_transcription_job():
+    data = request.get_json(silent=True) or {}
+    try:
+        job = batch_transcriber.create_job(data.get('assemblyKey') or request.headers.get('X-AssemblyAI-Key'))
+        batch_transcriber.add_paths(job, data.get('paths') or [])
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify(_job_links(job.id)), 202
+
+@app.route('/transcriptions/<job_id>/files', methods=['POST'])
+def upload_transcription_file(job_id):
+    try:
+        job = batch_transcriber.get_job(job_id)
+        # Streamed to disk as it arrives rather than buffered in memory
+        chunks = iter(lambda: request.stream.read(64 * 1024), b"")
+        index = batch_transcriber.save_upload(job, request.args.get('name') or 'upload', chunks)
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'index': index, **_job_links(job_id)}), 202
+
+@app.route('/transcriptions/<job_id>')
+def transcription_job(job_id):
+    try:
+        return jsonify(batch_transcriber.get_job(job_id).to_dict())
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+
+@app.route('/transcriptions/<job_id>/events')
+def transcription_job_events(job_id):
+    try:
+        job = batch_transcriber.get_job(job_id)
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    return Response(job_events(job), mimetype='application/x-ndjson')
+
+# Image jobs started by voice turns; results are also pushed over the socket
+@app.route('/image-jobs/<job_id>')
+def image_job(job_id):
+    job = image_jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict())
+
+def _job_links(job_id):
+    return {'job_id': job_id, 'status_url': f'/transcriptions/{job_id}',
+            'events_url': f'/transcriptions/{job_id}/events', 'upload_url': f'/transcriptions/{job_id}/files'}
+
 @sock.route('/transcribe-ws')
 def transcribe_ws(ws):
-    from assemblyai.streaming.v3 import StreamingClient, StreamingClientOptions, StreamingParameters, StreamingEvents, TurnEvent
-    api_keys = {"assembly": None, "gemini": None, "murf": None, "openai": None}
-    first_msg = ws.receive()
     try:
-        keys = json.loads(first_msg)
-        api_keys["assembly"] = keys.get("assemblyKey")
-        api_keys["gemini"] = keys.get("geminiKey")
-        api_keys["murf"] = keys.get("murfKey")
-        api_keys["openai"] = keys.get("openaiKey")
-    except Exception:
-        api_keys = {"assembly": "none", "gemini": "none", "murf": "none", "openai": "none"}
-    client = StreamingClient(StreamingClientOptions(api_key=api_keys["assembly"] or "none", api_host="streaming.assemblyai.com"))
-    from services.llm_service import query_llm, maybe_open_in_chrome, search_web_and_enhance_answer
-    from services.tts_service import murf_tts
-    persona = {
-        "role": "system",
-        "content": (
-            "You are Buzz Lightyear. If asked your name or who you are, always reply 'I am Buzz Lightyear.' "
-            "Keep your responses short, direct, and helpful, like a personal assistant. Avoid long role-played speeches."
-        )
-    }
-    chat_history = [persona]
-    import re
-    transcript_accumulator = {'text': ''}
-    streaming_started = {'done': False}
-    def is_image_request(text):
-        keywords = [r"draw (me|an|a|the)?", r"show (me|an|a|the)?", r"generate (an|a|the)? image", r"create (an|a|the)? image", r"picture of", r"image of", r"visualize", r"illustrate"]
-        text = text.lower()
-        return any(re.search(kw, text) for kw in keywords)
-    def on_turn(self, event: TurnEvent):
-        logger.info(f"[WS] {event.transcript} (end_of_turn={event.end_of_turn})")
-        # Always send partial transcript for live update
+        session_ticket = admission.open_session()
+    except Overloaded as e:
+        ws.send(json.dumps(e.as_message()))
+        ws.close(1013, 'overloaded')
+        return
+    # Ticket for one of the MAX_SESSIONS; freed when the socket closes
+    with session_ticket:
+        api_keys, options = parse_session_config(ws.receive())
+        prewarm_tts_cache_async(api_keys["murf"])
+        session = VoiceSession(ws.send, api_keys, options)
+        if session.resumable:
+            session.send(session.session_message())
+        if session.uplink_negotiated:
+            session.send(session.uplink.as_message())
+        # Pooled, pre-connected STT session when available; audio is buffered until it is live
+        transcriber = open_transcriber(api_keys["assembly"], session.on_stt_turn)
         try:
-            ws.send(json.dumps({
-                "type": "partial",
-                "transcript": event.transcript
-            }))
-        except Exception as e:
-            logger.warning(f"WebSocket send (partial) failed: {e}")
-        # Accumulate transcript until end_of_turn
-        transcript_accumulator['text'] = event.transcript
-        # If end_of_turn, process only the first one per session
-        if event.end_of_turn and not streaming_started['done']:
-            streaming_started['done'] = True
-            try:
-                ws.send(json.dumps({
-                    "type": "end_of_turn",
-                    "transcript": event.transcript
-                }))
-            except Exception as e:
-                logger.warning(f"WebSocket send (end_of_turn) failed: {e}")
-            # Save user message to chat history
-            chat_history.append({"role": "user", "content": transcript_accumulator['text']})
-            user_prompt = transcript_accumulator['text']
-            from services.llm_service import maybe_control_esp32_led
-            led_feedback = maybe_control_esp32_led(user_prompt)
-            tts_text = None
-            if led_feedback:
-                try:
-                    ws.send(json.dumps({
-                        "type": "assistant_chunk",
-                        "text": led_feedback
-                    }))
-                    logger.info("Sent LED feedback to client.")
-                except Exception as e:
-                    logger.warning(f"WebSocket send (LED feedback) failed: {e}")
-                tts_text = led_feedback
-            elif maybe_open_in_chrome(user_prompt):
-                try:
-                    ws.send(json.dumps({
-                        "type": "web_search_opened"
-                    }))
-                    logger.info("Sent web_search_opened to client.")
-                except Exception as e:
-                    logger.warning(f"WebSocket send (web_search_opened) failed: {e}")
-                tts_text = "Opened web search in your browser."
-            else:
-                # If the prompt looks like a question, use web search to enhance answer
-                question_words = ("who", "what", "when", "where", "why", "how")
-                is_question = user_prompt.strip().endswith("?") or user_prompt.lower().startswith(question_words)
-                
-                identity_keywords = [
-                    "your name", "who are you", "what are you", "identify yourself", "are you buzz", "are you buzz lightyear"
-                ]
-                if any(kw in user_prompt.lower() for kw in identity_keywords):
-                    logger.info("Identity question detected, using persona LLM only.")
-                    llm_response = query_llm(chat_history, api_keys["gemini"])
-                    logger.info(f"[LLM persona response]: {llm_response}")
-                    chat_history.append({"role": "assistant", "content": llm_response})
-                    try:
-                        ws.send(json.dumps({
-                            "type": "assistant_chunk",
-                            "text": llm_response
-                        }))
-                        logger.info("Sent assistant_chunk to client.")
-                    except Exception as e:
-                        logger.warning(f"WebSocket send (assistant_chunk) failed: {e}")
-                    tts_text = llm_response
-                elif is_question:
-                    logger.info("Getting enhanced answer with web search...")
-                    enhanced_answer = search_web_and_enhance_answer(user_prompt, api_keys["gemini"])
-                    logger.info(f"[Web-enhanced answer]: {enhanced_answer}")
-                    chat_history.append({"role": "assistant", "content": enhanced_answer})
-                    try:
-                        ws.send(json.dumps({
-                            "type": "assistant_chunk",
-                            "text": enhanced_answer
-                        }))
-                        logger.info("Sent assistant_chunk to client.")
-                    except Exception as e:
-                        logger.warning(f"WebSocket send (assistant_chunk) failed: {e}")
-                    tts_text = enhanced_answer
-                else:
-                    logger.info("Getting full Gemini response...")
-                    llm_response = query_llm(chat_history, api_keys["gemini"])
-                    logger.info(f"[LLM full response]: {llm_response}")
-                    chat_history.append({"role": "assistant", "content": llm_response})
-                    try:
-                        ws.send(json.dumps({
-                            "type": "assistant_chunk",
-                            "text": llm_response
-                        }))
-                        logger.info("Sent assistant_chunk to client.")
-                    except Exception as e:
-                        logger.warning(f"WebSocket send (assistant_chunk) failed: {e}")
-                    tts_text = llm_response
-            # Call TTS only if tts_text is set
-            if tts_text:
-                audio_b64 = murf_tts(tts_text, api_keys["murf"])
-                logger.info(f"[Murf audio]: {str(audio_b64)[:30]} ...")
-                try:
-                    ws.send(json.dumps({
-                        "type": "audio_chunk",
-                        "audio_b64": audio_b64,
-                        "audio_mime": "audio/mpeg"
-                    }))
-                    logger.info(f"Audio chunk sent to client. Length: {len(audio_b64) if audio_b64 else 0}")
-                except Exception as e:
-                    logger.warning(f"WebSocket send (audio_chunk) failed: {e}")
-                try:
-                    ws.send(json.dumps({"type": "audio_done"}))
-                    logger.info("Sent audio_done to client.")
-                except Exception as e:
-                    logger.warning(f"WebSocket send (audio_done) failed: {e}")
-                logger.info("Finished streaming all chunks.")
-
-    client.on(StreamingEvents.Turn, on_turn)
-    client.connect(StreamingParameters(sample_rate=16000, format_turns=True))
-    try:
-        while True:
-            data = ws.receive()
-            if data is None:
-                break
-            client.stream(data)
-    finally:
-        client.disconnect(terminate=True)
+            while True:
+                data = ws.receive()
+                if data is None:
+                    break
+                # Negotiated codec -> 16 kHz PCM16; empty while a compressed frame is incomplete
+                pcm = session.uplink.decode(data)
+                if pcm:
+                    relay_audio(session.audio_gate, transcriber, pcm)
+        finally:
+            session.close()
+            transcriber.close()
 
 if __name__ == "__main__":
-    import os
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host="0.0.0.0", port=port)
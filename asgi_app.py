@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+# Before any service is imported: they read their settings from the environment
+load_dotenv()
+
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from services.admission import admission, Overloaded
+from services.audio_gate import relay_audio
+from services.batch_transcription import JobError, batch_transcriber, job_events_async
+from services.client_registry import close_async_http_client
+from services.image_jobs import image_jobs
+from services.metrics_service import metrics_snapshot
+from services.device_shadow import (FAILED, MAX_BULK_TOPICS, UNCHANGED, send_device_command_async,
+                                    send_device_commands_async, valid_topic)
+from services.service_registry import service_registry
+from services.session_service import AsyncVoiceSession, parse_session_config
+from services.transcriber import open_transcriber
+from services.tts_service import prewarm_tts_cache_async
+
+# asyncio runtime for the voice agent: same routes and WebSocket protocol as app.py,
+# but each voice session is a set of tasks on one event loop instead of blocked threads.
+# Run with: uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Threads for the remaining blocking SDK calls (STT teardown, device actions); the
+# default executor (cpu_count + 4) would serialise session setup under load
+BLOCKING_POOL_SIZE = int(os.environ.get("BLOCKING_POOL_SIZE", 256))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking"))
+    yield
+    await close_async_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
+
+# SDKs, shared clients and the TTS cache load in the background while the server starts
+service_registry.warm_up()
+
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    return templates.TemplateResponse(request, "index.html")
+
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_snapshot()
+
+
+# Device control API (MQTT)
+@app.post("/control-device")
+async def control_device(request: Request):
+    data = await request.json()
+    topic = data.get('topic')
+    # Bulk variant: the same command to every topic in `topics`, over one broker connection
+    topics = data.get('topics')
+    command = data.get('command')
+    # Use public Mosquitto broker by default
+    mqtt_host = data.get('mqttHost') or "broker.hivemq.com"
+    mqtt_port = int(data.get('mqttPort') or 1883)
+    mqtt_user = data.get('mqttUser') or None
+    mqtt_pass = data.get('mqttPass') or None
+    if not (topic or topics) or not command:
+        return JSONResponse({'success': False, 'error': 'Missing required fields'}, status_code=400)
+    if topics is not None and (not isinstance(topics, list) or len(topics) > MAX_BULK_TOPICS
+                               or not all(valid_topic(t) for t in topics)):
+        return JSONResponse({'success': False, 'error': f'topics must be a list of at most {MAX_BULK_TOPICS} topic names'},
+                            status_code=400)
+    if topics is None and not valid_topic(topic):
+        return JSONResponse({'success': False, 'error': 'topic must be a topic name without wildcards'}, status_code=400)
+    try:
+        ticket = await admission.admit_async('device', request.client.host if request.client else None)
+    except Overloaded as e:
+        return _overloaded(e)
+    with ticket:
+        if topics is not None:
+            results = await send_device_commands_async(command, topics, mqtt_host, mqtt_port, mqtt_user, mqtt_pass)
+            return {'success': FAILED not in results.values(), 'results': results}
+        outcome = await send_device_command_async(command, topic, mqtt_host, mqtt_port, mqtt_user, mqtt_pass)
+    # `changed` is False when the device was already in that state and nothing was published
+    return {'success': outcome != FAILED, 'changed': outcome not in (FAILED, UNCHANGED)}
+
+
+def _overloaded(e: Overloaded) -> JSONResponse:
+    return JSONResponse({'success': False, 'error': str(e), 'retry_after_ms': round(e.retry_after * 1000)},
+                        status_code=429, headers={'Retry-After': str(math.ceil(e.retry_after))})
+
+
+# Batch transcription of recordings (AssemblyAI pre-recorded API)
+@app.post("/transcriptions")
+async def create_transcription_job(request: Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    try:
+        job = batch_transcriber.create_job(data.get('assemblyKey') or request.headers.get('X-AssemblyAI-Key'))
+        # Hashing server-side files reads them from disk
+        await asyncio.to_thread(batch_transcriber.add_paths, job, data.get('paths') or [])
+    except JobError as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=400)
+    return JSONResponse(_job_links(job.id), status_code=202)
+
+
+@app.post("/transcriptions/{job_id}/files")
+async def upload_transcription_file(job_id: str, request: Request):
+    try:
+        job = batch_transcriber.get_job(job_id)
+        # Streamed to disk as it arrives rather than buffered in memory
+        index = await batch_transcriber.save_upload_async(job, request.query_params.get('name') or 'upload', request.stream())
+    except JobError as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=400)
+    return JSONResponse({'index': index, **_job_links(job_id)}, status_code=202)
+
+
+@app.get("/transcriptions/{job_id}")
+async def transcription_job(job_id: str):
+    try:
+        return batch_transcriber.get_job(job_id).to_dict()
+    except JobError as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=404)
+
+
+@app.get("/transcriptions/{job_id}/events")
+async def transcription_job_events(job_id: str):
+    try:
+        job = batch_transcriber.get_job(job_id)
+    except JobError as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=404)
+    return StreamingResponse(job_events_async(job), media_type="application/x-ndjson")
+
+
+# Image jobs started by voice turns; results are also pushed over the socket
+@app.get("/image-jobs/{job_id}")
+async def image_job(job_id: str):
+    job = image_jobs.get_job(job_id)
+    if job is None:
+        return JSONResponse({'success': False, 'error': f'Unknown job {job_id}'}, status_code=404)
+    return job.to_dict()
+
+
+def _job_links(job_id: str) -> dict:
+    return {'job_id': job_id, 'status_url': f'/transcriptions/{job_id}',
+            'events_url': f'/transcriptions/{job_id}/events', 'upload_url': f'/transcriptions/{job_id}/files'}
+
+
+@app.websocket("/transcribe-ws")
+async def transcribe_ws(ws: WebSocket):
+    await ws.accept()
+    try:
+        session_ticket = admission.open_session()
+    except Overloaded as e:
+        await ws.send_json(e.as_message())
+        await ws.close(code=1013, reason='overloaded')
+        return
+    # Ticket for one of the MAX_SESSIONS; freed when the socket closes
+    with session_ticket:
+        api_keys, options = parse_session_config(await ws.receive_text())
+        prewarm_tts_cache_async(api_keys["murf"])
+        session = AsyncVoiceSession(ws, asyncio.get_running_loop(), api_keys, options)
+        if session.resumable:
+            await session.send(session.session_message())
+        if session.uplink_negotiated:
+            await session.send(session.uplink.as_message())
+        # Pooled, pre-connected STT session when available; audio is buffered until it is live
+        transcriber = open_transcriber(api_keys["assembly"], session.on_stt_turn)
+        worker = asyncio.create_task(session.run())
+        try:
+            while True:
+                message = await ws.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                # Negotiated codec -> 16 kHz PCM16; empty while a compressed frame is incomplete
+                data = session.uplink.decode(message.get("bytes") or b"")
+                if data:
+                    relay_audio(session.audio_gate, transcriber, data)
+        finally:
+            session.close()
+            worker.cancel()
+            # SDK teardown joins its threads; keep it off the event loop
+            await asyncio.to_thread(transcriber.close)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.environ.get("PORT", 5000))
+    uvicorn.run(app, host="0.0.0.0", port=port)
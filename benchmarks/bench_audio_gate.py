@@ -0,0 +1,74 @@
+"""
+Server-side VAD gate benchmark: CPU cost per inbound chunk and how much of a
+conversation-like uplink (speech bursts separated by pauses and long idle gaps, over
+background noise) still reaches the STT service, plus when end of speech is detected.
+
+    python benchmarks/bench_audio_gate.py --minutes 5 --noise 60
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.audio_gate import AudioGate, SAMPLE_RATE
+
+CHUNK_SAMPLES = 4096  # the browser's ScriptProcessor buffer
+CHUNK_MS = CHUNK_SAMPLES / SAMPLE_RATE * 1000
+
+
+def synth_chunks(minutes: float, noise: float, seed: int = 0):
+    """Yield (chunk, is_speech) for alternating utterances (1-6 s) and pauses (0.5-20 s)."""
+    rng = np.random.default_rng(seed)
+    total = int(minutes * 60_000 / CHUNK_MS)
+    produced = 0
+    speaking = False
+    while produced < total:
+        seconds = rng.uniform(1, 6) if speaking else rng.choice([rng.uniform(0.5, 2), rng.uniform(5, 20)])
+        for _ in range(max(1, int(seconds * 1000 / CHUNK_MS))):
+            t = (produced * CHUNK_SAMPLES + np.arange(CHUNK_SAMPLES)) / SAMPLE_RATE
+            x = rng.normal(0, noise, CHUNK_SAMPLES)
+            if speaking:
+                # Voiced tone with a syllable-rate envelope
+                envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+                x += 6000 * envelope * np.sin(2 * np.pi * rng.uniform(120, 240) * t)
+            yield np.clip(x, -32768, 32767).astype("<i2").tobytes(), speaking
+            produced += 1
+        speaking = not speaking
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=5)
+    parser.add_argument("--noise", type=float, default=60, help="background noise std-dev (PCM16 units)")
+    args = parser.parse_args()
+    chunks = list(synth_chunks(args.minutes, args.noise))
+    gate = AudioGate()
+    missed_speech = 0
+    endpoints = []
+    speech_ended_at = None
+    start = time.perf_counter()
+    for i, (chunk, speaking) in enumerate(chunks):
+        out, end_of_speech = gate.process(chunk)
+        if speaking and not out:
+            missed_speech += 1
+        if not speaking and i and chunks[i - 1][1]:
+            speech_ended_at = i
+        if end_of_speech and speech_ended_at is not None:
+            endpoints.append((i - speech_ended_at + 1) * CHUNK_MS)
+    elapsed = time.perf_counter() - start
+    summary = gate.summary()
+    print(f"audio: {len(chunks) * CHUNK_MS / 60000:.1f} min in {len(chunks)} chunks | "
+          f"{elapsed / len(chunks) * 1e6:.0f} µs/chunk ({elapsed / (len(chunks) * CHUNK_MS / 1000) * 100:.3f}% of real time)")
+    print(f"speech ratio {summary['speech_ratio']:.2f} | forwarded {summary['upstream_ratio'] * 100:.0f}% of bytes upstream | "
+          f"speech chunks dropped: {missed_speech}")
+    if endpoints:
+        print(f"local end of speech: {len(endpoints)} utterances, detected {np.median(endpoints):.0f} ms "
+              f"(median) after the speech stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Batch transcription benchmark: the real server's /transcriptions API against the local
+AssemblyAI REST stand-in (benchmarks/fake_upstreams.py). Generates a set of recordings
+(some of them byte-identical duplicates), uploads them to one job, streams the results
+from /transcriptions/<id>/events, and compares one worker (the old one-file-at-a-time
+path) with the bounded pool.
+
+Reports wall time, files per second, how many files were actually sent upstream after
+content-hash deduplication, and the server's peak RSS while uploads stream to disk.
+
+    python benchmarks/bench_batch_transcription.py --files 40 --duplicates 0.25
+    python benchmarks/bench_batch_transcription.py --runtime async --workers 1,4,8 --size-kb 4096
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_server_load import _free_port, _wait_for_port
+from fake_upstreams import DEFAULT_JITTER, FakeUpstreams, Latency, parse_latency
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_recordings(directory: str, files: int, duplicates: float, size_kb: int, seed: int) -> list[str]:
+    """`files` recordings of random bytes; about `duplicates` of them repeat an earlier one."""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f"recording-{i:03d}.wav")
+        if paths and rng.random() < duplicates:
+            with open(rng.choice(paths), "rb") as src, open(path, "wb") as dst:
+                dst.write(src.read())
+        else:
+            with open(path, "wb") as f:
+                f.write(rng.randbytes(size_kb * 1024))
+        paths.append(path)
+    return paths
+
+
+def _request(url: str, data=None, headers: dict | None = None, method: str | None = None):
+    req = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
+    return urllib.request.urlopen(req, timeout=120)
+
+
+def run_job(base: str, paths: list[str]) -> dict:
+    t0 = time.perf_counter()
+    with _request(f"{base}/transcriptions", json.dumps({}).encode(),
+                  {"Content-Type": "application/json", "X-AssemblyAI-Key": "bench"}) as res:
+        job = json.load(res)
+    for path in paths:
+        # The file object is streamed by urllib in blocks; the server writes it to disk as it arrives
+        with open(path, "rb") as f:
+            headers = {"Content-Length": str(os.path.getsize(path)), "Content-Type": "application/octet-stream"}
+            _request(f"{base}{job['upload_url']}?name={os.path.basename(path)}", f, headers).close()
+    uploaded = time.perf_counter()
+    first = None
+    results = []
+    with _request(f"{base}{job['events_url']}") as res:
+        for line in res:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if "file" in event:
+                first = first or time.perf_counter()
+                results.append(event)
+            else:
+                summary = event
+    done = time.perf_counter()
+    return {"elapsed": done - t0, "upload": uploaded - t0, "first_result": (first or done) - t0,
+            "results": results, "summary": summary}
+
+
+def _peak_rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def bench(runtime: str, workers: int, upstreams: FakeUpstreams, paths: list[str]) -> dict:
+    port = _free_port()
+    batch_dir = tempfile.TemporaryDirectory(prefix="batch-stt-")
+    env = dict(os.environ, MURF_API_KEY="", STT_BATCH_WORKERS=str(workers), STT_BATCH_DIR=batch_dir.name,
+               **upstreams.server_env())
+    before = upstreams.stats["stt_uploads"]
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), "bench_replay.py"),
+                               "--serve", runtime, "--port", str(port)],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        result = run_job(f"http://127.0.0.1:{port}", paths)
+        with _request(f"http://127.0.0.1:{port}/metrics") as res:
+            result["metrics"] = json.load(res)
+        result["peak_rss_mb"] = _peak_rss_kb(server.pid) / 1024
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        batch_dir.cleanup()
+    result["sent_upstream"] = upstreams.stats["stt_uploads"] - before
+    return result
+
+
+def report(runtime: str, workers: int, files: int, result: dict):
+    failed = sum(1 for r in result["results"] if r["status"] != "done")
+    print(f"{runtime:>9} | workers {workers:3d} | {files} files in {result['elapsed']:6.2f} s "
+          f"({files / result['elapsed']:6.2f} files/s) | uploads took {result['upload']:5.2f} s | "
+          f"first result {result['first_result']:5.2f} s | sent upstream {result['sent_upstream']} | "
+          f"failed {failed} | peak RSS {result['peak_rss_mb']:.0f} MB")
+    stage = result["metrics"].get("batch_transcription")
+    if stage and stage.get("count"):
+        print(f"{'':>9} | per-file transcription p50 {stage['p50_ms']:7.1f} p95 {stage['p95_ms']:7.1f} ms "
+              f"(n={stage['count']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runtime", choices=["threaded", "async", "both"], default="both")
+    parser.add_argument("--workers", default="1,4", help="comma-separated worker pool sizes to compare")
+    parser.add_argument("--files", type=int, default=24)
+    parser.add_argument("--duplicates", type=float, default=0.25, help="fraction of files that repeat an earlier one")
+    parser.add_argument("--size-kb", type=int, default=1024)
+    parser.add_argument("--latency", default="", help="median upstream latencies in ms, e.g. stt_batch=2000")
+    parser.add_argument("--jitter", type=float, default=DEFAULT_JITTER)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    latency = Latency(parse_latency(args.latency), args.jitter, seed=args.seed)
+    upstreams = FakeUpstreams(latency).start()
+    recordings = tempfile.TemporaryDirectory(prefix="batch-recordings-")
+    try:
+        paths = make_recordings(recordings.name, args.files, args.duplicates, args.size_kb, args.seed)
+        print(f"{args.files} recordings of {args.size_kb} kB | AssemblyAI medians (ms): upload "
+              f"{latency.medians_ms['stt_upload']}, transcript {latency.medians_ms['stt_batch']}")
+        runtimes = ["threaded", "async"] if args.runtime == "both" else [args.runtime]
+        for runtime in runtimes:
+            for workers in (int(w) for w in args.workers.split(",")):
+                report(runtime, workers, args.files, bench(runtime, workers, upstreams, paths))
+    finally:
+        upstreams.stop()
+        recordings.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Cold start benchmark: how long a fresh server process takes to import, to accept
+connections, and to answer its first voice turn, against the local stand-ins for every
+upstream (benchmarks/fake_upstreams.py).
+
+- import: `import app` / `import asgi_app` in a fresh interpreter (median of --repeat
+  runs), and which heavy SDKs that import loaded. Measured with the warm-up off, as the
+  warm-up thread would otherwise race the probe for what is in sys.modules;
+- first turn: the server is started like on Render (uvicorn asgi_app:app, or app.py's
+  Flask server), one client connects as soon as the port accepts connections and
+  speaks one turn; a second client then does the same on the now-warm server. The
+  difference is what the first user pays for lazily loaded backends.
+
+Both are run with the background warm-up (services/service_registry.py) on and off
+(WARMUP_SERVICES=none).
+
+    python benchmarks/bench_cold_start.py
+    python benchmarks/bench_cold_start.py --runtime async --repeat 5
+    python benchmarks/bench_cold_start.py --save cold.json
+    python benchmarks/bench_cold_start.py --baseline cold.json --tolerance 0.25   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_replay import FRAME_INTERVAL, drive, frames_of, load_pcm, speech_end_seconds, DEFAULT_AUDIO
+from bench_server_load import _free_port, _pct
+from fake_upstreams import FakeUpstreams, Latency
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# SDKs that take hundreds of milliseconds to import
+HEAVY_MODULES = ("google.genai", "openai", "assemblyai", "bs4", "PIL")
+MODULES = {"threaded": "app", "async": "asgi_app"}
+WARMUP_MODES = {"warm-up": {}, "lazy": {"WARMUP_SERVICES": "none"}}
+# Metrics compared against a saved baseline (lower is better)
+REGRESSION_METRICS = ("import_ms", "listen_ms", "first_ttfa_ms", "first_turn_ms")
+
+_IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({{"ms": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def import_time(module: str, repeat: int, env: dict) -> tuple[float, list]:
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                             cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return statistics.median(r["ms"] for r in runs), runs[-1]["heavy"]
+
+
+def _server_command(runtime: str, port: int) -> list:
+    if runtime == "async":
+        # render.yaml's start command
+        return [sys.executable, "-m", "uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", str(port),
+                "--log-level", "warning"]
+    return [sys.executable, os.path.join(ROOT, "benchmarks", "bench_replay.py"), "--serve", "threaded",
+            "--port", str(port)]
+
+
+def _wait_for_port(port: int, timeout: float = 60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def first_turn(runtime: str, samples, env: dict) -> dict:
+    port = _free_port()
+    frames, speech_end = frames_of(samples), speech_end_seconds(samples)
+    started = time.perf_counter()
+    server = subprocess.Popen(_server_command(runtime, port), cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        listen_ms = (time.perf_counter() - started) * 1000
+        cold = asyncio.run(drive(port, frames, speech_end, 1, 1))
+        warm = asyncio.run(drive(port, frames, speech_end, 1, 1))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return {
+        "listen_ms": round(listen_ms, 1),
+        "first_ttfa_ms": round(_pct(cold["ttfa"], .5), 1),
+        "first_turn_ms": round(_pct(cold["turn"], .5), 1),
+        "warm_ttfa_ms": round(_pct(warm["ttfa"], .5), 1),
+        "warm_turn_ms": round(_pct(warm["turn"], .5), 1),
+        "errors": cold["errors"] + warm["errors"],
+        "first_error": cold.get("first_error") or warm.get("first_error"),
+    }
+
+
+def report(name: str, summary: dict):
+    print(f"{name:>18} | import {summary['import_ms']:6.0f} ms (loads {', '.join(summary['heavy']) or 'no heavy SDKs'}) | "
+          f"listening after {summary['listen_ms']:6.0f} ms")
+    print(f"{'':>18} | first turn: TTFA {summary['first_ttfa_ms']:6.0f} ms, turn {summary['first_turn_ms']:6.0f} ms | "
+          f"warm: TTFA {summary['warm_ttfa_ms']:6.0f} ms, turn {summary['warm_turn_ms']:6.0f} ms | "
+          f"first-turn penalty {summary['first_ttfa_ms'] - summary['warm_ttfa_ms']:+6.0f} ms")
+    if summary["errors"]:
+        print(f"{'':>18} | {summary['errors']} errors, first: {summary['first_error']}")
+
+
+def regressions(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    found = []
+    for name, summary in current.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for metric in REGRESSION_METRICS:
+            old, new = before.get(metric), summary.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                found.append(f"{name} {metric}: {old:.0f} -> {new:.0f} ms (+{(new / old - 1) * 100:.0f}%)")
+        for module in set(summary["heavy"]) - set(before.get("heavy", [])):
+            found.append(f"{name} now imports {module} at startup")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runtime", choices=["threaded", "async", "both"], default="both")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh-interpreter imports per measurement")
+    parser.add_argument("--audio", default=DEFAULT_AUDIO, help="recording to replay (.wav/.pcm, others need ffmpeg)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="log-normal sigma of every upstream latency")
+    parser.add_argument("--save", help="write the summary to this JSON file")
+    parser.add_argument("--baseline", help="compare against a saved summary; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs the baseline")
+    args = parser.parse_args()
+    samples, source = load_pcm(args.audio)
+    print(f"Audio: {source}, {len(samples) / 16000:.1f} s per turn ({FRAME_INTERVAL * 1000:.0f} ms frames)")
+    upstreams = FakeUpstreams(Latency(jitter=args.jitter, seed=1)).start()
+    summaries = {}
+    try:
+        runtimes = ["threaded", "async"] if args.runtime == "both" else [args.runtime]
+        for runtime in runtimes:
+            base_env = dict(os.environ, MURF_API_KEY="", **upstreams.server_env())
+            import_ms, heavy = import_time(MODULES[runtime], args.repeat, dict(base_env, **WARMUP_MODES["lazy"]))
+            for mode, mode_env in WARMUP_MODES.items():
+                # A fresh TTS disk cache per run, so the canned replies are not already on disk
+                with tempfile.TemporaryDirectory(prefix="cold-start-tts-") as cache_dir:
+                    env = dict(base_env, TTS_CACHE_DIR=cache_dir, **mode_env)
+                    summary = {"import_ms": round(import_ms, 1), "heavy": heavy, **first_turn(runtime, samples, env)}
+                name = f"{runtime} {mode}"
+                summaries[name] = summary
+                report(name, summary)
+    finally:
+        upstreams.stop()
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summaries, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(json.load(f), summaries, args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance * 100:.0f}% of {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Prompt growth over a long session: the old unbounded chat_history list joined by
+build_prompt on every turn vs services/conversation_memory.ConversationMemory.
+Reports prompt size and time to build the prompt at several points in the session.
+
+    python benchmarks/bench_conversation_memory.py --turns 1000 --budget 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.conversation_memory import ConversationMemory
+from services.llm_service import build_prompt, gemini_request
+from services.session_service import PERSONA
+
+USER = "Can you tell me something interesting about the planet number {i} in our little game?"
+ASSISTANT = ("Planet {i} is a gas giant with thirteen moons. Its storms last for centuries, "
+             "and its rings are made mostly of ice. Want to hear about its largest moon?")
+
+
+def _timed(fn, repeat: int = 20) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--budget", type=int, default=2000)
+    args = parser.parse_args()
+    history = [PERSONA]
+    memory = ConversationMemory(PERSONA, token_budget=args.budget)
+    gemini_request(memory)  # imports google.genai
+    checkpoints = {10, 100, args.turns} | {n for n in (500, 1000, 5000) if n < args.turns}
+    print(f"{'turn':>6} | {'list chars':>10} {'list µs':>9} | {'memory chars':>12} {'memory µs':>9} {'evicted':>8}")
+    for i in range(1, args.turns + 1):
+        for role, text in (("user", USER), ("assistant", ASSISTANT)):
+            history.append({"role": role, "content": text.format(i=i)})
+            memory.add(role, text.format(i=i))
+        if i in checkpoints:
+            # The list was re-joined every turn; the memory's rendering is extended in place
+            list_us = _timed(lambda: build_prompt(history))
+            memory_us = _timed(lambda: gemini_request(memory))
+            print(f"{i:6d} | {len(build_prompt(history)):10d} {list_us:9.1f} | "
+                  f"{len(memory.as_text()):12d} {memory_us:9.1f} {memory.evicted:8d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Device shadow benchmark, against the stand-in broker with simulated latency and a
+simulated ESP32 that applies commands and reports its state retained (like
+esp32_mqtt_sample.ino):
+
+- state queries ("is the light on?") answered from the shadow;
+- a command stream where many commands repeat the current state, sent blindly
+  (what send_mqtt_command does) vs through the shadow, which skips the no-ops;
+- one command fanned out to many topics: one publish at a time vs the bulk variant.
+
+    python benchmarks/bench_device_shadow.py
+    python benchmarks/bench_device_shadow.py --commands 100 --repeat-share 0.7 --topics 50 --latency 0.04
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import paho.mqtt.client as mqtt
+from benchmarks.mqtt_broker import StandInBroker
+from services.device_shadow import (STATE_SUFFIX, device_shadow_stats, get_shadow, send_device_command,
+                                    send_device_commands)
+from services.mqtt_service import get_publisher
+
+TOPIC = "bench/esp32/led"
+
+
+def _pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] * 1000 if values else float("nan")
+
+
+class SimulatedDevice:
+    """Applies on/off commands on its topics and publishes the resulting state, retained."""
+
+    def __init__(self, broker: StandInBroker, topics: list):
+        self.state = {topic: "off" for topic in topics}
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="bench-device")
+        self._client.on_connect = self._on_connect
+        self._client.on_message = self._on_message
+        self._client.connect(broker.host, broker.port)
+        self._client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        client.subscribe([(topic, 1) for topic in self.state])
+        for topic, state in self.state.items():
+            client.publish(topic + STATE_SUFFIX, state, qos=1, retain=True)
+
+    def _on_message(self, client, userdata, message):
+        command = message.payload.decode()
+        if command in ("on", "off"):
+            self.state[message.topic] = command
+        client.publish(message.topic + STATE_SUFFIX, self.state[message.topic], qos=1, retain=True)
+
+    def close(self):
+        self._client.loop_stop()
+        self._client.disconnect()
+
+
+def command_stream(commands: int, repeat_share: float, seed: int = 0) -> list:
+    """On/off commands where `repeat_share` of them ask for the state the light is already in."""
+    rng = random.Random(seed)
+    stream, state = [], "off"
+    for _ in range(commands):
+        if rng.random() >= repeat_share:
+            state = "on" if state == "off" else "off"
+        stream.append(state)
+    return stream
+
+
+def bench_queries(broker: StandInBroker, queries: int):
+    shadow = get_shadow(broker.host, broker.port, None, None)
+    start = time.perf_counter()
+    first = shadow.state(TOPIC, wait=1.0)
+    sync_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    for _ in range(queries):
+        shadow.state(TOPIC)
+    per_query_us = (time.perf_counter() - start) / queries * 1e6
+    print(f"{'state query':>18} | first (waits for retained state) {sync_ms:6.1f} ms -> {first!r} | "
+          f"then {per_query_us:.1f} µs per query")
+
+
+def bench_commands(broker: StandInBroker, stream: list, blind: bool):
+    before = len(broker.published)
+    latencies = []
+    t0 = time.perf_counter()
+    for command in stream:
+        start = time.perf_counter()
+        if blind:
+            assert get_publisher(broker.host, broker.port, None, None).publish_sync(TOPIC, command)
+        else:
+            assert send_device_command(command, TOPIC, broker.host, broker.port, None, None) != "failed"
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - t0
+    print(f"{'blind publish' if blind else 'shadow':>18} | {len(stream):4d} commands | p50 {_pct(latencies, .5):7.2f} ms | "
+          f"p95 {_pct(latencies, .95):7.2f} ms | {len(stream) / elapsed:8.1f} cmd/s | "
+          f"published {len([p for p in broker.published[before:] if p[0] == TOPIC])}")
+
+
+def bench_fan_out(broker: StandInBroker, topics: list):
+    publisher = get_publisher(broker.host, broker.port, None, None)
+    for command in ("on", "off"):
+        start = time.perf_counter()
+        for topic in topics:
+            assert publisher.publish_sync(topic, command)
+        print(f"{'one at a time':>18} | '{command}' to {len(topics)} topics | {(time.perf_counter() - start) * 1000:7.1f} ms")
+    for command in ("on", "off", "off"):
+        start = time.perf_counter()
+        results = send_device_commands(command, topics, broker.host, broker.port, None, None)
+        outcomes = {outcome: list(results.values()).count(outcome) for outcome in set(results.values())}
+        print(f"{'bulk':>18} | '{command}' to {len(topics)} topics | {(time.perf_counter() - start) * 1000:7.1f} ms | "
+              f"{outcomes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", type=int, default=50)
+    parser.add_argument("--repeat-share", type=float, default=0.5, help="share of commands repeating the current state")
+    parser.add_argument("--topics", type=int, default=20, help="topics in the fan-out")
+    parser.add_argument("--queries", type=int, default=100000)
+    parser.add_argument("--latency", type=float, default=0.04, help="simulated broker response delay (s)")
+    args = parser.parse_args()
+    topics = [f"bench/room{i}/light" for i in range(args.topics)]
+    broker = StandInBroker(latency=args.latency).start()
+    device = SimulatedDevice(broker, [TOPIC, *topics])
+    try:
+        print(f"Stand-in broker on port {broker.port}, {args.latency * 1000:.0f} ms per response")
+        bench_queries(broker, args.queries)
+        stream = command_stream(args.commands, args.repeat_share)
+        bench_commands(broker, stream, blind=True)
+        bench_commands(broker, stream, blind=False)
+        bench_fan_out(broker, topics)
+        print(f"Shadow stats: {device_shadow_stats()}")
+    finally:
+        device.close()
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
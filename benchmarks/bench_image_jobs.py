@@ -0,0 +1,135 @@
+"""
+Image job benchmark, in-process against the OpenAI images stand-in in
+benchmarks/fake_upstreams.py (PNGs about the size of real ones):
+
+- a voice turn that generates its image inline (generate_dalle_image called from the
+  turn) vs one that starts an image job: how long the turn is held before it can speak;
+- a burst of image requests through the bounded worker pool, some repeating a prompt
+  already in flight: time to each result, and how many are shed once the queue is full;
+- the same prompts again, answered from the disk cache;
+- bytes pushed per result: the full PNG vs its JPEG thumbnail (needs Pillow).
+
+    python benchmarks/bench_image_jobs.py
+    python benchmarks/bench_image_jobs.py --latency image=3000 --requests 30 --workers 2 --max-queued 8
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import wait
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_upstreams import FakeUpstreams, Latency, parse_latency
+from services.admission import Overloaded
+from services.client_registry import get_openai_client
+from services.image_jobs import ImageJobs, make_thumbnail
+from services.llm_service import generate_dalle_image
+
+SUBJECTS = ["a cat", "a lighthouse", "a robot", "a dragon", "a castle", "a rocket", "a forest", "a whale"]
+PLACES = ["on the moon", "in the rain", "at sunset", "under the sea", "in a city", "on a skateboard"]
+
+
+def _pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] * 1000 if values else float("nan")
+
+
+def prompts(requests: int, repeat_share: float, seed: int = 0) -> list:
+    """Image requests where about `repeat_share` of them repeat an earlier prompt."""
+    rng = random.Random(seed)
+    out = []
+    for _ in range(requests):
+        if out and rng.random() < repeat_share:
+            out.append(rng.choice(out))
+        else:
+            out.append(f"draw me {rng.choice(SUBJECTS)} {rng.choice(PLACES)} number {rng.randrange(10 ** 6)}")
+    return out
+
+
+def bench_turn(jobs: ImageJobs):
+    get_openai_client("bench")  # not timing the SDK import
+    start = time.perf_counter()
+    png = generate_dalle_image("draw me a cat inline", "bench")
+    inline_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    job = jobs.submit("draw me a cat as a job", "bench")
+    job_ms = (time.perf_counter() - start) * 1000
+    job.future.result()
+    ready_ms = (time.perf_counter() - start) * 1000
+    print(f"{'inline':>12} | turn held {inline_ms:8.1f} ms before speaking | {len(png or b'')} byte image")
+    print(f"{'image job':>12} | turn held {job_ms:8.3f} ms before speaking | image pushed after {ready_ms:.0f} ms")
+
+
+def bench_burst(jobs: ImageJobs, batch: list, label: str):
+    start = time.perf_counter()
+    submitted, shed, done_at = [], 0, {}
+    for prompt in batch:
+        try:
+            job = jobs.submit(prompt, "bench")
+        except Overloaded:
+            shed += 1
+            continue
+        submitted.append(job)
+        job.future.add_done_callback(lambda f, job=job: done_at.setdefault(job.id, time.perf_counter()))
+    submit_ms = (time.perf_counter() - start) * 1000
+    wait([job.future for job in submitted])
+    elapsed = time.perf_counter() - start
+    latencies = [done_at[job.id] - start for job in submitted]
+    failed = sum(1 for job in submitted if job.status == "failed")
+    print(f"{label:>12} | {len(batch):3d} requests | submitted in {submit_ms:7.2f} ms | result p50 "
+          f"{_pct(latencies, .5):8.1f} ms | p95 {_pct(latencies, .95):8.1f} ms | all in {elapsed:6.2f} s | "
+          f"shed {shed} | failed {failed}")
+    return submitted
+
+
+def report_sizes(jobs: ImageJobs, submitted: list):
+    job = next((job for job in submitted if job.status == "done"), None)
+    if job is None:
+        return
+    image_path, thumb_path = jobs._paths(job.key)
+    full = os.path.getsize(image_path)
+    if os.path.exists(thumb_path):
+        thumb = os.path.getsize(thumb_path)
+        print(f"{'payload':>12} | full PNG {full / 1024:8.1f} KiB | thumbnail {thumb / 1024:6.1f} KiB "
+              f"({full / thumb:.0f}x smaller)")
+    else:
+        with open(image_path, "rb") as f:
+            thumbnail = make_thumbnail(f.read())
+        note = "Pillow not installed, clients get the full image" if thumbnail is None else ""
+        print(f"{'payload':>12} | full PNG {full / 1024:8.1f} KiB | no thumbnail ({note})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", default="image=2000", help="median latencies in ms, e.g. image=3000")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--requests", type=int, default=20, help="image requests in the burst")
+    parser.add_argument("--repeat-share", type=float, default=0.25, help="share of requests repeating a prompt")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-queued", type=int, default=8)
+    args = parser.parse_args()
+    upstreams = FakeUpstreams(Latency(parse_latency(args.latency), args.jitter, seed=0)).start()
+    os.environ.update(upstreams.server_env())
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench-images-") as image_dir:
+            jobs = ImageJobs(workers=args.workers, image_dir=image_dir, max_queued=args.max_queued)
+            print(f"Images stand-in at {upstreams.http_url}, {upstreams.latency.medians_ms['image']:.0f} ms median, "
+                  f"{args.workers} workers, {args.max_queued} queued at most")
+            bench_turn(jobs)
+            batch = prompts(args.requests, args.repeat_share)
+            submitted = bench_burst(jobs, batch, "burst")
+            # Only the prompts that were generated (not shed) are in the cache
+            bench_burst(jobs, [job.prompt for job in submitted], "repeated")
+            report_sizes(jobs, submitted)
+            print(f"Image job stats: {jobs.stats()}")
+            print(f"Upstream image requests: {upstreams.stats['image_requests']}")
+    finally:
+        upstreams.stop()
+
+
+if __name__ == "__main__":
+    main()
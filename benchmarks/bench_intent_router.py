@@ -0,0 +1,100 @@
+"""
+Intent routing micro-benchmark: the previous per-turn cascade (uncompiled LED regex
+lists, linear site/keyword scans, image regexes, identity/question keyword checks)
+vs services/intent_router.py's single compiled matcher, over a corpus of transcripts.
+
+    python benchmarks/bench_intent_router.py --repeat 2000
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.intent_router import route_intent
+
+CORPUS = [
+    "Turn on the light.",
+    "switch off the led please",
+    "can you turn the light off",
+    "light on",
+    "turn on the lights",
+    "Switch off the lights.",
+    "turn off the lights please",
+    "Could you please switch on the LEDs?",
+    "Open YouTube",
+    "open github website",
+    "Search for the best pizza near me",
+    "look up the weather in Paris",
+    "What happened in the news today?",
+    "Who won the football match last night?",
+    "Who are you?",
+    "What is your name",
+    "What is the capital of Australia?",
+    "How do airplanes stay in the air",
+    "Why is the sky blue?",
+    "Draw me a picture of a cat",
+    "Generate an image of a sunset over the ocean",
+    "Tell me a joke about programmers",
+    "I had a really long day at work and I just want to chat for a while about nothing in particular",
+    "Thanks, that was helpful.",
+    "Can you explain the difference between a list and a tuple in Python",
+    "Let's talk about space exploration and the next mission to Mars",
+]
+
+
+def legacy_route(user_prompt: str) -> str:
+    """The checks each turn used to run in sequence (side effects removed)."""
+    prompt = user_prompt.lower()
+    on_patterns = [r"(turn|switch) (on) (the )?(led|light)", r"(led|light) (on)", r"(on) (led|light)"]
+    off_patterns = [r"(turn|switch) (off) (the )?(led|light)", r"(led|light) (off)", r"(off) (led|light)"]
+    if any(re.search(p, prompt) for p in on_patterns) or any(re.search(p, prompt) for p in off_patterns):
+        return "device_control"
+    prompt = user_prompt.lower().strip()
+    site_map = ["youtube", "github", "wikipedia", "gmail", "google drive", "reddit", "twitter", "facebook", "instagram"]
+    for key in site_map:
+        if f"open {key}" in prompt or f"open {key} website" in prompt:
+            return "open_site"
+    search_keywords = ["search for", "google", "look up", "latest news", "find", "show me the news",
+                       "who won", "what happened", "current events"]
+    if any(kw in prompt for kw in search_keywords):
+        return "web_search"
+    identity_keywords = ["your name", "who are you", "what are you", "identify yourself", "are you buzz", "are you buzz lightyear"]
+    if any(kw in user_prompt.lower() for kw in identity_keywords):
+        return "identity"
+    question_words = ("who", "what", "when", "where", "why", "how")
+    if user_prompt.strip().endswith("?") or user_prompt.lower().startswith(question_words):
+        return "question"
+    keywords = [r"draw (me|an|a|the)?", r"show (me|an|a|the)?", r"generate (an|a|the)? image", r"create (an|a|the)? image", r"picture of", r"image of", r"visualize", r"illustrate"]
+    if any(re.search(kw, user_prompt.lower()) for kw in keywords):
+        return "image"
+    return "chat"
+
+
+def bench(name: str, fn, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in CORPUS:
+            fn(text)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / (repeat * len(CORPUS)) * 1e6
+    print(f"{name:>16} | {repeat * len(CORPUS):7d} routes | {per_call:6.2f} µs/route")
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    mismatches = [(t, legacy_route(t), route_intent(t).name) for t in CORPUS if legacy_route(t) != route_intent(t).name]
+    for text, old, new in mismatches:
+        print(f"  differs: {text!r}: legacy={old} router={new}")
+    legacy = bench("legacy cascade", legacy_route, args.repeat)
+    routed = bench("intent router", route_intent, args.repeat)
+    print(f"speed-up: {legacy / routed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
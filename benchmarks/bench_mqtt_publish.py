@@ -0,0 +1,99 @@
+"""
+MQTT publish benchmark: one-shot `publish.single` (connect, publish, disconnect per
+command, the old send_mqtt_command) vs the persistent pooled publisher in
+services/mqtt_service.py, against the local stand-in broker with simulated latency.
+
+    python benchmarks/bench_mqtt_publish.py --commands 50 --latency 0.04
+    python benchmarks/bench_mqtt_publish.py --burst 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import paho.mqtt.publish as publish
+from benchmarks.mqtt_broker import StandInBroker
+from services.mqtt_service import get_publisher, mqtt_stats
+
+TOPIC = "bench/esp32/led"
+
+
+def _pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] * 1000 if values else float("nan")
+
+
+def report(name: str, latencies: list, elapsed: float, delivered: int):
+    print(f"{name:>18} | {len(latencies):4d} commands | p50 {_pct(latencies, .5):7.1f} ms | "
+          f"p95 {_pct(latencies, .95):7.1f} ms | {len(latencies) / elapsed:7.1f} cmd/s | "
+          f"broker received {delivered}")
+
+
+def bench_single(broker: StandInBroker, commands: int):
+    before = len(broker.published)
+    latencies = []
+    t0 = time.perf_counter()
+    for i in range(commands):
+        start = time.perf_counter()
+        publish.single(TOPIC, "on" if i % 2 else "off", qos=1, hostname=broker.host, port=broker.port)
+        latencies.append(time.perf_counter() - start)
+    report("publish.single", latencies, time.perf_counter() - t0, len(broker.published) - before)
+
+
+def bench_pooled(broker: StandInBroker, commands: int):
+    publisher = get_publisher(broker.host, broker.port, None, None)
+    publisher.publish_sync(TOPIC, "warmup")
+    before = len(broker.published)
+    latencies = []
+    t0 = time.perf_counter()
+    for i in range(commands):
+        start = time.perf_counter()
+        assert publisher.publish_sync(TOPIC, "on" if i % 2 else "off")
+        latencies.append(time.perf_counter() - start)
+    report("pooled (sync)", latencies, time.perf_counter() - t0, len(broker.published) - before)
+
+
+def bench_burst(broker: StandInBroker, burst: int):
+    """`burst` concurrent async commands to one topic, e.g. a user toggling a switch quickly."""
+    publisher = get_publisher(broker.host, broker.port, None, None)
+    before = len(broker.published)
+    latencies = []
+
+    async def one(i):
+        start = time.perf_counter()
+        assert await publisher.publish_async(TOPIC, f"level {i}")
+        latencies.append(time.perf_counter() - start)
+
+    async def run():
+        await asyncio.gather(*(one(i) for i in range(burst)))
+
+    t0 = time.perf_counter()
+    asyncio.run(run())
+    report("pooled burst", latencies, time.perf_counter() - t0, len(broker.published) - before)
+    last_topic, last_payload, _ = broker.published[-1]
+    print(f"{'':>18} | last payload on {last_topic}: {last_payload.decode()!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.04, help="simulated broker response delay (s)")
+    args = parser.parse_args()
+    broker = StandInBroker(latency=args.latency).start()
+    try:
+        print(f"Stand-in broker on port {broker.port}, {args.latency * 1000:.0f} ms per response")
+        bench_single(broker, args.commands)
+        bench_pooled(broker, args.commands)
+        bench_burst(broker, args.burst)
+        print(f"Publisher stats: {mqtt_stats()}")
+    finally:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""
+Offline end-to-end replay benchmark: the real server (app.py or asgi_app.py, unpatched)
+talks to local stand-ins for AssemblyAI, Gemini, Murf, DuckDuckGo and MQTT
+(benchmarks/fake_upstreams.py) with injected latency and jitter. N concurrent clients
+replay a recorded utterance through /transcribe-ws in real time, like the browser does,
+for several turns each, and wait for the spoken answer before "speaking" again.
+
+Reports throughput, time-to-first-audio from the final transcript (TTFA) and from the
+end of the user's speech, tail latencies, and the server's own per-stage breakdown.
+TTFA counts the first audio frame (when a progressive client starts playing); "first
+clip" is when the first sentence's clip is complete (when a client that decodes whole
+clips could start). Turns the server sheds (an `overloaded` message) and turns that end
+without any audio (an upstream error) are counted separately. No network access or API
+keys are needed.
+
+    python benchmarks/bench_replay.py --sessions 20 --turns 4
+    python benchmarks/bench_replay.py --runtime async --sessions 100 --latency gemini=800 --jitter 0.5
+    python benchmarks/bench_replay.py --speculative     # LLM replies start on stable partials
+    python benchmarks/bench_replay.py --tts-backend murf --tts-sample-rate 44100   # the old TTS path
+    python benchmarks/bench_replay.py --sessions 40 --gemini-capacity 8 --stage-concurrency llm=8
+    python benchmarks/bench_replay.py --llm-cache-ttls identity=0,question=0   # without the LLM cache
+    python benchmarks/bench_replay.py --uplink adpcm --uplink-rate 48000   # compressed uplink, server resamples
+    python benchmarks/bench_replay.py --save baseline.json
+    python benchmarks/bench_replay.py --baseline baseline.json --tolerance 0.15   # exit 1 on regression
+
+Audio: 16 kHz mono PCM16 .wav or raw .pcm files are read directly; other formats (such as
+uploads/echo_audio.webm, as recorded by the browser) are decoded with ffmpeg when it is
+installed. Without ffmpeg, a synthetic voiced utterance is used instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_server_load import _free_port, _pct, _server_stages, _wait_for_port
+from fake_upstreams import DEFAULT_JITTER, SAMPLE_RATE, SPEECH_RMS, FakeUpstreams, Latency, parse_latency
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_AUDIO = os.path.join(ROOT, "uploads", "echo_audio.webm")
+# Browser-like uplink: 4096 samples (256 ms) per message
+FRAME_SAMPLES = 4096
+FRAME_INTERVAL = FRAME_SAMPLES / SAMPLE_RATE
+SILENCE_FRAME = b"\0" * (2 * FRAME_SAMPLES)
+TURN_TIMEOUT = 60
+# Metrics compared against a saved baseline (lower is better)
+REGRESSION_METRICS = ("ttfa_p50_ms", "ttfa_p95_ms", "speech_to_audio_p95_ms", "turn_p95_ms")
+
+
+def synthetic_utterance(seconds: float = 1.8) -> np.ndarray:
+    """A voiced tone with a syllable-rate envelope, loud enough for any VAD."""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    envelope = 0.55 + 0.45 * np.sin(2 * np.pi * 4 * t)
+    return (7000 * envelope * np.sin(2 * np.pi * 180 * t)).astype("<i2")
+
+
+def load_pcm(path: str) -> tuple[np.ndarray, str]:
+    """16 kHz mono PCM16 samples of a recording, and a description of where they came from."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pcm" or ext == ".raw":
+        with open(path, "rb") as f:
+            return np.frombuffer(f.read(), dtype="<i2"), path
+    if ext == ".wav":
+        with wave.open(path, "rb") as w:
+            if w.getsampwidth() != 2:
+                raise SystemExit(f"{path}: only 16-bit WAV is supported")
+            samples = np.frombuffer(w.readframes(w.getnframes()), dtype="<i2")
+            if w.getnchannels() > 1:
+                samples = samples.reshape(-1, w.getnchannels()).mean(axis=1).astype("<i2")
+            rate = w.getframerate()
+        if rate != SAMPLE_RATE:
+            positions = np.arange(0, len(samples), rate / SAMPLE_RATE)
+            samples = np.interp(positions, np.arange(len(samples)), samples).astype("<i2")
+        return samples, path
+    if shutil.which("ffmpeg"):
+        pcm = subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-f", "s16le", "-ac", "1",
+                              "-ar", str(SAMPLE_RATE), "-"], capture_output=True, check=True).stdout
+        return np.frombuffer(pcm, dtype="<i2"), path
+    return synthetic_utterance(), f"synthetic utterance (ffmpeg not found to decode {os.path.basename(path)})"
+
+
+def frames_of(samples: np.ndarray) -> list[bytes]:
+    pad = (-len(samples)) % FRAME_SAMPLES
+    samples = np.concatenate([samples, np.zeros(pad, dtype="<i2")])
+    return [samples[i:i + FRAME_SAMPLES].tobytes() for i in range(0, len(samples), FRAME_SAMPLES)]
+
+
+def uplink_frames(samples: np.ndarray, codec: str, rate: int) -> tuple[list[bytes], bytes]:
+    """
+    The messages (and a silent one) a browser capturing at `rate` sends in the uplink
+    `codec`, using the same encoders as templates/index.html; one message per 256 ms.
+    """
+    sys.path.insert(0, ROOT)
+    from services.uplink_audio import AdpcmEncoder, Resampler, encode_ulaw
+    if rate != SAMPLE_RATE:
+        samples = Resampler(SAMPLE_RATE, rate).process(samples)
+    chunk = FRAME_SAMPLES * rate // SAMPLE_RATE
+    samples = np.concatenate([samples, np.zeros((-len(samples)) % chunk + chunk, dtype=np.int16)])
+    pieces = [samples[i:i + chunk] for i in range(0, len(samples), chunk)]
+    if codec == "adpcm":
+        encoder = AdpcmEncoder()
+        encoded = [encoder.encode(piece) for piece in pieces]
+    elif codec == "ulaw":
+        encoded = [encode_ulaw(piece) for piece in pieces]
+    else:
+        encoded = [piece.astype("<i2").tobytes() for piece in pieces]
+    return encoded[:-1], encoded[-1]
+
+
+def speech_end_seconds(samples: np.ndarray, window: int = SAMPLE_RATE // 50) -> float:
+    """Offset of the end of the last 20 ms window with speech-level energy."""
+    usable = len(samples) // window * window
+    power = np.mean(samples[:usable].astype(np.float32).reshape(-1, window) ** 2, axis=1)
+    loud = np.flatnonzero(power > SPEECH_RMS ** 2)
+    return (loud[-1] + 1) * window / SAMPLE_RATE if loud.size else len(samples) / SAMPLE_RATE
+
+
+def serve(runtime: str, port: int):
+    """Server subprocess: the real app, pointed at the fake upstreams through the environment."""
+    import logging
+    sys.path.insert(0, ROOT)
+    if runtime == "threaded":
+        from app import app
+        logging.getLogger().setLevel(logging.WARNING)
+        app.run(host="127.0.0.1", port=port, threaded=True)
+    else:
+        import uvicorn
+        from asgi_app import app
+        logging.getLogger().setLevel(logging.WARNING)
+        uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", ws_max_queue=64)
+
+
+async def replay_session(url: str, frames: list[bytes], speech_end: float, turns: int, results: dict,
+                         speculative: bool = False, silence: bytes = SILENCE_FRAME, uplink: dict | None = None):
+    from websockets.asyncio.client import connect
+    t0 = time.perf_counter()
+    async with connect(url, max_size=None, open_timeout=60) as ws:
+        await ws.send(json.dumps({"assemblyKey": "replay", "geminiKey": "replay", "murfKey": "replay",
+                                  "multiTurn": True, "streamingReplies": True, "binaryAudio": True,
+                                  "speculativeReplies": speculative, **(uplink or {})}))
+        results["connect"].append(time.perf_counter() - t0)
+        events = asyncio.Queue()
+
+        async def reader():
+            async for message in ws:
+                now = time.perf_counter()
+                if isinstance(message, bytes):
+                    results["audio_bytes"] += len(message)
+                    events.put_nowait(("audio_fin" if message[1] & 1 else "audio", now))
+                else:
+                    events.put_nowait((json.loads(message)["type"], now))
+
+        read_task = asyncio.create_task(reader())
+        try:
+            for _ in range(turns):
+                await _replay_turn(ws, frames, speech_end, events, read_task, results, silence)
+        finally:
+            read_task.cancel()
+
+
+async def _replay_turn(ws, frames: list[bytes], speech_end: float, events: asyncio.Queue, read_task, results: dict,
+                       silence: bytes = SILENCE_FRAME):
+    # Speak the recording in real time, then keep the "microphone" open with silence.
+    # Like the browser, each frame is sent once its 256 ms have been captured.
+    started = time.perf_counter()
+    for i, frame in enumerate(frames):
+        await asyncio.sleep(max(0.0, started + (i + 1) * FRAME_INTERVAL - time.perf_counter()))
+        await ws.send(frame)
+        results["uplink_bytes"] += len(frame)
+        results["uplink_messages"] += 1
+    speech_ended = started + speech_end
+    turn_ended = first_audio = first_clip = None
+    deadline = speech_ended + TURN_TIMEOUT
+    while time.perf_counter() < deadline:
+        if read_task.done():
+            raise ConnectionError("server closed the connection")
+        try:
+            kind, at = await asyncio.wait_for(events.get(), timeout=FRAME_INTERVAL)
+        except asyncio.TimeoutError:
+            await ws.send(silence)
+            results["uplink_bytes"] += len(silence)
+            results["uplink_messages"] += 1
+            continue
+        if kind == "end_of_turn" and turn_ended is None:
+            turn_ended = at
+        elif kind in ("audio", "audio_fin") and turn_ended is not None:
+            first_audio = first_audio or at
+            if kind == "audio_fin":
+                first_clip = first_clip or at
+        elif kind == "overloaded" and turn_ended is not None:
+            results["shed"] += 1
+            return
+        elif kind == "audio_done" and turn_ended is not None:
+            if first_audio is None:
+                results["silent"] += 1
+            else:
+                results["ttfa"].append(first_audio - turn_ended)
+                results["first_clip"].append(first_clip - turn_ended)
+                results["speech_to_audio"].append(first_audio - speech_ended)
+            results["turn"].append(at - turn_ended)
+            return
+    raise TimeoutError("turn did not complete")
+
+
+async def drive(port: int, frames: list[bytes], speech_end: float, sessions: int, turns: int,
+                speculative: bool = False, silence: bytes = SILENCE_FRAME, uplink: dict | None = None) -> dict:
+    results = {"connect": [], "ttfa": [], "first_clip": [], "speech_to_audio": [], "turn": [], "errors": 0,
+               "audio_bytes": 0, "shed": 0, "silent": 0, "uplink_bytes": 0, "uplink_messages": 0}
+    url = f"ws://127.0.0.1:{port}/transcribe-ws"
+
+    async def guarded():
+        try:
+            await replay_session(url, frames, speech_end, turns, results, speculative, silence, uplink)
+        except Exception as e:
+            results["errors"] += 1
+            results.setdefault("first_error", repr(e))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(guarded() for _ in range(sessions)))
+    results["elapsed"] = time.perf_counter() - t0
+    return results
+
+
+def bench(runtime: str, upstreams: FakeUpstreams, samples: np.ndarray, sessions: int, turns: int,
+          speculative: bool = False, extra_env: dict | None = None, uplink: str = "pcm",
+          uplink_rate: int = SAMPLE_RATE) -> dict:
+    port = _free_port()
+    # A fresh TTS disk cache per run, so earlier runs don't turn synthesis into cache hits
+    cache_dir = tempfile.TemporaryDirectory(prefix="replay-tts-cache-")
+    env = dict(os.environ, MURF_API_KEY="", TTS_CACHE_DIR=cache_dir.name, **upstreams.server_env(), **(extra_env or {}))
+    server = subprocess.Popen([sys.executable, __file__, "--serve", runtime, "--port", str(port)],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        if uplink == "pcm" and uplink_rate == SAMPLE_RATE:
+            # What clients that don't negotiate the uplink send
+            frames, silence, config = frames_of(samples), SILENCE_FRAME, None
+        else:
+            frames, silence = uplink_frames(samples, uplink, uplink_rate)
+            config = {"uplinkCodecs": [uplink], "uplinkSampleRate": uplink_rate}
+        results = asyncio.run(drive(port, frames, speech_end_seconds(samples), sessions, turns, speculative,
+                                    silence, config))
+        results["stages"] = _server_stages(port)
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=10) as res:
+            metrics = json.load(res)
+        results["admission"] = metrics.get("admission")
+        results["llm_cache"] = metrics.get("llm_cache")
+        results["uplink"] = metrics.get("uplink")
+        if speculative:
+            results["speculation"] = metrics.get("speculation")
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        cache_dir.cleanup()
+    return results
+
+
+def summarise(results: dict) -> dict:
+    completed = len(results["turn"])
+    return {
+        "turns": completed,
+        "errors": results["errors"],
+        "shed": results["shed"],
+        "silent": results["silent"],
+        "turns_per_s": round(completed / results["elapsed"], 2),
+        "connect_p50_ms": round(_pct(results["connect"], .5), 1),
+        "ttfa_p50_ms": round(_pct(results["ttfa"], .5), 1),
+        "ttfa_p95_ms": round(_pct(results["ttfa"], .95), 1),
+        "ttfa_p99_ms": round(_pct(results["ttfa"], .99), 1),
+        "first_clip_p50_ms": round(_pct(results["first_clip"], .5), 1),
+        "first_clip_p95_ms": round(_pct(results["first_clip"], .95), 1),
+        "speech_to_audio_p50_ms": round(_pct(results["speech_to_audio"], .5), 1),
+        "speech_to_audio_p95_ms": round(_pct(results["speech_to_audio"], .95), 1),
+        "turn_p95_ms": round(_pct(results["turn"], .95), 1),
+        "audio_kb_per_turn": round(results["audio_bytes"] / 1024 / completed, 1) if completed else None,
+        "uplink_kbit_s": round(results["uplink_bytes"] * 8 / 1000 / (results["uplink_messages"] * FRAME_INTERVAL), 1)
+        if results["uplink_messages"] else None,
+    }
+
+
+def report(runtime: str, sessions: int, summary: dict, results: dict):
+    print(f"{runtime:>9} | sessions {sessions:4d} | turns {summary['turns']:5d} | errors {summary['errors']:3d} | "
+          f"{summary['turns_per_s']:6.2f} turns/s | connect p50 {summary['connect_p50_ms']:6.0f} ms")
+    print(f"{'':>9} | TTFA p50 {summary['ttfa_p50_ms']:6.0f} p95 {summary['ttfa_p95_ms']:6.0f} "
+          f"p99 {summary['ttfa_p99_ms']:6.0f} ms | end of speech -> audio p50 {summary['speech_to_audio_p50_ms']:6.0f} "
+          f"p95 {summary['speech_to_audio_p95_ms']:6.0f} ms | turn p95 {summary['turn_p95_ms']:6.0f} ms")
+    print(f"{'':>9} | first clip p50 {summary['first_clip_p50_ms']:6.0f} p95 {summary['first_clip_p95_ms']:6.0f} ms | "
+          f"audio {summary['audio_kb_per_turn']} kB per turn")
+    if summary["shed"] or summary["silent"]:
+        print(f"{'':>9} | {summary['shed']} turns shed (overloaded), {summary['silent']} answered without audio")
+    for name, stage in sorted((results.get("admission") or {}).items()):
+        shed = {k[5:]: v for k, v in stage.items() if k.startswith("shed_") and v}
+        if stage["admitted"] or shed:
+            print(f"{'':>9} | admission {name:<8} admitted {stage['admitted']:5d}, queued {stage['queued']:5d}, "
+                  f"shed {shed or 0}")
+    llm_cache = results.get("llm_cache")
+    if llm_cache:
+        print(f"{'':>9} | LLM cache: {llm_cache['hits'] + llm_cache['near_hits']} hits, {llm_cache['coalesced']} shared "
+              f"in flight, {llm_cache['misses']} misses (hit rate {llm_cache['hit_rate']})")
+    uplink = results.get("uplink")
+    if uplink and uplink["messages"]:
+        print(f"{'':>9} | uplink {'/'.join(f'{c} x{n}' for c, n in uplink['codecs'].items())}: "
+              f"{summary['uplink_kbit_s']} kbit/s per session, wire ratio {uplink['wire_ratio']}, "
+              f"decode {uplink['decode_us_per_message']} µs per message")
+    if "first_error" in results:
+        print(f"{'':>9} | first error: {results['first_error']}")
+    speculation = results.get("speculation")
+    if speculation:
+        print(f"{'':>9} | speculation: {speculation['started']} started, {speculation['hits']} hits, "
+              f"{speculation['misses']} misses, {speculation['discarded']} discarded (hit rate "
+              f"{speculation['hit_rate']}), {speculation['saved_ms_total']:.0f} ms saved in total")
+    for name, stats in sorted(results["stages"].items()):
+        print(f"{'':>9} | {name:<22} p50 {stats['p50_ms']:7.1f} p95 {stats['p95_ms']:7.1f} "
+              f"p99 {stats['p99_ms']:7.1f} ms  (n={stats['count']})")
+
+
+def regressions(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    found = []
+    for runtime, summary in current.items():
+        before = baseline.get(runtime)
+        if not before:
+            continue
+        for metric in REGRESSION_METRICS:
+            old, new = before.get(metric), summary.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                found.append(f"{runtime} {metric}: {old:.0f} -> {new:.0f} ms (+{(new / old - 1) * 100:.0f}%)")
+        if summary["errors"] > before.get("errors", 0):
+            found.append(f"{runtime} errors: {before.get('errors', 0)} -> {summary['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runtime", choices=["threaded", "async", "both"], default="both")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--audio", default=DEFAULT_AUDIO, help="recording to replay (.wav/.pcm, others need ffmpeg)")
+    parser.add_argument("--latency", default="", help="median upstream latencies in ms, e.g. gemini=400,murf=300")
+    parser.add_argument("--jitter", type=float, default=DEFAULT_JITTER, help="log-normal sigma of every latency")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--speculative", action="store_true", help="sessions ask for speculative LLM replies")
+    parser.add_argument("--tts-backend", help="server TTS_BACKEND (murf-stream or murf)")
+    parser.add_argument("--tts-sample-rate", type=int, help="server TTS_SAMPLE_RATE")
+    parser.add_argument("--gemini-capacity", type=int, help="stand-in Gemini answers 429 past this many concurrent requests")
+    parser.add_argument("--stage-concurrency", help="server STAGE_CONCURRENCY, e.g. llm=8")
+    parser.add_argument("--llm-cache-ttls", help="server LLM_CACHE_TTLS, e.g. identity=0,question=0 to turn it off")
+    parser.add_argument("--uplink", choices=["pcm", "ulaw", "adpcm"], default="pcm",
+                        help="microphone codec the clients negotiate")
+    parser.add_argument("--uplink-rate", type=int, default=SAMPLE_RATE, help="clients' capture rate (Hz)")
+    parser.add_argument("--save", help="write the summary to this JSON file")
+    parser.add_argument("--baseline", help="compare against a saved summary; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs the baseline")
+    parser.add_argument("--serve", choices=["threaded", "async"], help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+    samples, source = load_pcm(args.audio)
+    latency = Latency(parse_latency(args.latency), args.jitter, seed=args.seed)
+    print(f"Audio: {source}, {len(samples) / SAMPLE_RATE:.1f} s per turn")
+    print(f"Upstream medians (ms): {latency.medians_ms} | jitter {latency.jitter}")
+    extra_env = {}
+    if args.tts_backend:
+        extra_env["TTS_BACKEND"] = args.tts_backend
+    if args.tts_sample_rate:
+        extra_env["TTS_SAMPLE_RATE"] = str(args.tts_sample_rate)
+    if args.stage_concurrency:
+        extra_env["STAGE_CONCURRENCY"] = args.stage_concurrency
+    if args.llm_cache_ttls:
+        extra_env["LLM_CACHE_TTLS"] = args.llm_cache_ttls
+    upstreams = FakeUpstreams(latency, args.gemini_capacity).start()
+    summaries = {}
+    try:
+        runtimes = ["threaded", "async"] if args.runtime == "both" else [args.runtime]
+        for runtime in runtimes:
+            results = bench(runtime, upstreams, samples, args.sessions, args.turns, args.speculative, extra_env,
+                            args.uplink, args.uplink_rate)
+            summaries[runtime] = summarise(results)
+            report(runtime, args.sessions, summaries[runtime], results)
+    finally:
+        upstreams.stop()
+    print(f"Upstream calls: {upstreams.stats}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"sessions": args.sessions, "turns": args.turns, **summaries}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(json.load(f), summaries, args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance * 100:.0f}% of {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
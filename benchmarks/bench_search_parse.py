@@ -0,0 +1,65 @@
+"""
+Search results parsing: BeautifulSoup with html.parser (previous implementation) vs
+the anchor-only regex scan in services/search_service.py, on a synthetic DuckDuckGo
+HTML results page of realistic size.
+
+    python benchmarks/bench_search_parse.py --results 30 --repeat 50
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+from services.search_service import parse_result_snippets
+
+RESULT = """
+<div class="result results_links results_links_deep web-result">
+  <div class="links_main links_deep result__body">
+    <h2 class="result__title">
+      <a rel="nofollow" class="result__a" href="//duckduckgo.com/l/?uddg=https%3A%2F%2Fexample.com%2F{i}">Result {i}: the <b>answer</b> &amp; more details</a>
+    </h2>
+    <div class="result__extras"><div class="result__extras__url"><span class="result__icon"></span>
+      <a class="result__url" href="//duckduckgo.com/l/?uddg=https%3A%2F%2Fexample.com%2F{i}">example.com/{i}</a></div></div>
+    <a class="result__snippet" href="//duckduckgo.com/l/?uddg=https%3A%2F%2Fexample.com%2F{i}">{snippet}</a>
+  </div>
+</div>"""
+
+
+def build_page(results: int) -> str:
+    snippet = "A longer snippet describing the page with <b>highlighted</b> query terms. " * 4
+    body = "".join(RESULT.format(i=i, snippet=snippet) for i in range(results))
+    head = "<html><head><title>query at DuckDuckGo</title>" + "<style>.x{color:red}</style>" * 20 + "</head>"
+    return f"{head}<body><div id='links' class='results'>{body}</div></body></html>"
+
+
+def bs4_snippets(page: str) -> list[str]:
+    soup = BeautifulSoup(page, "html.parser")
+    return [a.get_text(strip=True) for a in soup.find_all('a', class_='result__a', limit=3)]
+
+
+def bench(name: str, fn, page: str, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(page)
+    per_call = (time.perf_counter() - start) / repeat * 1000
+    print(f"{name:>14} | {per_call:8.3f} ms/page | {fn(page)[0]!r}")
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--results", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    page = build_page(args.results)
+    print(f"page size: {len(page) / 1024:.0f} KiB")
+    old = bench("BeautifulSoup", bs4_snippets, page, args.repeat)
+    new = bench("anchor regex", parse_result_snippets, page, args.repeat)
+    print(f"speed-up: {old / new:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
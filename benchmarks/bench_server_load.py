@@ -0,0 +1,264 @@
+"""
+Load benchmark: threaded Flask server (app.py) vs asyncio server (asgi_app.py).
+
+Each runtime is started in a subprocess with the upstream services (AssemblyAI,
+Gemini, Murf, web search) replaced by in-process stand-ins that only add latency,
+so the numbers reflect the serving runtime rather than the network. N concurrent
+clients then talk to /transcribe-ws like the browser does: PCM frames every 256 ms,
+one simulated utterance per turn, several turns per connection.
+
+    python benchmarks/bench_server_load.py --sessions 200 --turns 3
+    python benchmarks/bench_server_load.py --runtime async --sessions 500
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Simulated upstream latencies (seconds)
+STT_HANDSHAKE = 0.30
+LLM_FIRST_SENTENCE = 0.40
+LLM_NEXT_SENTENCE = 0.15
+LLM_SENTENCES = 3
+TTS_GENERATE = 0.30
+TTS_DOWNLOAD = 0.10
+TTS_CLIP_BYTES = 24_000
+# Browser-like uplink: 4096 PCM16 samples at 16 kHz every 256 ms; a turn ends after ~1.5 s of audio
+FRAME_BYTES = 8192
+FRAME_INTERVAL = 0.256
+TURN_AUDIO_BYTES = 6 * FRAME_BYTES
+# A 220 Hz tone at -14 dBFS so the server's VAD gate treats the uplink as speech
+SPEECH_FRAME = b"".join(int(6500 * math.sin(2 * math.pi * 220 * n / 16000)).to_bytes(2, "little", signed=True)
+                        for n in range(FRAME_BYTES // 2))
+
+
+# --- server side -------------------------------------------------------------------
+
+def _install_stand_ins():
+    """Replace upstream calls with latency-only stand-ins (server subprocess only)."""
+    import assemblyai.streaming.v3 as aai_v3
+    from assemblyai.streaming.v3 import StreamingEvents, TurnEvent
+    from services import turn_service
+    from services.tts_cache import AudioStream, AsyncAudioStream
+    from services.tracing import span, timed_iter, timed_aiter
+
+    class SimulatedStreamingClient:
+        def __init__(self, options):
+            self._handlers = []
+            self._bytes = 0
+            self._turn_order = 0
+
+        def on(self, event, handler):
+            if event == StreamingEvents.Turn:
+                self._handlers.append(handler)
+
+        def connect(self, params):
+            time.sleep(STT_HANDSHAKE)
+
+        def stream(self, data):
+            self._bytes += len(data)
+            if self._bytes >= TURN_AUDIO_BYTES:
+                self._bytes = 0
+                event = TurnEvent(type="Turn", turn_order=self._turn_order, turn_is_formatted=True,
+                                  end_of_turn=True, transcript="tell me something about space",
+                                  end_of_turn_confidence=1.0, words=[])
+                self._turn_order += 1
+                # The SDK delivers events on its reader thread
+                threading.Thread(target=lambda: [h(self, event) for h in self._handlers], daemon=True).start()
+
+        def disconnect(self, terminate=False):
+            pass
+
+    aai_v3.StreamingClient = SimulatedStreamingClient
+
+    def sentences(prompt, key):
+        for i in range(LLM_SENTENCES):
+            time.sleep(LLM_FIRST_SENTENCE if i == 0 else LLM_NEXT_SENTENCE)
+            yield f"Simulated sentence number {i} about space."
+
+    async def sentences_async(prompt, key):
+        for i in range(LLM_SENTENCES):
+            await asyncio.sleep(LLM_FIRST_SENTENCE if i == 0 else LLM_NEXT_SENTENCE)
+            yield f"Simulated sentence number {i} about space."
+
+    def audio(text, key, **_):
+        with span("murf_generate"):
+            time.sleep(TTS_GENERATE)
+        def chunks():
+            time.sleep(TTS_DOWNLOAD)
+            yield b"\0" * TTS_CLIP_BYTES
+        return AudioStream(timed_iter(chunks(), "murf_download"))
+
+    async def audio_async(text, key, **_):
+        with span("murf_generate"):
+            await asyncio.sleep(TTS_GENERATE)
+        async def chunks():
+            await asyncio.sleep(TTS_DOWNLOAD)
+            yield b"\0" * TTS_CLIP_BYTES
+        return AsyncAudioStream(timed_aiter(chunks(), "murf_download"))
+
+    turn_service.stream_llm_sentences = sentences
+    turn_service.stream_llm_sentences_async = sentences_async
+    turn_service.open_murf_audio = audio
+    turn_service.open_murf_audio_async = audio_async
+    turn_service.control_esp32_led = lambda state: f"LED turned {state}!"
+    turn_service.open_in_chrome = lambda intent: False
+
+
+def serve(runtime: str, port: int):
+    import logging
+    sys.path.insert(0, ROOT)
+    os.environ["MURF_API_KEY"] = ""
+    _install_stand_ins()
+    if runtime == "threaded":
+        from app import app
+        logging.getLogger().setLevel(logging.WARNING)
+        app.run(host="127.0.0.1", port=port, threaded=True)
+    else:
+        import uvicorn
+        from asgi_app import app
+        logging.getLogger().setLevel(logging.WARNING)
+        uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", ws_max_queue=64)
+
+
+# --- client side -------------------------------------------------------------------
+
+async def run_session(url: str, turns: int, results: dict):
+    from websockets.asyncio.client import connect
+    t0 = time.perf_counter()
+    async with connect(url, max_size=None, open_timeout=60) as ws:
+        await ws.send(json.dumps({"assemblyKey": "bench", "geminiKey": "bench", "murfKey": "bench",
+                                  "multiTurn": True, "streamingReplies": True, "binaryAudio": True}))
+        results["connect"].append(time.perf_counter() - t0)
+        frame = SPEECH_FRAME
+        for _ in range(turns):
+            turn_ended = None
+            first_audio = None
+            done = asyncio.Event()
+
+            async def reader():
+                nonlocal turn_ended, first_audio
+                async for message in ws:
+                    if isinstance(message, bytes):
+                        if first_audio is None:
+                            first_audio = time.perf_counter()
+                        continue
+                    msg = json.loads(message)
+                    if msg["type"] == "end_of_turn":
+                        turn_ended = time.perf_counter()
+                    elif msg["type"] == "audio_done":
+                        done.set()
+                        return
+
+            read_task = asyncio.create_task(reader())
+            # Stream audio like the browser until the server ends the turn
+            while turn_ended is None and not read_task.done():
+                await ws.send(frame)
+                await asyncio.sleep(FRAME_INTERVAL)
+            await asyncio.wait_for(done.wait(), timeout=60)
+            read_task.cancel()
+            results["ttfa"].append(first_audio - turn_ended)
+            results["turn"].append(time.perf_counter() - turn_ended)
+
+
+def _pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] * 1000 if values else float("nan")
+
+
+async def drive(port: int, sessions: int, turns: int) -> dict:
+    results = {"connect": [], "ttfa": [], "turn": [], "errors": 0}
+    url = f"ws://127.0.0.1:{port}/transcribe-ws"
+
+    async def guarded():
+        try:
+            await run_session(url, turns, results)
+        except Exception:
+            results["errors"] += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(guarded() for _ in range(sessions)))
+    results["elapsed"] = time.perf_counter() - t0
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def _server_stages(port: int) -> dict:
+    """Per-stage latency histograms from the server's /metrics."""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=10) as res:
+        metrics = json.load(res)
+    return {name: stats for name, stats in metrics.items()
+            if (name.startswith("stage_") or name == "turn_total") and stats.get("count")}
+
+
+def bench(runtime: str, sessions: int, turns: int) -> dict:
+    port = _free_port()
+    server = subprocess.Popen([sys.executable, __file__, "--serve", runtime, "--port", str(port)],
+                              cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        results = asyncio.run(drive(port, sessions, turns))
+        results["stages"] = _server_stages(port)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return results
+
+
+def report(runtime: str, sessions: int, results: dict):
+    completed = len(results["turn"])
+    print(f"{runtime:>9} | sessions {sessions:4d} | turns {completed:5d} | errors {results['errors']:3d} | "
+          f"{completed / results['elapsed']:6.1f} turns/s | "
+          f"connect p50 {_pct(results['connect'], .5):6.0f} ms | "
+          f"TTFA p50 {_pct(results['ttfa'], .5):6.0f} p95 {_pct(results['ttfa'], .95):6.0f} p99 {_pct(results['ttfa'], .99):6.0f} ms | "
+          f"turn p95 {_pct(results['turn'], .95):6.0f} ms")
+    for name, stats in sorted(results["stages"].items()):
+        print(f"{'':>9} | {name:<22} p50 {stats['p50_ms']:7.1f} p95 {stats['p95_ms']:7.1f} "
+              f"p99 {stats['p99_ms']:7.1f} ms  (n={stats['count']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runtime", choices=["threaded", "async", "both"], default="both")
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--serve", choices=["threaded", "async"], help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+    ideal = LLM_FIRST_SENTENCE + TTS_GENERATE + TTS_DOWNLOAD
+    print(f"Simulated ideal TTFA: {ideal * 1000:.0f} ms")
+    runtimes = ["threaded", "async"] if args.runtime == "both" else [args.runtime]
+    for runtime in runtimes:
+        report(runtime, args.sessions, bench(runtime, args.sessions, args.turns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Session store benchmark: how big a conversation's persisted state is, what encoding it
+costs, the load/save latency each backend adds per turn under concurrent sessions, and
+whether a conversation resumes when its reconnect lands on a different worker.
+
+The networked backend runs against the stand-in server (benchmarks/session_store_server.py)
+with `--latency` added per reply to imitate a store on another node.
+
+    python benchmarks/bench_session_store.py
+    python benchmarks/bench_session_store.py --turns 20 --sessions 50 --latency 0.002
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.session_store_server import StandInStore
+from services.conversation_memory import ConversationMemory
+from services.session_service import PERSONA
+from services.session_store import (MemorySessionStore, RedisSessionStore, decode_state, encode_state,
+                                    new_session_id)
+
+QUESTIONS = ["What's the weather like in Paris tomorrow?", "Turn on the living room lights.",
+             "Who won the football match last night?", "Set the thermostat to twenty one degrees.",
+             "Remind me what you said about the weather."]
+ANSWERS = ["Tomorrow in Paris expect light rain in the morning, clearing to sunny spells with a high of 18 degrees.",
+           "Done, the living room lights are on.",
+           "The home side won two to one after a late goal in stoppage time.",
+           "The thermostat is now set to 21 degrees.",
+           "I said Paris will see morning rain, then sunny spells, reaching about 18 degrees."]
+
+
+def conversation(turns: int) -> ConversationMemory:
+    memory = ConversationMemory(PERSONA)
+    for i in range(turns):
+        memory.add("user", QUESTIONS[i % len(QUESTIONS)])
+        memory.add("model", ANSWERS[i % len(ANSWERS)])
+    return memory
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_encoding(memory: ConversationMemory, repeat: int = 2000):
+    state = {"memory": memory.to_state()}
+    blob = encode_state(state)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encode_state(state)
+    encode_us = (time.perf_counter() - start) / repeat * 1e6
+    start = time.perf_counter()
+    for _ in range(repeat):
+        ConversationMemory.from_state(PERSONA, decode_state(blob)["memory"])
+    decode_us = (time.perf_counter() - start) / repeat * 1e6
+    print(f"state: {len(memory)} messages, {len(blob)} bytes on the wire | "
+          f"encode {encode_us:.0f} µs, decode + rebuild {decode_us:.0f} µs")
+    return state
+
+
+def bench_backend(name: str, store, state: dict, sessions: int, turns: int):
+    """Each thread is one session: load once (the resume), then save after every turn."""
+    loads, saves = [], []
+    lock = threading.Lock()
+
+    def session():
+        session_id = new_session_id()
+        start = time.perf_counter()
+        store.get(session_id)
+        load_ms = (time.perf_counter() - start) * 1000
+        times = []
+        for _ in range(turns):
+            start = time.perf_counter()
+            store.set(session_id, encode_state(state))
+            times.append((time.perf_counter() - start) * 1000)
+        with lock:
+            loads.append(load_ms)
+            saves.extend(times)
+
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8} | {sessions} sessions x {turns} turns | load p50 {statistics.median(loads):6.2f} "
+          f"p95 {percentile(loads, 0.95):6.2f} ms | save p50 {statistics.median(saves):6.2f} "
+          f"p95 {percentile(saves, 0.95):6.2f} ms | {len(saves) / elapsed:,.0f} saves/s")
+
+
+def bench_resume(name: str, worker_a, worker_b, state: dict):
+    """A session saved by one worker, then reconnected to another."""
+    session_id = new_session_id()
+    worker_a.set(session_id, encode_state(state))
+    blob = worker_b.get(session_id)
+    restored = len(decode_state(blob)["memory"]["messages"]) if blob is not None else 0
+    print(f"{name:>8} | reconnect on another worker: "
+          f"{'resumed with %d messages' % restored if blob is not None else 'history lost'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=10, help="turns per conversation")
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent sessions")
+    parser.add_argument("--latency", type=float, default=0.001, help="stand-in store's added latency per reply (s)")
+    args = parser.parse_args()
+    state = bench_encoding(conversation(args.turns))
+    server = StandInStore(latency=args.latency).start()
+    try:
+        bench_backend("memory", MemorySessionStore(), state, args.sessions, args.turns)
+        bench_backend("redis", RedisSessionStore(server.url), state, args.sessions, args.turns)
+        # Each worker process has its own in-process store; the networked one is shared
+        bench_resume("memory", MemorySessionStore(), MemorySessionStore(), state)
+        bench_resume("redis", RedisSessionStore(server.url), RedisSessionStore(server.url), state)
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
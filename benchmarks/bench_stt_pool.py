@@ -0,0 +1,72 @@
+"""
+STT connection pool benchmark: time until a voice session's AssemblyAI stream is live,
+with and without pre-connected sessions, for clients that reconnect per question (the
+legacy single-turn page) with a short think time between questions. The AssemblyAI
+client is replaced by a stand-in that only adds handshake latency.
+
+    python benchmarks/bench_stt_pool.py --sessions 20 --handshake 0.35 --think 1.0
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import assemblyai.streaming.v3 as aai_v3
+from services import transcriber
+from services.transcriber import STTConnectionPool, StreamingTranscriber
+
+HANDSHAKE = 0.35
+
+
+class LatencyOnlyStreamingClient:
+    def __init__(self, options):
+        self.sent = 0
+
+    def on(self, event, handler):
+        pass
+
+    def connect(self, params):
+        time.sleep(HANDSHAKE)
+
+    def stream(self, data):
+        self.sent += len(data)
+
+    def disconnect(self, terminate=False):
+        pass
+
+
+def run(pool_size: int, sessions: int, think: float) -> list[float]:
+    pool = STTConnectionPool(size=pool_size, idle_seconds=60)
+    ready = []
+    for _ in range(sessions):
+        stt = StreamingTranscriber("bench-key", on_turn=lambda event: None, pool=pool)
+        # The browser starts streaming immediately; early audio lands in the ring buffer
+        stt.stream(b"\0" * 8192)
+        stt.ready.wait()
+        ready.append((time.monotonic() - stt._opened_at) * 1000)
+        time.sleep(think)
+        stt.close()
+    return ready
+
+
+def main():
+    global HANDSHAKE
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--handshake", type=float, default=HANDSHAKE)
+    parser.add_argument("--think", type=float, default=1.0, help="seconds between a session's start and the next one")
+    args = parser.parse_args()
+    HANDSHAKE = args.handshake
+    aai_v3.StreamingClient = LatencyOnlyStreamingClient
+    for size in (0, 1):
+        ready = run(size, args.sessions, args.think)
+        print(f"pool size {size} | stream live after p50 {statistics.median(ready):6.1f} ms | "
+              f"max {max(ready):6.1f} ms")
+    print(f"pool stats: {transcriber.stt_pool.stats()}")
+
+
+if __name__ == "__main__":
+    main()
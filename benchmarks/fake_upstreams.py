@@ -0,0 +1,493 @@
+"""
+Local stand-ins for every upstream the voice agent talks to, so the real server can be
+exercised end to end with no network and no API keys:
+
+- AssemblyAI streaming v3 (TLS WebSocket): Begin, partial and final Turn events, driven
+  by the energy of the received audio and by ForceEndpoint, then Termination
+- Gemini generateContent / streamGenerateContent (SSE), optionally answering 429 past a
+  number of concurrent requests
+- Murf speech/generate and the audio file download, and speech/stream
+- DuckDuckGo's HTML results page
+- AssemblyAI's pre-recorded REST API (upload, create transcript, poll)
+- OpenAI's image generation (b64_json PNGs of noise, about the size of real ones)
+- an MQTT broker (benchmarks/mqtt_broker.py), with a fixed response latency
+
+The HTTP and STT stand-ins answer after a configurable latency with log-normal jitter.
+Questions and answers differ per session and per request, so the server's search and
+TTS caches only hit where they would with real traffic. Point the
+server at them with the environment from `FakeUpstreams.server_env()`:
+
+    python benchmarks/fake_upstreams.py --latency gemini=400,murf=300 --jitter 0.3
+
+The AssemblyAI SDK only speaks wss://, so a self-signed certificate for 127.0.0.1 is
+generated and handed to the server process through SSL_CERT_FILE.
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_search_parse import build_page
+from mqtt_broker import StandInBroker
+
+# Median latency of each upstream (milliseconds)
+DEFAULT_LATENCY_MS = {
+    "stt_connect": 300,   # AssemblyAI WebSocket handshake until Begin
+    "stt_final": 250,     # end of speech (or ForceEndpoint) to the final Turn
+    "gemini": 450,        # request to first streamed chunk / full answer
+    "gemini_chunk": 120,  # between streamed chunks
+    "murf": 350,          # speech/generate
+    "download": 80,       # audio file download
+    "murf_chunk": 20,     # between speech/stream chunks
+    "search": 400,        # DuckDuckGo results page
+    "mqtt": 20,           # broker response
+    "stt_upload": 100,    # AssemblyAI file upload
+    "stt_batch": 1500,    # pre-recorded transcript creation until it reads completed
+    "image": 8000,        # OpenAI image generation
+}
+# Log-normal sigma applied to every latency; 0.3 gives a p99 of about twice the median
+DEFAULT_JITTER = 0.3
+
+# Final transcripts, in turn order: a web question, a device command, identity, chat.
+# {n} is the STT session number.
+SCRIPT = [
+    "what is the tallest mountain on planet {n}",
+    "turn on the light",
+    "who are you",
+    "tell me something interesting about black hole {n}",
+]
+# {n} is the Gemini request number, so no two replies share a sentence
+REPLY = ("Answer {n} is Olympus Mons on Mars. It rises about {n} kilometres above the plains. "
+         "That is {n} times the height of a small hill. Want to hear more about number {n}?")
+# Frame-energy threshold (RMS of PCM16 samples) for the fake STT's speech detection
+SPEECH_RMS = 300
+# Trailing silence after which the fake STT ends a turn on its own (clients without server VAD)
+STT_SILENCE_MS = 700
+PARTIAL_EVERY_MS = 500
+SAMPLE_RATE = 16000
+# Fake MP3 size: about 16 kB per second of speech at ~15 characters per second
+AUDIO_BYTES_PER_CHAR = 1100
+# speech/stream body chunk size
+MURF_STREAM_CHUNK = 4096
+
+
+class Latency:
+    """Median latencies per upstream with log-normal jitter."""
+
+    def __init__(self, medians_ms: dict | None = None, jitter: float = DEFAULT_JITTER, seed: int | None = None):
+        self.medians_ms = dict(DEFAULT_LATENCY_MS, **(medians_ms or {}))
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+
+    def seconds(self, name: str) -> float:
+        median = self.medians_ms[name] / 1000
+        if not self.jitter:
+            return median
+        return median * math.exp(self._rng.gauss(0, self.jitter))
+
+    async def wait(self, name: str):
+        await asyncio.sleep(self.seconds(name))
+
+
+def parse_latency(spec: str) -> dict:
+    """'gemini=400,murf=300' -> {'gemini': 400.0, 'murf': 300.0}"""
+    medians = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        if name not in DEFAULT_LATENCY_MS:
+            raise ValueError(f"unknown upstream {name!r} (one of {', '.join(DEFAULT_LATENCY_MS)})")
+        medians[name] = float(value)
+    return medians
+
+
+def _self_signed_cert(directory: str) -> tuple[str, str]:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    import ipaddress
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "fake-upstreams")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5)).not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+                                                        x509.DNSName("localhost")]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256()))
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def noise_png(width: int, height: int, seed: int = 0) -> bytes:
+    """RGB PNG of random pixels: incompressible, so about as large as a generated photo-like image."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width * 3), dtype=np.uint8)
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), pixels]).tobytes()  # filter byte 0 per row
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+
+# --- AssemblyAI streaming --------------------------------------------------------------
+
+class _FakeSTTSession:
+    """One streaming connection: turns open on speech and end on ForceEndpoint or trailing silence."""
+
+    def __init__(self, ws, number: int, latency: Latency, stats: dict):
+        self.ws = ws
+        self.number = number
+        self.latency = latency
+        self.stats = stats
+        self.turn_order = 0
+        self.speech_ms = 0.0
+        self.silence_ms = 0.0
+        self.since_partial_ms = 0.0
+        self.finals = set()
+
+    def _transcript(self, complete: bool) -> str:
+        words = SCRIPT[self.turn_order % len(SCRIPT)].format(n=self.number).split()
+        if not complete:
+            words = words[:max(1, min(len(words) - 1, int(self.speech_ms / 300)))]
+        return " ".join(words)
+
+    async def _send_turn(self, end_of_turn: bool, complete: bool = False):
+        await self.ws.send(json.dumps({
+            "type": "Turn", "turn_order": self.turn_order, "turn_is_formatted": end_of_turn,
+            "end_of_turn": end_of_turn, "transcript": self._transcript(complete or end_of_turn),
+            "end_of_turn_confidence": 0.9 if end_of_turn else 0.1, "words": [],
+        }))
+
+    async def _finalise(self):
+        turn = self.turn_order
+        if turn in self.finals:
+            return
+        self.finals.add(turn)
+        await self.latency.wait("stt_final")
+        await self._send_turn(end_of_turn=True)
+        self.stats["turns"] += 1
+        self.turn_order = turn + 1
+        self.speech_ms = self.silence_ms = 0.0
+
+    def audio(self, data: bytes):
+        samples = np.frombuffer(data[:len(data) // 2 * 2], dtype="<i2").astype(np.float32)
+        chunk_ms = len(samples) / SAMPLE_RATE * 1000
+        self.stats["audio_bytes"] += len(data)
+        if samples.size and math.sqrt(float(np.mean(samples * samples))) > SPEECH_RMS:
+            self.speech_ms += chunk_ms
+            self.silence_ms = 0.0
+            self.since_partial_ms += chunk_ms
+            if self.since_partial_ms >= PARTIAL_EVERY_MS:
+                self.since_partial_ms = 0.0
+                asyncio.ensure_future(self._send_turn(end_of_turn=False))
+        elif self.speech_ms:
+            if not self.silence_ms:
+                # The recogniser catches up with the last words once speech stops
+                asyncio.ensure_future(self._send_turn(end_of_turn=False, complete=True))
+            self.silence_ms += chunk_ms
+            if self.silence_ms >= STT_SILENCE_MS:
+                asyncio.ensure_future(self._finalise())
+
+    async def run(self):
+        await self.ws.send(json.dumps({"type": "Begin", "id": str(uuid.uuid4()),
+                                       "expires_at": int(time.time()) + 3600}))
+        async for message in self.ws:
+            if isinstance(message, bytes):
+                self.audio(message)
+                continue
+            kind = json.loads(message).get("type")
+            if kind == "ForceEndpoint":
+                self.stats["force_endpoints"] += 1
+                if self.speech_ms:
+                    await self._finalise()
+            elif kind == "Terminate":
+                await self.ws.send(json.dumps({"type": "Termination", "audio_duration_seconds": 0,
+                                               "session_duration_seconds": 0}))
+                await self.ws.close()
+                return
+
+
+# --- HTTP upstreams --------------------------------------------------------------------
+
+def _http_app(latency: Latency, stats: dict, base_url: str, gemini_capacity: int | None = None):
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+    from starlette.routing import Route
+
+    def candidate(text: str) -> dict:
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}]}
+
+    in_flight = {"gemini": 0}
+
+    async def gemini(request: Request):
+        call = request.path_params["call"]
+        await request.body()
+        stats["gemini_requests"] += 1
+        if gemini_capacity is not None and in_flight["gemini"] >= gemini_capacity:
+            # Like the real API once a project's quota is exhausted
+            stats["gemini_429s"] += 1
+            return JSONResponse({"error": {"code": 429, "message": "Resource has been exhausted",
+                                           "status": "RESOURCE_EXHAUSTED"}}, status_code=429)
+        in_flight["gemini"] += 1
+        reply = REPLY.format(n=stats["gemini_requests"])
+        try:
+            await latency.wait("gemini")
+        except BaseException:
+            in_flight["gemini"] -= 1
+            raise
+        if call.endswith(":generateContent"):
+            in_flight["gemini"] -= 1
+            body = candidate(reply)
+            body["candidates"][0]["finishReason"] = "STOP"
+            return JSONResponse(body)
+
+        async def events():
+            try:
+                words = reply.split(" ")
+                for i in range(0, len(words), 4):
+                    if i:
+                        await latency.wait("gemini_chunk")
+                    yield f"data: {json.dumps(candidate(' '.join(words[i:i + 4]) + ' '))}\r\n\r\n"
+            finally:
+                in_flight["gemini"] -= 1
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    def murf_clip_bytes(payload: dict) -> int:
+        # AUDIO_BYTES_PER_CHAR is for Murf's default 44.1 kHz; MP3 size follows the sample rate
+        size = len(payload.get("text", "")) * AUDIO_BYTES_PER_CHAR * int(payload.get("sampleRate") or 44100) // 44100
+        return max(2048, size)
+
+    async def murf_generate(request: Request):
+        payload = await request.json()
+        stats["murf_requests"] += 1
+        await latency.wait("murf")
+        size = murf_clip_bytes(payload)
+        return JSONResponse({"audioFile": f"{base_url}/murf/audio/{uuid.uuid4().hex}.mp3?bytes={size}",
+                             "audioLengthInSeconds": size / 16000})
+
+    async def murf_audio(request: Request):
+        stats["murf_downloads"] += 1
+        await latency.wait("download")
+        size = int(request.query_params.get("bytes", 16000))
+        # An MPEG frame header up front so the bytes at least look like MP3
+        return Response(b"\xff\xfb\x90\x64" + b"\0" * (size - 4), media_type="audio/mpeg")
+
+    async def murf_stream(request: Request):
+        payload = await request.json()
+        stats["murf_requests"] += 1
+        size = murf_clip_bytes(payload)
+        # Same time to first audio as speech/generate, then the rest as it is synthesised
+        await latency.wait("murf")
+
+        async def body():
+            yield b"\xff\xfb\x90\x64" + b"\0" * (MURF_STREAM_CHUNK - 4)
+            for _ in range(MURF_STREAM_CHUNK, size, MURF_STREAM_CHUNK):
+                await latency.wait("murf_chunk")
+                yield b"\0" * MURF_STREAM_CHUNK
+        return StreamingResponse(body(), media_type="audio/mpeg")
+
+    async def search(request: Request):
+        stats["searches"] += 1
+        await latency.wait("search")
+        return HTMLResponse(build_page(30))
+
+    uploads = {}
+    transcripts = {}
+
+    async def stt_upload(request: Request):
+        digest = hashlib.sha256()
+        async for chunk in request.stream():
+            digest.update(chunk)
+        stats["stt_uploads"] += 1
+        await latency.wait("stt_upload")
+        name = uuid.uuid4().hex
+        uploads[name] = digest.hexdigest()
+        return JSONResponse({"upload_url": f"{base_url}/stt/files/{name}"})
+
+    async def stt_create(request: Request):
+        payload = await request.json()
+        stats["stt_transcripts"] += 1
+        transcript_id = uuid.uuid4().hex
+        sha = uploads.get(payload["audio_url"].rsplit("/", 1)[-1], "")
+        transcripts[transcript_id] = (payload["audio_url"], time.monotonic() + latency.seconds("stt_batch"),
+                                      f"Recording {sha[:8]} transcribed.")
+        return JSONResponse({"id": transcript_id, "status": "queued", "audio_url": payload["audio_url"]})
+
+    async def stt_poll(request: Request):
+        audio_url, ready_at, text = transcripts[request.path_params["id"]]
+        if time.monotonic() < ready_at:
+            return JSONResponse({"id": request.path_params["id"], "status": "processing", "audio_url": audio_url})
+        return JSONResponse({"id": request.path_params["id"], "status": "completed", "audio_url": audio_url,
+                             "text": text})
+
+    async def image_generate(request: Request):
+        payload = await request.json()
+        stats["image_requests"] += 1
+        await latency.wait("image")
+        width, _, height = payload.get("size", "1024x1024").partition("x")
+        seed = int(hashlib.sha256(payload["prompt"].encode()).hexdigest()[:8], 16)
+        png = await asyncio.to_thread(noise_png, int(width), int(height), seed)
+        return JSONResponse({"created": int(time.time()), "data": [
+            {"b64_json": base64.b64encode(png).decode(), "revised_prompt": payload["prompt"]}]})
+
+    return Starlette(routes=[
+        Route("/v1beta/models/{call}", gemini, methods=["POST"]),
+        Route("/v1/speech/generate", murf_generate, methods=["POST"]),
+        Route("/murf/audio/{name}", murf_audio, methods=["GET"]),
+        Route("/v1/speech/stream", murf_stream, methods=["POST"]),
+        Route("/html/", search, methods=["GET", "POST"]),
+        Route("/v2/upload", stt_upload, methods=["POST"]),
+        Route("/v2/transcript", stt_create, methods=["POST"]),
+        Route("/v2/transcript/{id}", stt_poll, methods=["GET"]),
+        Route("/v1/images/generations", image_generate, methods=["POST"]),
+    ])
+
+
+class FakeUpstreams:
+    """All stand-ins on one background event loop (plus the MQTT broker's own thread)."""
+
+    def __init__(self, latency: Latency | None = None, gemini_capacity: int | None = None):
+        self.latency = latency or Latency()
+        # Concurrent Gemini requests served before the rest get 429 (None: unlimited)
+        self.gemini_capacity = gemini_capacity
+        self.stats = {"stt_sessions": 0, "turns": 0, "force_endpoints": 0, "audio_bytes": 0, "gemini_requests": 0,
+                      "gemini_429s": 0, "murf_requests": 0, "murf_downloads": 0, "searches": 0, "stt_uploads": 0,
+                      "stt_transcripts": 0, "image_requests": 0}
+        self._tmp = tempfile.TemporaryDirectory(prefix="fake-upstreams-")
+        self.cert_path, self._key_path = _self_signed_cert(self._tmp.name)
+        self.http_port = _free_port()
+        self.stt_port = _free_port()
+        self.broker = None
+        self._loop = None
+        self._thread = None
+        self._http_server = None
+
+    @property
+    def http_url(self) -> str:
+        return f"http://127.0.0.1:{self.http_port}"
+
+    def server_env(self) -> dict:
+        """Environment that points app.py / asgi_app.py at these stand-ins."""
+        return {
+            "ASSEMBLYAI_STREAMING_HOST": f"127.0.0.1:{self.stt_port}",
+            "ASSEMBLYAI_BASE_URL": self.http_url,
+            "ASSEMBLYAI_POLL_SECONDS": "0.1",
+            "SSL_CERT_FILE": self.cert_path,
+            "GEMINI_BASE_URL": self.http_url,
+            "MURF_API_URL": f"{self.http_url}/v1/speech/generate",
+            "MURF_STREAM_URL": f"{self.http_url}/v1/speech/stream",
+            "SEARCH_URL": f"{self.http_url}/html/",
+            "OPENAI_BASE_URL": f"{self.http_url}/v1",
+            "MQTT_BROKER": "127.0.0.1",
+            "MQTT_PORT": str(self.broker.port),
+        }
+
+    async def _stt_handler(self, ws):
+        from websockets.exceptions import ConnectionClosed
+        self.stats["stt_sessions"] += 1
+        try:
+            await _FakeSTTSession(ws, self.stats["stt_sessions"], self.latency, self.stats).run()
+        except ConnectionClosed:
+            pass
+
+    async def _process_request(self, connection, request):
+        # Handshake latency: the SDK's connect() blocks until Begin-ready
+        await self.latency.wait("stt_connect")
+
+    async def _serve(self, started: threading.Event):
+        import ssl
+        import uvicorn
+        from websockets.asyncio.server import serve
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert_path, self._key_path)
+        stt_server = await serve(self._stt_handler, "127.0.0.1", self.stt_port, ssl=context,
+                                 process_request=self._process_request, max_size=None)
+        config = uvicorn.Config(_http_app(self.latency, self.stats, self.http_url, self.gemini_capacity), host="127.0.0.1",
+                                port=self.http_port, log_level="warning", lifespan="off")
+        self._http_server = uvicorn.Server(config)
+        http_task = asyncio.ensure_future(self._http_server.serve())
+        while not self._http_server.started:
+            await asyncio.sleep(0.01)
+        started.set()
+        await http_task
+        stt_server.close()
+        await stt_server.wait_closed()
+
+    def start(self) -> "FakeUpstreams":
+        self.broker = StandInBroker(latency=self.latency.medians_ms["mqtt"] / 1000).start()
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._serve(started))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="fake-upstreams", daemon=True)
+        self._thread.start()
+        if not started.wait(timeout=30):
+            raise RuntimeError("fake upstreams did not start")
+        return self
+
+    def stop(self):
+        if self._http_server is not None:
+            self._http_server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        if self.broker is not None:
+            self.broker.stop()
+        self._tmp.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", default="", help="median latencies in ms, e.g. gemini=400,murf=300")
+    parser.add_argument("--jitter", type=float, default=DEFAULT_JITTER, help="log-normal sigma of every latency")
+    parser.add_argument("--gemini-capacity", type=int, help="concurrent Gemini requests before answering 429")
+    args = parser.parse_args()
+    upstreams = FakeUpstreams(Latency(parse_latency(args.latency), args.jitter), args.gemini_capacity).start()
+    print("Fake upstreams running. Start the server with:\n")
+    print(" ".join(f"{k}={v}" for k, v in upstreams.server_env().items()) + " python app.py\n")
+    try:
+        while True:
+            time.sleep(5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(upstreams.stats, indent=2))
+        upstreams.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Minimal MQTT 3.1.1 broker for local testing and benchmarks.
+
+Speaks enough of the protocol for paho clients and ESP32 firmware to talk to it like
+they would to Mosquitto: CONNECT/CONNACK, PUBLISH at QoS 0 and 1 (PUBACK), SUBSCRIBE
+with `+`/`#` wildcards, retained messages, PINGREQ and DISCONNECT. QoS 2 publishes are
+delivered at QoS 1. `latency` delays every broker response to imitate a remote broker;
+like a network link it is pipelined, so packets sent back to back arrive back to back.
+
+    python benchmarks/mqtt_broker.py --port 1883 --latency 0.05
+
+Or in-process:
+
+    broker = StandInBroker(latency=0.05).start()
+    send_mqtt_command("on", broker="127.0.0.1", port=broker.port)
+    broker.stop()
+"""
+import argparse
+import asyncio
+import struct
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+def _encode_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([(packet_type << 4) | flags]) + _encode_length(len(body)) + body
+
+
+def _utf8(data: bytes, pos: int) -> tuple[str, int]:
+    (n,) = struct.unpack_from(">H", data, pos)
+    return data[pos + 2:pos + 2 + n].decode("utf-8"), pos + 2 + n
+
+
+class _Session:
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.subscriptions = {}
+        self.next_mid = 1
+        self._outbox = asyncio.Queue()   # (due time, packet), written in order
+        self._sender = asyncio.ensure_future(self._send_loop())
+
+    def _enqueue(self, data: bytes):
+        self._outbox.put_nowait((asyncio.get_running_loop().time() + self.broker.latency, data))
+
+    async def send(self, data: bytes):
+        self._enqueue(data)
+
+    async def _send_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            due, data = await self._outbox.get()
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            if not self.writer.is_closing():
+                self.writer.write(data)
+                await self.writer.drain()
+
+    def close(self):
+        self._sender.cancel()
+        self.writer.close()
+
+    def deliver(self, topic: str, payload: bytes, qos: int, retain: bool = False):
+        qos = min(qos, 1)
+        header = struct.pack(">H", len(topic.encode())) + topic.encode()
+        if qos:
+            header += struct.pack(">H", self.next_mid)
+            self.next_mid = self.next_mid % 65535 + 1
+        self._enqueue(_packet(PUBLISH, (qos << 1) | int(retain), header + payload))
+
+
+class StandInBroker:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.sessions = set()
+        self.retained = {}
+        self.published = []  # (topic, payload, qos) of every PUBLISH received, in order
+        self.connections = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    async def _read_packet(self, reader) -> tuple[int, int, bytes]:
+        first = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        session = _Session(self, writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    self.connections += 1
+                    await session.send(_packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+                    topic, pos = _utf8(body, 0)
+                    mid = None
+                    if qos:
+                        (mid,) = struct.unpack_from(">H", body, pos)
+                        pos += 2
+                    payload = body[pos:]
+                    self.published.append((topic, payload, qos))
+                    if retain:
+                        if payload:
+                            self.retained[topic] = (payload, qos)
+                        else:
+                            self.retained.pop(topic, None)
+                    for other in list(self.sessions):
+                        granted = [q for pattern, q in other.subscriptions.items() if topic_matches(pattern, topic)]
+                        if granted:
+                            other.deliver(topic, payload, min(qos, max(granted)))
+                    if qos == 1:
+                        await session.send(_packet(PUBACK, 0, struct.pack(">H", mid)))
+                    elif qos == 2:
+                        await session.send(_packet(PUBREC, 0, struct.pack(">H", mid)))
+                elif packet_type == PUBREL:
+                    await session.send(_packet(PUBCOMP, 0, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    (mid,) = struct.unpack_from(">H", body, 0)
+                    pos, granted = 2, {}
+                    while pos < len(body):
+                        pattern, pos = _utf8(body, pos)
+                        granted[pattern] = min(body[pos], 1)
+                        pos += 1
+                    session.subscriptions.update(granted)
+                    await session.send(_packet(SUBACK, 0, struct.pack(">H", mid) + bytes(granted.values())))
+                    # Retained messages are sent for the filters in this SUBSCRIBE only
+                    for topic, (payload, qos) in list(self.retained.items()):
+                        matched = [q for pattern, q in granted.items() if topic_matches(pattern, topic)]
+                        if matched:
+                            session.deliver(topic, payload, min(qos, max(matched)), retain=True)
+                elif packet_type == UNSUBSCRIBE:
+                    (mid,) = struct.unpack_from(">H", body, 0)
+                    pos = 2
+                    while pos < len(body):
+                        pattern, pos = _utf8(body, pos)
+                        session.subscriptions.pop(pattern, None)
+                    await session.send(_packet(UNSUBACK, 0, struct.pack(">H", mid)))
+                elif packet_type == PINGREQ:
+                    await session.send(_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                # PUBACK/PUBCOMP from subscribers need no reply
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            session.close()
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self._server
+
+    def start(self) -> "StandInBroker":
+        """Run the broker on a background thread; returns once it is accepting connections."""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.serve())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="mqtt-broker", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def drop_connections(self):
+        """Close every client socket, e.g. to exercise reconnects."""
+        for session in list(self.sessions):
+            self._loop.call_soon_threadsafe(session.writer.close)
+
+    async def _shutdown(self):
+        self._server.close()
+        for session in list(self.sessions):
+            session.close()
+        # Closing the sockets ends each handler's read loop; give them a moment to finish
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added before every broker response")
+    args = parser.parse_args()
+    broker = StandInBroker(args.host, args.port, args.latency)
+
+    async def run():
+        server = await broker.serve()
+        print(f"MQTT stand-in broker listening on {args.host}:{broker.port}")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Minimal Redis-protocol (RESP2) key-value server for local testing and benchmarks.
+
+Speaks enough of the protocol for the networked session store (SESSION_STORE_URL=redis://...)
+and redis-cli to talk to it like they would to Redis: PING, GET, SET with EX/PX, DEL,
+EXISTS, DBSIZE, FLUSHALL, plus SELECT and AUTH (accepted, not enforced). Keys expire
+lazily. `latency` delays every reply to imitate a store on another node.
+
+    python benchmarks/session_store_server.py --port 6379 --latency 0.001
+    SESSION_STORE_URL=redis://127.0.0.1:6379/0 uvicorn asgi_app:app --workers 4
+
+Or in-process:
+
+    store = StandInStore(latency=0.001).start()
+    os.environ["SESSION_STORE_URL"] = store.url
+    store.stop()
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+
+def _bulk(value: bytes | None) -> bytes:
+    return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def _integer(n: int) -> bytes:
+    return b":%d\r\n" % n
+
+
+def _error(message: str) -> bytes:
+    return f"-ERR {message}\r\n".encode()
+
+
+class StandInStore:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.data = {}      # key -> (value, expires at or None)
+        self.commands = 0
+        self.connections = 0
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}/0"
+
+    def _get(self, key: bytes) -> bytes | None:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.monotonic():
+            del self.data[key]
+            return None
+        return entry[0]
+
+    def _execute(self, args: list[bytes]) -> bytes:
+        command = args[0].upper()
+        if command == b"PING":
+            return b"+PONG\r\n"
+        if command in (b"SELECT", b"AUTH"):
+            return b"+OK\r\n"
+        if command == b"GET" and len(args) == 2:
+            return _bulk(self._get(args[1]))
+        if command == b"SET" and len(args) >= 3:
+            expires = None
+            options = [a.upper() for a in args[3:]]
+            if b"EX" in options:
+                expires = time.monotonic() + int(args[3 + options.index(b"EX") + 1])
+            elif b"PX" in options:
+                expires = time.monotonic() + int(args[3 + options.index(b"PX") + 1]) / 1000
+            self.data[args[1]] = (args[2], expires)
+            return b"+OK\r\n"
+        if command == b"DEL":
+            return _integer(sum(self.data.pop(key, None) is not None for key in args[1:]))
+        if command == b"EXISTS":
+            return _integer(sum(self._get(key) is not None for key in args[1:]))
+        if command == b"DBSIZE":
+            return _integer(len(self.data))
+        if command == b"FLUSHALL":
+            self.data.clear()
+            return b"+OK\r\n"
+        return _error(f"unsupported command '{args[0].decode(errors='replace')}'")
+
+    @staticmethod
+    async def _read_command(reader) -> list[bytes]:
+        line = await reader.readuntil(b"\r\n")
+        if not line.startswith(b"*"):
+            # Inline command (e.g. typed into telnet)
+            return line.split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            header = await reader.readuntil(b"\r\n")
+            args.append((await reader.readexactly(int(header[1:-2]) + 2))[:-2])
+        return args
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if not args:
+                    continue
+                self.commands += 1
+                reply = self._execute(args)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self._server
+
+    def start(self) -> "StandInStore":
+        """Run the server on a background thread; returns once it is accepting connections."""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.serve())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="session-store-server", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    async def _shutdown(self):
+        self._server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added before every reply")
+    args = parser.parse_args()
+    store = StandInStore(args.host, args.port, args.latency)
+
+    async def run():
+        server = await store.serve()
+        print(f"Session store stand-in listening on {store.url}")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ const int mqtt_port = 1883; // Standard MQTT port
 const char* mqtt_user = nullptr; // No username for public broker
 const char* mqtt_pass = nullptr; // No password for public broker
 const char* topic = "myhome/esp32/led"; // Must match backend topic
+const char* state_topic = "myhome/esp32/led/state"; // Retained LED state, read by the backend's device shadow
 
 WiFiClient espClient;
 PubSubClient client(espClient);
@@ -30,6 +31,11 @@ void setup_wifi() {
   Serial.println(WiFi.localIP());
 }
 
+// Report the LED's actual state, retained so the backend knows it even after reconnecting
+void publish_state() {
+  client.publish(state_topic, digitalRead(2) == HIGH ? "on" : "off", true);
+}
+
 void callback(char* topic, byte* payload, unsigned int length) {
   Serial.print("Message arrived [");
   Serial.print(topic);
@@ -45,6 +51,7 @@ void callback(char* topic, byte* payload, unsigned int length) {
   } else if (command == "off") {
     digitalWrite(2, LOW);
   }
+  publish_state();
 }
 
 void reconnect() {
@@ -58,6 +65,7 @@ void reconnect() {
       client.subscribe(topic);
       Serial.print("Subscribed to topic: ");
       Serial.println(topic);
+      publish_state();
     } else {
       Serial.print("failed, rc=");
       Serial.print(client.state());
@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from services.metrics_service import record_latency, register_stats_provider
+from services.tracing import current_trace
+
+logger = logging.getLogger(__name__)
+
+# Admission control for calls to rate-limited upstreams. Every call is admitted to a
+# stage: "llm" (Gemini), "tts" (Murf) or "device" (MQTT). Admission takes a token from
+# two buckets, one for the caller's API key and one shared by every key, and then a
+# slot from the stage's concurrency limit. Callers queue (FIFO, bounded) for both until
+# their deadline: the turn's, for calls made while answering a voice turn, or
+# ADMISSION_MAX_WAIT_SECONDS otherwise. Work that cannot be admitted by then is shed with
+# Overloaded straight away rather than left to time out upstream.
+
+
+def _parse_rates(spec: str, defaults: dict) -> dict:
+    """'llm=5/10,tts=20' -> {'llm': (5.0, 10.0), 'tts': (20.0, 20.0)} on top of `defaults` (rate per second / burst)."""
+    rates = dict(defaults)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        rates[name.strip()] = (float(rate), float(burst or rate))
+    return rates
+
+
+def _parse_limits(spec: str, defaults: dict) -> dict:
+    limits = dict(defaults)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        limits[name.strip()] = int(value)
+    return limits
+
+
+# Requests per second (sustained/burst) allowed per API key, and for all keys together
+KEY_RATES = _parse_rates(os.environ.get("RATE_LIMIT_PER_KEY", ""),
+                         {"llm": (5, 10), "tts": (20, 40), "device": (2, 5)})
+UPSTREAM_RATES = _parse_rates(os.environ.get("RATE_LIMIT_PER_UPSTREAM", ""),
+                              {"llm": (50, 100), "tts": (100, 200), "device": (20, 40)})
+# Calls in flight per stage; as many again may queue for a slot before new ones are shed
+STAGE_CONCURRENCY = _parse_limits(os.environ.get("STAGE_CONCURRENCY", ""), {"llm": 64, "tts": 64, "device": 8})
+# Voice turns whose upstream calls can't start within this long of the final transcript are shed
+TURN_DEADLINE_SECONDS = float(os.environ.get("TURN_DEADLINE_SECONDS", 8))
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", 2))
+# Concurrent /transcribe-ws sessions per process
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 500))
+# Token buckets kept for this many distinct API keys (least recently used dropped)
+MAX_KEY_BUCKETS = 4096
+
+
+class Overloaded(Exception):
+    """A call was shed by admission control; `retry_after` is a hint in seconds."""
+
+    def __init__(self, stage: str, reason: str, retry_after: float):
+        super().__init__(f"{stage} overloaded ({reason})")
+        self.stage = stage
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def as_message(self, turn: int | None = None) -> dict:
+        """The `overloaded` message sent to voice clients."""
+        return {"type": "overloaded", "stage": self.stage, "reason": self.reason,
+                "retry_after_ms": round(self.retry_after * 1000), "turn": turn}
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `burst`; not thread-safe (RateLimiter holds its lock)."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is now)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Per-key and per-upstream token buckets for each stage."""
+
+    def __init__(self, key_rates: dict = KEY_RATES, upstream_rates: dict = UPSTREAM_RATES):
+        self.key_rates = key_rates
+        self._upstream = {stage: TokenBucket(*rate) for stage, rate in upstream_rates.items()}
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key_bucket(self, stage: str, key: str) -> TokenBucket | None:
+        rate = self.key_rates.get(stage)
+        if rate is None:
+            return None
+        bucket = self._keys.get((stage, key))
+        if bucket is None:
+            bucket = self._keys[(stage, key)] = TokenBucket(*rate)
+            if len(self._keys) > MAX_KEY_BUCKETS:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end((stage, key))
+        return bucket
+
+    def try_take(self, stage: str, key: str) -> tuple[float, str | None]:
+        """Take a token from both buckets, or return (seconds to wait, which bucket is empty)."""
+        now = time.monotonic()
+        with self._lock:
+            buckets = [(b, name) for b, name in ((self._key_bucket(stage, key), "key_rate"),
+                                                 (self._upstream.get(stage), "upstream_rate")) if b is not None]
+            waits = [(b.wait_time(now), name) for b, name in buckets]
+            wait, reason = max(waits, default=(0.0, None))
+            if wait == 0:
+                for bucket, _name in buckets:
+                    bucket.tokens -= 1
+                return 0.0, None
+        return wait, reason
+
+
+class _Waiter:
+    """A queued caller: a thread (Event) or an asyncio task (future on its loop)."""
+
+    __slots__ = ("event", "future", "loop", "granted")
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+        self.granted = False
+
+    def grant(self):
+        # Caller holds the stage lock
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Stage:
+    """Bounded concurrency for one stage, with a bounded FIFO of callers waiting for a slot."""
+
+    def __init__(self, name: str, limit: int, max_waiting: int | None = None):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = limit if max_waiting is None else max_waiting
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self.stats = {"admitted": 0, "queued": 0, "shed_capacity": 0, "shed_queue_full": 0, "shed_deadline": 0,
+                      "shed_key_rate": 0, "shed_upstream_rate": 0}
+
+    def _enter(self, loop=None) -> _Waiter | None:
+        """Take a slot (None) or join the queue (the waiter); raises Overloaded when the queue is full."""
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                self.stats["admitted"] += 1
+                return None
+            if len(self._waiters) >= self.max_waiting:
+                reason = "queue_full" if self.max_waiting else "capacity"
+                self.stats[f"shed_{reason}"] += 1
+                raise Overloaded(self.name, reason, 1.0)
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            self.stats["queued"] += 1
+            return waiter
+
+    def _give_up(self, waiter: _Waiter) -> bool:
+        """Leave the queue; True if a slot was handed over in the meantime (the caller now owns it)."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def _shed(self, reason: str, retry_after: float):
+        with self._lock:
+            self.stats[f"shed_{reason}"] += 1
+        raise Overloaded(self.name, reason, retry_after)
+
+    def acquire(self, timeout: float):
+        waiter = self._enter()
+        if waiter is None:
+            return
+        if waiter.event.wait(max(0.0, timeout)) or self._give_up(waiter):
+            return
+        self._shed("deadline", 1.0)
+
+    async def acquire_async(self, timeout: float):
+        waiter = self._enter(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(0.0, timeout))
+            return
+        except asyncio.TimeoutError:
+            if self._give_up(waiter):
+                return
+        except asyncio.CancelledError:
+            # Barge-in while queued: don't leak a slot that was handed over meanwhile
+            if self._give_up(waiter):
+                self.release()
+            raise
+        self._shed("deadline", 1.0)
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes straight to the next caller in line
+                self._waiters.popleft().grant()
+                self.stats["admitted"] += 1
+            else:
+                self.active -= 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"active": self.active, "waiting": len(self._waiters), "limit": self.limit, **self.stats}
+
+
+class Ticket:
+    """An admitted call; release() (or leaving the `with` block) frees its stage slot."""
+
+    __slots__ = ("stage", "_released")
+
+    def __init__(self, stage: Stage):
+        self.stage = stage
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.stage.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class Admission:
+    def __init__(self, concurrency: dict = STAGE_CONCURRENCY, limiter: RateLimiter | None = None):
+        self.stages = {name: Stage(name, limit) for name, limit in concurrency.items()}
+        self.limiter = limiter or RateLimiter()
+        self.sessions = Stage("sessions", MAX_SESSIONS, max_waiting=0)
+
+    def _deadline(self, max_wait: float | None) -> float:
+        now = time.monotonic()
+        if max_wait is not None:
+            return now + max_wait
+        trace = current_trace()
+        if trace is not None:
+            return trace.started_at + TURN_DEADLINE_SECONDS
+        return now + ADMISSION_MAX_WAIT_SECONDS
+
+    def _rate_wait(self, stage: Stage, key: str, deadline: float) -> float:
+        """Seconds to sleep before trying the buckets again; sheds if the next token comes too late."""
+        wait, reason = self.limiter.try_take(stage.name, key)
+        if wait and time.monotonic() + wait > deadline:
+            stage._shed(reason, wait)
+        return wait
+
+    def admit(self, stage_name: str, key: str | None, max_wait: float | None = None) -> Ticket:
+        """Block until the call may go ahead; raises Overloaded if it can't by its deadline."""
+        stage = self.stages[stage_name]
+        started = time.monotonic()
+        deadline = self._deadline(max_wait)
+        while wait := self._rate_wait(stage, key or "", deadline):
+            time.sleep(wait)
+        stage.acquire(deadline - time.monotonic())
+        record_latency(f"admission_{stage_name}", (time.monotonic() - started) * 1000)
+        return Ticket(stage)
+
+    async def admit_async(self, stage_name: str, key: str | None, max_wait: float | None = None) -> Ticket:
+        stage = self.stages[stage_name]
+        started = time.monotonic()
+        deadline = self._deadline(max_wait)
+        while wait := self._rate_wait(stage, key or "", deadline):
+            await asyncio.sleep(wait)
+        await stage.acquire_async(deadline - time.monotonic())
+        record_latency(f"admission_{stage_name}", (time.monotonic() - started) * 1000)
+        return Ticket(stage)
+
+    def open_session(self) -> Ticket:
+        """Admit a new voice session, or raise Overloaded when MAX_SESSIONS are already open."""
+        self.sessions.acquire(0)
+        return Ticket(self.sessions)
+
+    def stats(self) -> dict:
+        stats = {name: stage.snapshot() for name, stage in self.stages.items()}
+        stats["sessions"] = self.sessions.snapshot()
+        return stats
+
+
+admission = Admission()
+register_stats_provider("admission", admission.stats)
+
+
+def held_until_done(chunks, ticket: Ticket):
+    """Iterate `chunks`, keeping the ticket's slot until they are exhausted or closed."""
+    try:
+        yield from chunks
+    finally:
+        ticket.release()
+
+
+async def held_until_done_async(chunks, ticket: Ticket):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        ticket.release()
@@ -0,0 +1,28 @@
+import struct
+
+# Binary audio frame sent over the voice WebSocket (big-endian):
+#   version u8 | flags u8 | turn u32 | seq u32 | mime_len u8 | mime (ascii) | audio payload
+# `seq` numbers the clips of a turn (one per spoken sentence); a clip may span several
+# frames and its last frame carries FLAG_FIN.
+FRAME_VERSION = 1
+FLAG_FIN = 0x01
+HEADER = struct.Struct(">BBIIB")
+
+
+def pack_audio_frame(turn: int, seq: int, mime: str, payload: bytes, fin: bool = False) -> bytes:
+    mime_bytes = mime.encode("ascii")
+    header = HEADER.pack(FRAME_VERSION, FLAG_FIN if fin else 0, turn, seq, len(mime_bytes))
+    return header + mime_bytes + payload
+
+
+def unpack_audio_frame(frame: bytes) -> dict:
+    version, flags, turn, seq, mime_len = HEADER.unpack_from(frame)
+    start = HEADER.size + mime_len
+    return {
+        "version": version,
+        "fin": bool(flags & FLAG_FIN),
+        "turn": turn,
+        "seq": seq,
+        "mime": frame[HEADER.size:start].decode("ascii"),
+        "payload": frame[start:],
+    }
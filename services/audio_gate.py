@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+from services.metrics_service import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+# Inbound audio from the browser: 16 kHz mono PCM16 little-endian, ~256 ms per WebSocket message
+SAMPLE_RATE = 16000
+# Energy is measured over 20 ms frames
+FRAME_MS = 20
+# A frame is speech when it is this far above the adaptive noise floor...
+SPEECH_MARGIN_DB = 10.0
+# ...and above this absolute level (dBFS), so a silent room doesn't make noise look like speech
+MIN_SPEECH_DBFS = -50.0
+# Speech must last this long to open the gate (ignores clicks and pops)
+MIN_SPEECH_MS = 60
+# Audio kept from before speech opens the gate, so word onsets aren't clipped
+PREROLL_MS = 300
+# Silence after speech that ends the utterance locally; the gate closes and the STT
+# session is asked to finalise the turn instead of waiting out its own silence timeout
+END_OF_SPEECH_MS = int(os.environ.get("VAD_END_OF_SPEECH_MS", 800))
+# While closed, a short chunk of digital silence is sent this often so the STT session
+# doesn't sit idle; the silence in between is dropped (compressed to this one chunk)
+KEEPALIVE_MS = 5000
+KEEPALIVE_CHUNK_MS = 50
+
+_totals = {"sessions": 0, "speech_ms": 0.0, "silence_ms": 0.0, "bytes_in": 0, "bytes_out": 0, "local_endpoints": 0}
+_totals_lock = threading.Lock()
+
+
+class AudioGate:
+    """
+    Voice activity gate between the browser's audio stream and the STT client.
+
+    Each inbound chunk is split into 20 ms frames and their energies computed in one
+    NumPy pass. Speech opens the gate (with pre-roll), trailing silence keeps it open for
+    END_OF_SPEECH_MS, after which the gate closes and reports end of speech. While closed,
+    audio is dropped except for a periodic keepalive chunk.
+    """
+
+    def __init__(self, sample_rate: int = SAMPLE_RATE, end_of_speech_ms: int = END_OF_SPEECH_MS):
+        self.sample_rate = sample_rate
+        self.frame_samples = sample_rate * FRAME_MS // 1000
+        self.end_of_speech_ms = end_of_speech_ms
+        self.noise_floor_db = -60.0
+        self.in_speech = False
+        # Monotonic time the most recent speech frame ended (for STT finalisation timing)
+        self.last_speech_at = None
+        self._silence_ms = 0.0
+        self._since_forward_ms = 0.0
+        self._preroll = deque()  # (chunk, ms) of the most recent dropped audio
+        self._preroll_ms = 0.0
+        self._remainder = b""
+        self._keepalive = b"\0" * (2 * sample_rate * KEEPALIVE_CHUNK_MS // 1000)
+        self.stats = {"speech_ms": 0.0, "silence_ms": 0.0, "bytes_in": 0, "bytes_out": 0, "local_endpoints": 0}
+        with _totals_lock:
+            _totals["sessions"] += 1
+
+    def _frame_levels(self, data: bytes) -> np.ndarray:
+        """dBFS of each whole 20 ms frame in `data` (a partial frame is carried to the next chunk)."""
+        data = self._remainder + data
+        usable = len(data) // (2 * self.frame_samples) * 2 * self.frame_samples
+        self._remainder = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype="<i2").astype(np.float32)
+        frames = samples.reshape(-1, self.frame_samples)
+        power = np.mean(frames * frames, axis=1) / (32768.0 * 32768.0)
+        return 10.0 * np.log10(power + 1e-12)
+
+    def process(self, data: bytes) -> tuple[list[bytes], bool]:
+        """Gate one inbound chunk. Returns (chunks to forward upstream, end of speech detected)."""
+        chunk_ms = len(data) / 2 / self.sample_rate * 1000
+        self.stats["bytes_in"] += len(data)
+        levels = self._frame_levels(data)
+        threshold = max(self.noise_floor_db + SPEECH_MARGIN_DB, MIN_SPEECH_DBFS)
+        is_speech = levels > threshold
+        speech_frames = int(np.count_nonzero(is_speech))
+        quiet = levels[~is_speech]
+        if quiet.size:
+            # Track the non-speech frames: down quickly, up more slowly
+            level = float(np.median(quiet))
+            rate = 0.5 if level < self.noise_floor_db else 0.1
+            self.noise_floor_db += rate * (level - self.noise_floor_db)
+        elif levels.size:
+            # Nothing below threshold: creep up so steady loud noise is eventually learned as the floor
+            self.noise_floor_db += 0.01 * (float(np.percentile(levels, 10)) - self.noise_floor_db)
+        speech_ms = speech_frames * FRAME_MS
+        self.stats["speech_ms"] += speech_ms
+        self.stats["silence_ms"] += max(0.0, chunk_ms - speech_ms)
+
+        out = []
+        end_of_speech = False
+        if speech_frames and (self.in_speech or speech_ms >= MIN_SPEECH_MS):
+            if not self.in_speech:
+                self.in_speech = True
+                out.extend(chunk for chunk, _ms in self._preroll)
+                self._preroll.clear()
+                self._preroll_ms = 0.0
+            last_speech = int(np.flatnonzero(is_speech)[-1])
+            self._silence_ms = (len(levels) - 1 - last_speech) * FRAME_MS
+            self.last_speech_at = time.monotonic() - self._silence_ms / 1000
+            out.append(data)
+        elif self.in_speech:
+            self._silence_ms += chunk_ms
+            # Trailing silence still goes upstream so the STT can finish the words
+            out.append(data)
+            if self._silence_ms >= self.end_of_speech_ms:
+                self.in_speech = False
+                end_of_speech = True
+                self.stats["local_endpoints"] += 1
+        else:
+            self._preroll.append((data, chunk_ms))
+            self._preroll_ms += chunk_ms
+            while self._preroll_ms - self._preroll[0][1] >= PREROLL_MS:
+                self._preroll_ms -= self._preroll.popleft()[1]
+            if self._since_forward_ms + chunk_ms >= KEEPALIVE_MS:
+                out.append(self._keepalive)
+
+        self._since_forward_ms = 0.0 if out else self._since_forward_ms + chunk_ms
+        self.stats["bytes_out"] += sum(len(c) for c in out)
+        return out, end_of_speech
+
+    def speech_ratio(self) -> float | None:
+        total = self.stats["speech_ms"] + self.stats["silence_ms"]
+        return round(self.stats["speech_ms"] / total, 3) if total else None
+
+    def summary(self) -> dict:
+        stats = {k: round(v) if isinstance(v, float) else v for k, v in self.stats.items()}
+        stats["speech_ratio"] = self.speech_ratio()
+        stats["upstream_ratio"] = round(self.stats["bytes_out"] / self.stats["bytes_in"], 3) if self.stats["bytes_in"] else None
+        return stats
+
+    def close(self):
+        """Fold this session's counters into the process totals and log them."""
+        with _totals_lock:
+            for key, value in self.stats.items():
+                _totals[key] += value
+        logger.info(f"Session audio: {self.summary()}")
+
+
+def relay_audio(gate: AudioGate | None, client, data: bytes):
+    """Forward one inbound audio chunk to the STT transcriber through the gate (if any)."""
+    if gate is None or not isinstance(data, bytes):
+        client.stream(data)
+        return
+    chunks, end_of_speech = gate.process(data)
+    for chunk in chunks:
+        client.stream(chunk)
+    if end_of_speech and hasattr(client, "force_endpoint"):
+        client.force_endpoint()
+
+
+def audio_gate_stats() -> dict:
+    with _totals_lock:
+        stats = {k: round(v) if isinstance(v, float) else v for k, v in _totals.items()}
+    total = stats["speech_ms"] + stats["silence_ms"]
+    stats["speech_ratio"] = round(stats["speech_ms"] / total, 3) if total else None
+    stats["upstream_ratio"] = round(stats["bytes_out"] / stats["bytes_in"], 3) if stats["bytes_in"] else None
+    return stats
+
+
+register_stats_provider("audio_gate", audio_gate_stats)
@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from services.metrics_service import record_latency, register_stats_provider
+from services.stt_service import transcribe_file
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Server-side recordings that jobs may reference by path (nothing outside it is readable)
+UPLOADS_DIR = os.path.join(BASE_DIR, "uploads")
+# Uploaded files are stored here under their content hash
+BATCH_DIR = os.environ.get("STT_BATCH_DIR", os.path.join(UPLOADS_DIR, "batch"))
+# Largest recording accepted per upload; bigger bodies are rejected while they stream in
+MAX_UPLOAD_BYTES = int(os.environ.get("STT_BATCH_MAX_UPLOAD_MB", 200)) * 1024 * 1024
+# Disk budget for stored uploads; the least recently uploaded are removed past it
+MAX_DISK_BYTES = int(os.environ.get("STT_BATCH_MAX_DISK_MB", 2048)) * 1024 * 1024
+# Concurrent AssemblyAI transcriptions; each holds a thread while it uploads and polls
+BATCH_WORKERS = int(os.environ.get("STT_BATCH_WORKERS", 4))
+# Finished jobs kept for polling; the oldest are forgotten past this many
+MAX_JOBS = 200
+# Transcripts remembered by content hash, so resubmitted recordings aren't transcribed again
+MAX_RESULTS = 2048
+HASH_CHUNK_BYTES = 1024 * 1024
+AUDIO_EXTENSIONS = {".wav", ".mp3", ".m4a", ".ogg", ".oga", ".opus", ".webm", ".flac", ".aac", ".mp4", ".mov", ".amr"}
+TERMINAL = ("done", "failed")
+
+_stats = {"jobs": 0, "files": 0, "transcribed": 0, "failed": 0, "deduplicated": 0, "bytes_uploaded": 0,
+          "trimmed": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def hash_file(path: str) -> str:
+    """sha256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class JobError(ValueError):
+    """A request the batch API rejects (bad path, unknown job, missing key, upload too large)."""
+
+
+def _check_size(name: str, size: int):
+    if size > MAX_UPLOAD_BYTES:
+        raise JobError(f"{name}: larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+
+
+class TranscriptionJob:
+    """
+    A set of recordings transcribed together. Files can be added until the job is
+    forgotten; `events` lists finished file indexes in completion order, so callers can
+    stream results as they arrive.
+    """
+
+    def __init__(self, api_key: str):
+        self.id = uuid.uuid4().hex
+        self.api_key = api_key
+        self.created_at = time.time()
+        self.files = []
+        self.events = []
+        self._cond = threading.Condition()
+
+    def add(self, name: str, sha256: str) -> int:
+        with self._cond:
+            self.files.append({"file": name, "sha256": sha256, "status": "queued"})
+            return len(self.files) - 1
+
+    def update(self, index: int, **fields):
+        with self._cond:
+            self.files[index].update(fields)
+            if fields.get("status") in TERMINAL:
+                self.events.append(index)
+            self._cond.notify_all()
+
+    @property
+    def status(self) -> str:
+        with self._cond:
+            if not self.files:
+                return "empty"
+            if len(self.events) < len(self.files):
+                return "running"
+            return "done"
+
+    def to_dict(self) -> dict:
+        with self._cond:
+            files = [dict(f) for f in self.files]
+        counts = {}
+        for f in files:
+            counts[f["status"]] = counts.get(f["status"], 0) + 1
+        return {"job_id": self.id, "status": self.status, "counts": counts, "files": files}
+
+    def wait(self, cursor: int, timeout: float) -> tuple[list[dict], int, bool]:
+        """Results finished after `cursor` (waiting up to `timeout` for one): (results, new cursor, job done)."""
+        with self._cond:
+            if cursor >= len(self.events) and len(self.events) < len(self.files):
+                self._cond.wait(timeout)
+            results = [dict(self.files[i]) for i in self.events[cursor:]]
+            done = bool(self.files) and len(self.events) == len(self.files)
+            return results, cursor + len(results), done
+
+
+class BatchTranscriber:
+    """
+    Bounded pool of AssemblyAI pre-recorded transcriptions shared by all batch jobs.
+
+    Recordings are identified by content hash: a file already transcribed (or in flight)
+    for the same API key is answered from that result instead of being uploaded again.
+    """
+
+    def __init__(self, workers: int = BATCH_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-stt")
+        self._jobs: OrderedDict[str, TranscriptionJob] = OrderedDict()
+        self._results: OrderedDict[tuple, Future] = OrderedDict()
+        self._lock = threading.Lock()
+        self.workers = workers
+
+    def create_job(self, api_key: str | None) -> TranscriptionJob:
+        # The caller's own key: the API is open, so the server's key is never spent on it
+        if not api_key:
+            raise JobError("An AssemblyAI API key is required")
+        job = TranscriptionJob(api_key)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > MAX_JOBS:
+                self._jobs.popitem(last=False)
+        _count("jobs")
+        return job
+
+    def get_job(self, job_id: str) -> TranscriptionJob:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise JobError(f"Unknown job {job_id}")
+        return job
+
+    def add_file(self, job: TranscriptionJob, name: str, path: str, sha256: str | None = None) -> int:
+        """Queue one recording on disk; identical content shares a single transcription."""
+        sha256 = sha256 or hash_file(path)
+        index = job.add(name, sha256)
+        _count("files")
+        key = (hashlib.sha256(job.api_key.encode()).hexdigest(), sha256)
+        with self._lock:
+            future = self._results.get(key)
+            deduplicated = future is not None
+            if deduplicated:
+                self._results.move_to_end(key)
+            else:
+                future = self._pool.submit(self._transcribe, path, job.api_key)
+                self._results[key] = future
+                while len(self._results) > MAX_RESULTS:
+                    self._results.popitem(last=False)
+        if deduplicated:
+            _count("deduplicated")
+            job.update(index, deduplicated=True)
+        # Runs immediately when the transcript is already known
+        future.add_done_callback(lambda f: self._finish(job, index, key, f))
+        return index
+
+    def add_paths(self, job: TranscriptionJob, paths: list[str]) -> list[int]:
+        """
+        Queue server-side recordings, given relative to uploads/; a directory adds every
+        recording in it. Other clients' uploads (BATCH_DIR) are not reachable this way.
+        """
+        root = os.path.realpath(UPLOADS_DIR)
+        batch_dir = os.path.realpath(BATCH_DIR)
+        # Every path is checked before anything is queued
+        found = []
+        for rel in paths:
+            path = os.path.realpath(os.path.join(root, rel))
+            if path != root and not path.startswith(root + os.sep):
+                raise JobError(f"{rel}: only files under uploads/ can be transcribed")
+            if path == batch_dir or path.startswith(batch_dir + os.sep):
+                raise JobError(f"{rel}: uploaded recordings can't be referenced by path")
+            if os.path.isdir(path):
+                found += sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS
+                                and os.path.isfile(os.path.join(path, name)))
+            elif os.path.isfile(path):
+                found.append(path)
+            else:
+                raise JobError(f"{rel}: no such file")
+        return [self.add_file(job, os.path.relpath(path, root), path) for path in found]
+
+    def _store_path(self, name: str, sha256: str) -> str:
+        ext = os.path.splitext(name)[1].lower()
+        return os.path.join(BATCH_DIR, sha256 + (ext if ext in AUDIO_EXTENSIONS else ".bin"))
+
+    def save_upload(self, job: TranscriptionJob, name: str, chunks) -> int:
+        """Write an uploaded recording to disk chunk by chunk (hashing as it goes) and queue it."""
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        digest = hashlib.sha256()
+        tmp = os.path.join(BATCH_DIR, f".{uuid.uuid4().hex}.part")
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    _check_size(name, size)
+                    digest.update(chunk)
+                    f.write(chunk)
+            return self._store_upload(job, name, tmp, digest.hexdigest(), size)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    async def save_upload_async(self, job: TranscriptionJob, name: str, chunks) -> int:
+        """save_upload for an async iterator of chunks (e.g. Starlette's request.stream())."""
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        digest = hashlib.sha256()
+        tmp = os.path.join(BATCH_DIR, f".{uuid.uuid4().hex}.part")
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    _check_size(name, size)
+                    digest.update(chunk)
+                    # Buffered writes of request-sized chunks; the page cache absorbs them
+                    f.write(chunk)
+            return await asyncio.to_thread(self._store_upload, job, name, tmp, digest.hexdigest(), size)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _store_upload(self, job: TranscriptionJob, name: str, tmp: str, sha256: str, size: int) -> int:
+        if not size:
+            raise JobError(f"{name}: empty upload")
+        path = self._store_path(name, sha256)
+        if os.path.exists(path):
+            os.utime(path)  # recently uploaded again, so trimmed last
+        else:
+            os.replace(tmp, path)
+        _count("bytes_uploaded", size)
+        index = self.add_file(job, name, path, sha256)
+        self._trim_disk()
+        return index
+
+    def _trim_disk(self):
+        """Remove the least recently uploaded recordings past MAX_DISK_BYTES, except those still being transcribed."""
+        with self._lock:
+            pending = {sha256 for (_key, sha256), future in self._results.items() if not future.done()}
+        try:
+            names = [name for name in os.listdir(BATCH_DIR) if not name.startswith(".")]
+        except OSError:
+            return
+        files = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(BATCH_DIR, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= MAX_DISK_BYTES:
+                break
+            if name.split(".", 1)[0] in pending:
+                continue
+            try:
+                os.remove(os.path.join(BATCH_DIR, name))
+            except OSError:
+                continue
+            total -= size
+            _count("trimmed")
+
+    def _transcribe(self, path: str, api_key: str) -> str:
+        # The SDK streams the file from disk to AssemblyAI's upload endpoint
+        started = time.monotonic()
+        text = transcribe_file(path, api_key)
+        record_latency("batch_transcription", (time.monotonic() - started) * 1000)
+        return text
+
+    def _finish(self, job: TranscriptionJob, index: int, key: tuple, future: Future):
+        try:
+            text = future.result()
+        except Exception as e:
+            logger.warning(f"Batch transcription of {job.files[index]['file']} failed: {e}")
+            # Failures aren't remembered, so the file can be retried
+            with self._lock:
+                if self._results.get(key) is future:
+                    del self._results[key]
+            _count("failed")
+            job.update(index, status="failed", error=str(e))
+            return
+        _count("transcribed")
+        job.update(index, status="done", text=text)
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+            pending = sum(1 for f in self._results.values() if not f.done())
+        with _stats_lock:
+            stats = dict(_stats)
+        stats.update(workers=self.workers, jobs_kept=len(jobs), pending=pending)
+        return stats
+
+
+batch_transcriber = BatchTranscriber()
+register_stats_provider("batch_stt", batch_transcriber.stats)
+
+
+def job_events(job: TranscriptionJob, poll_seconds: float = 15.0):
+    """NDJSON lines: one per finished file as it completes, then the job summary."""
+    cursor = 0
+    while True:
+        results, cursor, done = job.wait(cursor, poll_seconds)
+        for result in results:
+            yield json.dumps(result) + "\n"
+        if done:
+            break
+        if not results:
+            # Keeps proxies from closing an idle stream
+            yield "\n"
+    summary = job.to_dict()
+    summary.pop("files")
+    yield json.dumps(summary) + "\n"
+
+
+async def job_events_async(job: TranscriptionJob, poll_seconds: float = 15.0):
+    """Async counterpart of job_events; the blocking wait runs on a worker thread."""
+    cursor = 0
+    while True:
+        results, cursor, done = await asyncio.to_thread(job.wait, cursor, poll_seconds)
+        for result in results:
+            yield json.dumps(result) + "\n"
+        if done:
+            break
+        if not results:
+            yield "\n"
+    summary = job.to_dict()
+    summary.pop("files")
+    yield json.dumps(summary) + "\n"
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from services.metrics_service import register_stats_provider
+from services.service_registry import service_registry
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) seconds for outbound HTTP calls that don't pass their own timeout
+DEFAULT_TIMEOUT = (3.05, 20)
+# Keep-alive connections kept per host; Murf is hit once or more per spoken sentence
+HOST_POOL_SIZES = {
+    "https://api.murf.ai": 16,
+    "https://html.duckduckgo.com": 8,
+}
+DEFAULT_POOL_SIZE = 10
+# Bounded retry with exponential backoff (0.3s, 0.6s) on throttling and transient upstream errors
+RETRY = Retry(
+    total=2,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None,
+    raise_on_status=False,
+)
+# Gemini clients are cached per API key; oldest keys are dropped past this many
+MAX_GEMINI_CLIENTS = 64
+MAX_ASSEMBLYAI_CLIENTS = 16
+MAX_OPENAI_CLIENTS = 16
+# Image generations take tens of seconds
+OPENAI_TIMEOUT_SECONDS = 120
+# Overrides the Gemini API endpoint, e.g. to point at a local stand-in (see benchmarks/fake_upstreams.py)
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+# AssemblyAI REST (pre-recorded transcription) endpoint and how often a transcript's status is polled
+ASSEMBLYAI_BASE_URL = os.environ.get("ASSEMBLYAI_BASE_URL", "https://api.assemblyai.com")
+ASSEMBLYAI_POLL_SECONDS = float(os.environ.get("ASSEMBLYAI_POLL_SECONDS", 3.0))
+
+_counters = {
+    "http_requests": 0,
+    "http_connections_opened": 0,
+    "async_http_requests": 0,
+    "async_http_retries": 0,
+    "gemini_clients_created": 0,
+    "gemini_client_reuses": 0,
+    "assemblyai_clients_created": 0,
+    "openai_clients_created": 0,
+}
+_counters_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1):
+    with _counters_lock:
+        _counters[name] += n
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count("http_connections_opened")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count("http_connections_opened")
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout and connection-reuse counters."""
+
+    def __init__(self, pool_maxsize: int = DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        super().__init__(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=RETRY)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        _count("http_requests")
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def _build_http_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", PooledAdapter())
+    session.mount("http://", PooledAdapter())
+    for prefix, size in HOST_POOL_SIZES.items():
+        session.mount(prefix, PooledAdapter(pool_maxsize=size))
+    return session
+
+
+_http_session = None
+_http_lock = threading.Lock()
+_gemini_clients = OrderedDict()
+_gemini_lock = threading.Lock()
+_assemblyai_clients = OrderedDict()
+_assemblyai_lock = threading.Lock()
+_openai_clients = OrderedDict()
+_openai_lock = threading.Lock()
+# Released with their loop: closed by close_async_http_client(), or dropped once the loop is gone
+_async_http = weakref.WeakKeyDictionary()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Process-wide keep-alive HTTP session for all outbound REST calls.
+    API keys travel in per-request headers, so one pool serves every user.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_lock:
+            if _http_session is None:
+                _http_session = _build_http_session()
+    return _http_session
+
+
+def get_async_http_client():
+    """
+    Keep-alive httpx.AsyncClient for the asyncio runtime, one per event loop, with the
+    same per-host pool sizes and timeouts as the blocking session.
+    """
+    import httpx
+    loop = asyncio.get_running_loop()
+    client = _async_http.get(loop)
+    if client is None:
+        connect, read = DEFAULT_TIMEOUT
+        def transport(size):
+            return httpx.AsyncHTTPTransport(retries=RETRY.total, limits=httpx.Limits(max_connections=size * 4, max_keepalive_connections=size))
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            transport=transport(DEFAULT_POOL_SIZE),
+            mounts={prefix: transport(size) for prefix, size in HOST_POOL_SIZES.items()},
+            follow_redirects=True,
+        )
+        _async_http[loop] = client
+    return client
+
+
+async def close_async_http_client():
+    """Close the running loop's client (call before the loop shuts down, e.g. from the ASGI lifespan)."""
+    client = _async_http.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def async_request(method: str, url: str, stream: bool = False, **kwargs):
+    """
+    Request on the shared async client with the same bounded retry/backoff policy as
+    the blocking session (httpx's transport only retries failed connects). With
+    stream=True the body is left unread; the caller must aclose() the response.
+    """
+    client = get_async_http_client()
+    for attempt in range(RETRY.total + 1):
+        _count("async_http_requests")
+        res = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+        if res.status_code not in RETRY.status_forcelist or attempt == RETRY.total:
+            return res
+        _count("async_http_retries")
+        await res.aclose()
+        await asyncio.sleep(RETRY.backoff_factor * (2 ** attempt))
+    return res
+
+
+def get_gemini_client(api_key: str):
+    """
+    Return the cached google-genai client for this API key, creating it on first use.
+    Async callers use its `.aio` interface, which shares the same configuration.
+    """
+    with _gemini_lock:
+        client = _gemini_clients.get(api_key)
+        if client is not None:
+            _gemini_clients.move_to_end(api_key)
+            _count("gemini_client_reuses")
+            return client
+    genai = service_registry.get("gemini")
+    client = genai.Client(
+        api_key=api_key,
+        http_options=genai.types.HttpOptions(
+            base_url=GEMINI_BASE_URL,
+            timeout=30_000,
+            retry_options=genai.types.HttpRetryOptions(attempts=3, initial_delay=0.3, http_status_codes=[429, 500, 502, 503, 504]),
+        ),
+    )
+    with _gemini_lock:
+        existing = _gemini_clients.get(api_key)
+        if existing is not None:
+            _count("gemini_client_reuses")
+            return existing
+        _gemini_clients[api_key] = client
+        _count("gemini_clients_created")
+        while len(_gemini_clients) > MAX_GEMINI_CLIENTS:
+            _gemini_clients.popitem(last=False)
+    return client
+
+
+def get_assemblyai_client(api_key: str):
+    """
+    Cached AssemblyAI REST client for this API key. Credentials travel with the client
+    instead of the SDK's process-wide `aai.settings`, so concurrent calls can't mix keys.
+    """
+    aai = service_registry.get("assemblyai")
+    with _assemblyai_lock:
+        client = _assemblyai_clients.get(api_key)
+        if client is not None:
+            _assemblyai_clients.move_to_end(api_key)
+            return client
+        client = aai.Client(settings=aai.Settings(api_key=api_key, base_url=ASSEMBLYAI_BASE_URL,
+                                                  polling_interval=ASSEMBLYAI_POLL_SECONDS))
+        _assemblyai_clients[api_key] = client
+        _count("assemblyai_clients_created")
+        while len(_assemblyai_clients) > MAX_ASSEMBLYAI_CLIENTS:
+            _assemblyai_clients.popitem(last=False)
+    return client
+
+
+def get_openai_client(api_key: str):
+    """Cached OpenAI client for this API key; OPENAI_BASE_URL (read by the SDK) can point it at a stand-in."""
+    openai = service_registry.get("openai")
+    with _openai_lock:
+        client = _openai_clients.get(api_key)
+        if client is not None:
+            _openai_clients.move_to_end(api_key)
+            return client
+        client = openai.OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=RETRY.total)
+        _openai_clients[api_key] = client
+        _count("openai_clients_created")
+        while len(_openai_clients) > MAX_OPENAI_CLIENTS:
+            _openai_clients.popitem(last=False)
+    return client
+
+
+def client_stats() -> dict:
+    """Connection reuse counters; http_connection_reuse is the share of requests served on a kept-alive socket."""
+    with _counters_lock:
+        stats = dict(_counters)
+    requests_made = stats["http_requests"]
+    opened = stats["http_connections_opened"]
+    stats["http_connection_reuse"] = round(1 - opened / requests_made, 3) if requests_made else None
+    stats["gemini_clients_cached"] = len(_gemini_clients)
+    return stats
+
+
+register_stats_provider("clients", client_stats)
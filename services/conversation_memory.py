@@ -0,0 +1,162 @@
+import copy
+import os
+import re
+from collections import deque
+
+# Prompt budget for one session's history (persona and summary included). Tokens are
+# estimated at ~4 characters each, which is close enough for Gemini's tokenizer to keep
+# prompt size flat without a tokenizer round-trip per turn.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 2000))
+# Share of the budget the rolling summary of evicted turns may use
+SUMMARY_SHARE = 0.25
+# When over budget, evict down to this fraction so eviction (and the prompt rebuild it
+# forces) happens once every few turns rather than on every turn
+EVICT_TO = 0.75
+SUMMARY_SNIPPET_CHARS = 160
+
+_FIRST_SENTENCE = re.compile(r"^(.+?[.!?])(\s|$)", re.DOTALL)
+# Gemini's role names for the two sides of the conversation
+_GEMINI_ROLES = {"user": "user", "assistant": "model"}
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, (len(text) + 3) // 4)
+
+
+def _snippet(content: str) -> str:
+    match = _FIRST_SENTENCE.match(content.strip())
+    snippet = match.group(1) if match else content.strip()
+    if len(snippet) > SUMMARY_SNIPPET_CHARS:
+        snippet = snippet[:SUMMARY_SNIPPET_CHARS].rsplit(" ", 1)[0] + "..."
+    return snippet
+
+
+class ConversationMemory:
+    """
+    Chat history for one session, kept within a token budget.
+
+    The persona (system message) is pinned. Once the messages go over budget the oldest
+    exchanges are evicted and folded into a short extractive summary (first sentence of
+    each message) that rides along with the persona, itself capped at SUMMARY_SHARE of
+    the budget. Prompt renderings are cached and extended in place on append, so building
+    the prompt for a turn doesn't re-walk the whole history.
+    """
+
+    def __init__(self, persona: dict, token_budget: int = HISTORY_TOKEN_BUDGET):
+        self.persona = persona["content"]
+        self.token_budget = token_budget
+        self._messages = deque()   # (role, content, tokens)
+        self._tokens = 0
+        self._summary = deque()    # (line, tokens)
+        self._summary_tokens = 0
+        self._fixed_tokens = estimate_tokens(self.persona)
+        self.evicted = 0
+        # Bumped on every add, so work based on an earlier snapshot can tell it is stale
+        self.revision = 0
+        self._text = None
+        self._contents = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def tokens(self) -> int:
+        return self._fixed_tokens + self._summary_tokens + self._tokens
+
+    def add(self, role: str, content: str):
+        tokens = estimate_tokens(content)
+        self.revision += 1
+        self._messages.append((role, content, tokens))
+        self._tokens += tokens
+        if self.tokens > self.token_budget:
+            self._evict()
+            return
+        # Extend the cached renderings instead of rebuilding them
+        if self._text is not None:
+            self._text += f"\n{self._render(role, content)}"
+        if self._contents is not None:
+            self._contents.append(self._gemini_content(role, content))
+
+    def with_message(self, role: str, content: str) -> "ConversationMemory":
+        """A copy of this history with one more message added; this one is left untouched."""
+        other = copy.copy(self)
+        other._messages = deque(self._messages)
+        other._summary = deque(self._summary)
+        if self._contents is not None:
+            other._contents = list(self._contents)
+        other.add(role, content)
+        return other
+
+    def _evict(self):
+        target = int(self.token_budget * EVICT_TO)
+        # Always keep the newest message; evict whole exchanges so history starts with the user
+        while len(self._messages) > 1 and (self.tokens > target or self._messages[0][0] != "user"):
+            role, content, tokens = self._messages.popleft()
+            self._tokens -= tokens
+            self.evicted += 1
+            self._summarise(role, content)
+        self._text = None
+        self._contents = None
+
+    def _summarise(self, role: str, content: str):
+        line = f"- {'User' if role == 'user' else 'You'}: {_snippet(content)}"
+        tokens = estimate_tokens(line)
+        self._summary.append((line, tokens))
+        self._summary_tokens += tokens
+        while self._summary and self._summary_tokens > self.token_budget * SUMMARY_SHARE:
+            _line, old = self._summary.popleft()
+            self._summary_tokens -= old
+
+    @staticmethod
+    def _render(role: str, content: str) -> str:
+        return f"{'User' if role == 'user' else 'Assistant'}: {content}"
+
+    @staticmethod
+    def _gemini_content(role: str, content: str) -> dict:
+        return {"role": _GEMINI_ROLES.get(role, "user"), "parts": [{"text": content}]}
+
+    def system_instruction(self) -> str:
+        """Persona plus the summary of evicted turns."""
+        if not self._summary:
+            return self.persona
+        return self.persona + "\n\nEarlier in this conversation:\n" + "\n".join(line for line, _ in self._summary)
+
+    def as_text(self) -> str:
+        """Role-labelled plain-text prompt (persona, summary, then the recent messages)."""
+        if self._text is None:
+            lines = [self.system_instruction()]
+            lines.extend(self._render(role, content) for role, content, _ in self._messages)
+            self._text = "\n".join(lines)
+        return self._text
+
+    def gemini_contents(self) -> list:
+        """Recent messages as Gemini `contents` (the persona goes in the system instruction)."""
+        if self._contents is None:
+            self._contents = [self._gemini_content(role, content) for role, content, _ in self._messages]
+        return list(self._contents)
+
+    def to_state(self) -> dict:
+        """What has to be persisted to rebuild this history (token counts are recomputed)."""
+        return {"messages": [[role, content] for role, content, _ in self._messages],
+                "summary": [line for line, _ in self._summary], "evicted": self.evicted}
+
+    @classmethod
+    def from_state(cls, persona: dict, state: dict, token_budget: int = HISTORY_TOKEN_BUDGET) -> "ConversationMemory":
+        memory = cls(persona, token_budget)
+        for line in state.get("summary", ()):
+            tokens = estimate_tokens(line)
+            memory._summary.append((line, tokens))
+            memory._summary_tokens += tokens
+        for role, content in state.get("messages", ()):
+            tokens = estimate_tokens(content)
+            memory._messages.append((role, content, tokens))
+            memory._tokens += tokens
+        memory.evicted = state.get("evicted", 0)
+        # The budget may have shrunk since the state was saved
+        if memory.tokens > memory.token_budget:
+            memory._evict()
+        return memory
+
+    def stats(self) -> dict:
+        return {"messages": len(self._messages), "tokens": self.tokens, "evicted": self.evicted,
+                "summary_lines": len(self._summary)}
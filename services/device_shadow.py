@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from services.metrics_service import register_stats_provider
+from services.mqtt_service import (MQTT_BROKER, MQTT_PASS, MQTT_PORT, MQTT_USER, PUBLISH_TIMEOUT, MQTTPublisher,
+                                   add_close_handler, get_publisher)
+
+logger = logging.getLogger(__name__)
+
+# Devices report what they actually did on <command topic> + this suffix, retained (see esp32_mqtt_sample.ino)
+STATE_SUFFIX = "/state"
+# Publish commands retained (a rebooting device then replays the last one); off by default
+RETAIN_COMMANDS = os.environ.get("MQTT_RETAIN_COMMANDS", "0") == "1"
+# Commands that set a state: repeating one the device is already in is skipped. Others (e.g. "blink") always go out
+STATE_COMMANDS = {"on", "off"}
+# Known state older than this is not trusted to skip a publish
+SHADOW_TTL_SECONDS = float(os.environ.get("DEVICE_SHADOW_TTL_SECONDS", 300))
+# How long a state query on a device not seen before waits for its retained messages
+SHADOW_SYNC_SECONDS = 0.5
+# Most topics one bulk /control-device request may address
+MAX_BULK_TOPICS = 100
+# Most devices tracked (and subscribed to) per broker; the least recently used is dropped
+MAX_TRACKED_DEVICES = max(MAX_BULK_TOPICS, int(os.environ.get("DEVICE_SHADOW_MAX_DEVICES", 256)))
+# Longest command topic accepted (MQTT allows 65535 bytes; device topics are short)
+MAX_TOPIC_LENGTH = 256
+
+# Outcome of a command
+SENT, UNCHANGED, FAILED = "sent", "unchanged", "failed"
+
+_stats = {"commands": 0, "sent": 0, "unchanged": 0, "failed": 0, "queries": 0, "unknown": 0, "updates": 0,
+          "untracked": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def _normalise(payload) -> str:
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8", errors="replace")
+    return payload.strip().lower()
+
+
+def valid_topic(topic) -> bool:
+    """A concrete topic a command may be published to: no wildcards, no NUL, not empty or overlong."""
+    return (isinstance(topic, str) and 0 < len(topic.encode("utf-8")) <= MAX_TOPIC_LENGTH
+            and not any(c in topic for c in "+#\0"))
+
+
+class _Device:
+    __slots__ = ("desired", "reported", "reported_at", "epoch", "seen")
+
+    def __init__(self):
+        self.desired = None      # last command on the topic (ours, another controller's or a retained one)
+        self.reported = None     # last state the device published on the state topic
+        self.reported_at = 0.0
+        self.epoch = 0           # publisher connection the latest report arrived on
+        self.seen = threading.Event()  # set once the device has reported a state
+
+
+class DeviceShadow:
+    """
+    In-memory state of the devices on one broker, kept current by subscribing once per
+    device to its command topic and its state topic on the shared publisher connection.
+    States are only ever what a device reported itself; commands are tracked so that one
+    the device hasn't applied yet is known to be pending.
+
+    A state command is skipped when the device reported that state, no different command
+    is pending, and the report arrived on the current connection (a reconnect may have
+    missed updates, until the retained ones arrive again) within SHADOW_TTL_SECONDS.
+
+    At most MAX_TRACKED_DEVICES devices are tracked; the least recently used one is
+    unsubscribed and forgotten.
+    """
+
+    def __init__(self, publisher: MQTTPublisher):
+        self.publisher = publisher
+        self._devices = OrderedDict()   # command topic -> _Device, least recently used first
+        self._lock = threading.Lock()
+        publisher.add_message_handler(self._on_message)
+
+    def track(self, topic: str) -> _Device:
+        with self._lock:
+            device = self._devices.get(topic)
+            if device is not None:
+                self._devices.move_to_end(topic)
+                return device
+            device = self._devices[topic] = _Device()
+            evicted = []
+            while len(self._devices) > MAX_TRACKED_DEVICES:
+                evicted.append(self._devices.popitem(last=False)[0])
+        for old in evicted:
+            _count("untracked")
+            self.publisher.unsubscribe(old)
+            self.publisher.unsubscribe(old + STATE_SUFFIX)
+        self.publisher.subscribe(topic)
+        self.publisher.subscribe(topic + STATE_SUFFIX)
+        return device
+
+    def _on_message(self, topic: str, payload: bytes, retained: bool):
+        reported = topic.endswith(STATE_SUFFIX)
+        with self._lock:
+            device = self._devices.get(topic[:-len(STATE_SUFFIX)] if reported else topic)
+            if device is None:
+                return
+            # An empty retained message clears the topic; keep what we knew
+            if not payload:
+                return
+            if reported:
+                device.reported, device.reported_at = _normalise(payload), time.monotonic()
+                device.epoch = self.publisher.connection_epoch
+            else:
+                device.desired = _normalise(payload)
+        _count("updates")
+        if reported:
+            device.seen.set()
+
+    def state(self, topic: str, wait: float = 0.0) -> str | None:
+        """
+        Last state the device on `topic` reported, or None. `wait` bounds how long to wait
+        for its retained report when the device was not tracked before.
+        """
+        _count("queries")
+        if not valid_topic(topic):
+            _count("unknown")
+            return None
+        device = self.track(topic)
+        if wait and not device.seen.is_set():
+            device.seen.wait(wait)
+        with self._lock:
+            state = device.reported
+        if state is None:
+            _count("unknown")
+        return state
+
+    def _is_current(self, device: _Device, command: str) -> bool:
+        return (device.reported == command and device.desired in (None, command)
+                and device.epoch == self.publisher.connection_epoch and self.publisher.is_connected()
+                and time.monotonic() - device.reported_at <= SHADOW_TTL_SECONDS)
+
+    def command(self, topic: str, command: str) -> Future:
+        """Send `command` unless it is a no-op; the Future resolves to SENT, UNCHANGED or FAILED."""
+        _count("commands")
+        result = Future()
+        if not valid_topic(topic):
+            logger.warning(f"[device_shadow] Refusing command to invalid topic {topic!r}")
+            _count(FAILED)
+            result.set_result(FAILED)
+            return result
+        device = self.track(topic)
+        normalised = _normalise(command)
+        with self._lock:
+            unchanged = normalised in STATE_COMMANDS and self._is_current(device, normalised)
+        if unchanged:
+            _count(UNCHANGED)
+            result.set_result(UNCHANGED)
+            return result
+        with self._lock:
+            # Pending until the device reports it: nothing is skipped on the strength of this publish alone
+            device.desired = normalised
+
+        def acked(publish: Future):
+            ok = not publish.cancelled() and publish.exception() is None and publish.result()
+            _count(SENT if ok else FAILED)
+            result.set_result(SENT if ok else FAILED)
+
+        try:
+            publish = self.publisher.publish(topic, command, retain=RETAIN_COMMANDS)
+        except Exception as e:
+            logger.warning(f"[device_shadow] Publish to {topic} failed: {e}")
+            _count(FAILED)
+            result.set_result(FAILED)
+            return result
+        publish.add_done_callback(acked)
+        return result
+
+    def command_many(self, topics: list, command: str) -> dict:
+        """Fan `command` out to every topic over this one connection: {topic: Future}."""
+        return {topic: self.command(topic, command) for topic in dict.fromkeys(topics)}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"devices": len(self._devices),
+                    "devices_known": sum(1 for d in self._devices.values() if d.reported is not None)}
+
+
+_shadows = {}
+_shadows_lock = threading.Lock()
+
+
+def get_shadow(host: str = MQTT_BROKER, port: int = MQTT_PORT, user: str | None = MQTT_USER,
+               password: str | None = MQTT_PASS) -> DeviceShadow:
+    """Shadow of the devices on this broker, sharing its publisher connection."""
+    key = (host, int(port), user, password)
+    publisher = get_publisher(host, port, user, password)
+    with _shadows_lock:
+        shadow = _shadows.get(key)
+        if shadow is None or shadow.publisher is not publisher:
+            shadow = _shadows[key] = DeviceShadow(publisher)
+    return shadow
+
+
+def _drop_shadow(publisher: MQTTPublisher):
+    with _shadows_lock:
+        for key, shadow in list(_shadows.items()):
+            if shadow.publisher is publisher:
+                del _shadows[key]
+
+
+add_close_handler(_drop_shadow)
+
+
+def _outcome(future: Future, timeout: float) -> str:
+    try:
+        return future.result(timeout=timeout)
+    except Exception:
+        return FAILED
+
+
+def send_device_command(command: str, topic: str, broker: str = MQTT_BROKER, port: int = MQTT_PORT,
+                        user: str | None = MQTT_USER, password: str | None = MQTT_PASS,
+                        timeout: float = PUBLISH_TIMEOUT) -> str:
+    return _outcome(get_shadow(broker, port, user, password).command(topic, command), timeout)
+
+
+async def send_device_command_async(command: str, topic: str, broker: str = MQTT_BROKER, port: int = MQTT_PORT,
+                                    user: str | None = MQTT_USER, password: str | None = MQTT_PASS,
+                                    timeout: float = PUBLISH_TIMEOUT) -> str:
+    future = get_shadow(broker, port, user, password).command(topic, command)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except Exception:
+        return FAILED
+
+
+def send_device_commands(command: str, topics: list, broker: str = MQTT_BROKER, port: int = MQTT_PORT,
+                         user: str | None = MQTT_USER, password: str | None = MQTT_PASS,
+                         timeout: float = PUBLISH_TIMEOUT) -> dict:
+    """Bulk variant: {topic: outcome}, all publishes in flight at once and one deadline for all."""
+    futures = get_shadow(broker, port, user, password).command_many(topics, command)
+    deadline = time.monotonic() + timeout
+    return {topic: _outcome(future, max(0.0, deadline - time.monotonic())) for topic, future in futures.items()}
+
+
+async def send_device_commands_async(command: str, topics: list, broker: str = MQTT_BROKER, port: int = MQTT_PORT,
+                                     user: str | None = MQTT_USER, password: str | None = MQTT_PASS,
+                                     timeout: float = PUBLISH_TIMEOUT) -> dict:
+    futures = get_shadow(broker, port, user, password).command_many(topics, command)
+    if futures:
+        await asyncio.wait([asyncio.wrap_future(f) for f in futures.values()], timeout=timeout)
+    return {topic: future.result() if future.done() else FAILED for topic, future in futures.items()}
+
+
+def device_state(topic: str, broker: str = MQTT_BROKER, port: int = MQTT_PORT, user: str | None = MQTT_USER,
+                 password: str | None = MQTT_PASS, wait: float = SHADOW_SYNC_SECONDS) -> str | None:
+    return get_shadow(broker, port, user, password).state(topic, wait)
+
+
+def device_shadow_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    with _shadows_lock:
+        shadows = list(_shadows.values())
+    stats["devices"] = sum(s.stats()["devices"] for s in shadows)
+    stats["devices_known"] = sum(s.stats()["devices_known"] for s in shadows)
+    return stats
+
+
+register_stats_provider("device_shadow", device_shadow_stats)
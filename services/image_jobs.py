@@ -0,0 +1,274 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from services.admission import Overloaded
+from services.llm_service import generate_dalle_image
+from services.metrics_service import record_latency, register_stats_provider
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are skipped without Pillow; clients get the full image
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Generated images and their thumbnails, under their prompt key. A subdirectory, so the TTS cache's trim leaves it alone
+IMAGE_DIR = os.environ.get("IMAGE_DIR") or os.path.join(BASE_DIR, "static", "generated", "images")
+IMAGE_URL_PREFIX = "/static/generated/images/"
+# Concurrent generations; each holds a thread for the whole (tens of seconds) OpenAI call
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+# Generations queued behind the workers before new requests are shed
+MAX_QUEUED_JOBS = int(os.environ.get("IMAGE_MAX_QUEUED", 16))
+# Jobs kept for polling; the oldest are forgotten past this many
+MAX_JOBS = 200
+# Disk budget for images and thumbnails; least recently written prompts are removed past it
+MAX_DISK_BYTES = 128 * 1024 * 1024
+# Longest side of the thumbnail pushed to clients first (JPEG)
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 80
+# Spend the server's OPENAI_API_KEY on sessions that didn't send their own; off by default
+USE_SERVER_KEY = os.environ.get("IMAGE_USE_SERVER_KEY", "0") == "1"
+IMAGE_MODEL = "dall-e-3"
+IMAGE_SIZE = "1024x1024"
+
+_stats = {"jobs": 0, "generated": 0, "cache_hits": 0, "coalesced": 0, "failed": 0, "shed": 0, "thumbnails": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def normalise_prompt(prompt: str) -> str:
+    return " ".join(re.sub(r"[.!?]+$", "", prompt.strip()).lower().split())
+
+
+def image_key(prompt: str, model: str = IMAGE_MODEL, size: str = IMAGE_SIZE) -> str:
+    return hashlib.sha256(f"{model}\0{size}\0{normalise_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+
+def make_thumbnail(png: bytes, size: int = THUMBNAIL_SIZE) -> bytes | None:
+    """JPEG of at most size x size pixels, or None without Pillow."""
+    if Image is None:
+        return None
+    with Image.open(io.BytesIO(png)) as image:
+        image.thumbnail((size, size))
+        out = io.BytesIO()
+        image.convert("RGB").save(out, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+class ImageJob:
+    """One image request. `future` resolves to (image url, thumbnail url or None)."""
+
+    def __init__(self, prompt: str, key: str, future: Future, cached: bool = False):
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.key = key
+        self.future = future
+        self.cached = cached
+        self.created_at = time.time()
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return "running"
+        return "failed" if self.future.cancelled() or self.future.exception() is not None else "done"
+
+    def to_dict(self) -> dict:
+        result = {"job_id": self.id, "status": self.status, "prompt": self.prompt, "cached": self.cached}
+        if result["status"] == "done":
+            result["image_url"], result["thumbnail_url"] = self.future.result()
+        elif result["status"] == "failed":
+            result["error"] = "cancelled" if self.future.cancelled() else str(self.future.exception())
+        return result
+
+    def as_message(self, turn: int | None = None) -> dict:
+        """Socket message: "image_job" while running, then "assistant_image" with the thumbnail as image_url."""
+        message = self.to_dict()
+        if message["status"] == "running":
+            return {"type": "image_job", "turn": turn, **message}
+        full = message.pop("image_url", None)
+        thumbnail = message.pop("thumbnail_url", None)
+        return {"type": "assistant_image", **message, "image_url": thumbnail or full, "full_image_url": full}
+
+
+class ImageJobs:
+    """
+    Bounded pool of image generations shared by all sessions.
+
+    Results are cached on disk by prompt key (model, size and normalised prompt), so a
+    repeated request is answered without calling OpenAI, and concurrent requests for the
+    same prompt share one generation. Each result also gets a small JPEG thumbnail.
+    """
+
+    def __init__(self, workers: int = IMAGE_WORKERS, image_dir: str = IMAGE_DIR,
+                 max_queued: int = MAX_QUEUED_JOBS, max_disk_bytes: int = MAX_DISK_BYTES):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self._jobs: OrderedDict[str, ImageJob] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.image_dir = image_dir
+        self.max_queued = max_queued
+        self.max_disk_bytes = max_disk_bytes
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        return os.path.join(self.image_dir, f"{key}.png"), os.path.join(self.image_dir, f"{key}.thumb.jpg")
+
+    def _urls(self, key: str) -> tuple[str, str | None]:
+        image_path, thumb_path = self._paths(key)
+        thumbnail = IMAGE_URL_PREFIX + os.path.basename(thumb_path) if os.path.exists(thumb_path) else None
+        return IMAGE_URL_PREFIX + os.path.basename(image_path), thumbnail
+
+    def submit(self, prompt: str, api_key: str) -> ImageJob:
+        """
+        Start (or join, or answer from disk) the generation for `prompt`; returns at once.
+        Raises Overloaded when MAX_QUEUED_JOBS generations are already waiting for a worker.
+        """
+        key = image_key(prompt)
+        cached = os.path.exists(self._paths(key)[0])
+        started = None
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                _count("coalesced")
+            elif cached:
+                _count("cache_hits")
+                future = Future()
+                future.set_result(self._urls(key))
+            else:
+                if len(self._inflight) >= self.workers + self.max_queued:
+                    _count("shed")
+                    raise Overloaded("image", "generation queue full", retry_after=10.0)
+                future = started = self._inflight[key] = self._pool.submit(self._generate, key, prompt, api_key)
+            job = ImageJob(prompt, key, future, cached)
+            self._jobs[job.id] = job
+            while len(self._jobs) > MAX_JOBS:
+                self._jobs.popitem(last=False)
+        if started is not None:
+            # Outside the lock: runs right away if the generation already finished
+            started.add_done_callback(lambda f: self._forget(key, f))
+        _count("jobs")
+        return job
+
+    def _forget(self, key: str, future: Future):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        if future.exception() is not None:
+            _count("failed")
+
+    def get_job(self, job_id: str) -> ImageJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _generate(self, key: str, prompt: str, api_key: str) -> tuple[str, str | None]:
+        started = time.monotonic()
+        png = generate_dalle_image(prompt, api_key, model=IMAGE_MODEL, size=IMAGE_SIZE)
+        if not png:
+            raise RuntimeError("image generation failed")
+        record_latency("image_generation", (time.monotonic() - started) * 1000)
+        _count("generated")
+        image_path, thumb_path = self._paths(key)
+        try:
+            thumbnail = make_thumbnail(png)
+        except Exception as e:
+            logger.warning(f"Thumbnail for image {key} failed: {e}")
+            thumbnail = None
+        os.makedirs(self.image_dir, exist_ok=True)
+        # The thumbnail goes first: the full image existing is what marks a cached prompt
+        if thumbnail:
+            self._write(thumb_path, thumbnail)
+            _count("thumbnails")
+        self._write(image_path, png)
+        self._trim_disk()
+        return self._urls(key)
+
+    def _write(self, path: str, data: bytes):
+        tmp = f"{path}.{uuid.uuid4().hex}.part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _trim_disk(self):
+        try:
+            names = os.listdir(self.image_dir)
+        except OSError:
+            return
+        prompts = {}
+        for name in names:
+            key = name.split(".", 1)[0]
+            if len(key) != 64 or name.endswith(".part"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.image_dir, name))
+            except OSError:
+                continue  # removed by a trim on another worker
+            mtime, size, files = prompts.get(key, (0.0, 0, []))
+            prompts[key] = (max(mtime, st.st_mtime), size + st.st_size, files + [name])
+        total = sum(size for _, size, _ in prompts.values())
+        for _, size, files in sorted(prompts.values()):
+            if total <= self.max_disk_bytes:
+                break
+            for name in files:
+                try:
+                    os.remove(os.path.join(self.image_dir, name))
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._inflight)
+            jobs_kept = len(self._jobs)
+        with _stats_lock:
+            stats = dict(_stats)
+        stats.update(workers=self.workers, pending=pending, jobs_kept=jobs_kept, thumbnails_enabled=Image is not None)
+        return stats
+
+
+image_jobs = ImageJobs()
+register_stats_provider("image_jobs", image_jobs.stats)
+
+
+def openai_key(api_keys: dict) -> str | None:
+    """The session's OpenAI key; OPENAI_API_KEY from the environment only with IMAGE_USE_SERVER_KEY=1."""
+    key = api_keys.get("openai")
+    if key and key != "none":
+        return key
+    return os.getenv("OPENAI_API_KEY") if USE_SERVER_KEY else None
+
+
+def start_image_job(session, turn_id: int, prompt: str) -> ImageJob | None:
+    """
+    Submit an image job for a voice turn and push its result to the session when it is
+    ready (right away for cached prompts). None without an OpenAI key.
+    Raises Overloaded when the generation queue is full.
+    """
+    api_key = openai_key(session.api_keys)
+    if not api_key:
+        return None
+    job = image_jobs.submit(prompt, api_key)
+    if not job.future.done():
+        session.post(job.as_message(turn_id))
+
+    def finished(future: Future):
+        record_latency("image_job", (time.time() - job.created_at) * 1000)
+        try:
+            # Without a turn, so the client shows it even after later turns have started
+            session.post(job.as_message())
+        except RuntimeError:
+            pass  # the session's event loop has closed
+
+    job.future.add_done_callback(finished)
+    return job
@@ -0,0 +1,144 @@
+import re
+
+# Routes a finished user turn to an intent in one pass. All rules' trigger words are merged
+# into one index, so a single tokenisation of the text picks the few rules worth trying;
+# their precompiled patterns are then tried in priority order and the first match wins,
+# with its named groups returned as slots. Most chit-chat turns trigger no rule at all.
+# Add intents with INTENT_ROUTER.add(...), or build your own IntentRouter.
+
+SITE_URLS = {
+    "youtube": "https://www.youtube.com",
+    "github": "https://www.github.com",
+    "wikipedia": "https://www.wikipedia.org",
+    "gmail": "https://mail.google.com",
+    "google drive": "https://drive.google.com",
+    "reddit": "https://www.reddit.com",
+    "twitter": "https://twitter.com",
+    "facebook": "https://facebook.com",
+    "instagram": "https://instagram.com",
+}
+SEARCH_KEYWORDS = [
+    "search for", "google", "look up", "latest news", "find", "show me the news",
+    "who won", "what happened", "current events",
+]
+IDENTITY_PHRASES = [
+    "your name", "who are you", "what are you", "identify yourself", "are you buzz",
+]
+QUESTION_WORDS = ["who", "what", "when", "where", "why", "how"]
+# Image requests start a (paid) generation job, so "show me how to..." must not count as one
+IMAGE_PATTERNS = [
+    r"draw (me|an|a|the)?", r"show (me )?(an? |the )?(picture|image|drawing|photo)", r"generate (an|a|the)? image",
+    r"create (an|a|the)? image", r"picture of", r"image of", r"visualize", r"illustrate",
+]
+
+# Words, plus "?" so a question mark can trigger a rule
+_TOKEN = re.compile(r"\w+|\?")
+
+
+class Intent:
+    """Result of routing one utterance: intent name, extracted slots and the original text."""
+    __slots__ = ("name", "slots", "text")
+
+    def __init__(self, name: str, slots: dict | None = None, text: str = ""):
+        self.name = name
+        self.slots = slots or {}
+        self.text = text
+
+    def __repr__(self):
+        return f"Intent({self.name!r}, {self.slots!r})"
+
+
+class IntentRouter:
+    def __init__(self, default: str = "chat"):
+        self.default = default
+        self._rules = []
+        self._compiled = False
+
+    def add(self, name: str, pattern: str, slots: dict | None = None, extract=None, triggers=None):
+        """
+        Register a rule for intent `name`, tried after the rules already added.
+        `pattern` is a regex searched in the lowercased text; its named groups become
+        slots, merged over the fixed `slots`. `extract(text, slots)` may return the
+        final slots dict (e.g. to derive a search query from the original text).
+        `triggers` are words (or "?") at least one of which must appear in the text for
+        the rule to be tried; None means the rule is always tried.
+        """
+        self._rules.append((name, pattern, slots or {}, extract, set(triggers) if triggers is not None else None))
+        self._compiled = False
+        return self
+
+    def _compile(self):
+        self._patterns = [re.compile(pattern, re.DOTALL) for _name, pattern, _slots, _extract, _triggers in self._rules]
+        self._trigger_index = {}
+        self._always = set()
+        for i, (_name, _pattern, _slots, _extract, triggers) in enumerate(self._rules):
+            if triggers is None:
+                self._always.add(i)
+            for word in triggers or ():
+                self._trigger_index.setdefault(word, set()).add(i)
+        self._compiled = True
+
+    def route(self, text: str) -> Intent:
+        if not self._compiled:
+            self._compile()
+        lowered = text.lower()
+        candidates = set(self._always)
+        for word in self._trigger_index.keys() & set(_TOKEN.findall(lowered)):
+            candidates |= self._trigger_index[word]
+        for index in sorted(candidates):
+            match = self._patterns[index].search(lowered)
+            if match is None:
+                continue
+            name, _pattern, fixed, extract, _triggers = self._rules[index]
+            slots = dict(fixed)
+            slots.update((slot, value) for slot, value in match.groupdict().items() if value is not None)
+            if extract is not None:
+                slots = extract(text, slots)
+            return Intent(name, slots, text)
+        return Intent(self.default, {}, text)
+
+
+def _alternation(words) -> str:
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+def _site_slots(text: str, slots: dict) -> dict:
+    return {**slots, "url": SITE_URLS[slots["site"]]}
+
+
+_SEARCH_KEYWORD = re.compile(_alternation(SEARCH_KEYWORDS), re.IGNORECASE)
+
+
+def _search_slots(text: str, slots: dict) -> dict:
+    query = " ".join(_SEARCH_KEYWORD.sub(" ", text, count=1).split())
+    return {**slots, "query": query}
+
+
+def _first_words(phrases) -> set:
+    return {phrase.split()[0] for phrase in phrases}
+
+
+def build_default_router() -> IntentRouter:
+    router = IntentRouter(default="chat")
+    # "light" and "led" both address the ESP32 LED. State questions go first: "is the light on" also reads as a command
+    router.add("device_state", r"\b(?:is|are) (?:the |my )?(?:led|light)s? (?:on|off|lit)\b|(?:status|state) of (?:the |my )?(?:led|light)"
+               r"|(?:led|light)'?s? (?:status|state)\b", {"device": "led"}, triggers={"led", "leds", "light", "lights"})
+    for state in ("on", "off"):
+        router.add("device_control", rf"(?:turn|switch) {state} (?:the )?(?:led|light)|(?:led|light) {state}|{state} (?:led|light)",
+                   {"device": "led", "state": state}, triggers={"led", "leds", "light", "lights"})
+    router.add("open_site", rf"open (?P<site>{_alternation(SITE_URLS)})", extract=_site_slots, triggers={"open"})
+    router.add("web_search", rf"(?P<keyword>{_alternation(SEARCH_KEYWORDS)})", extract=_search_slots,
+               triggers=_first_words(SEARCH_KEYWORDS))
+    router.add("identity", _alternation(IDENTITY_PHRASES), triggers=_first_words(IDENTITY_PHRASES))
+    # Before questions, so "can you draw me a cat?" is an image request; "how do I draw..." stays a question
+    router.add("image", r"^(?!\s*how\b).*?(?:" + "|".join(f"(?:{p})" for p in IMAGE_PATTERNS) + ")",
+               triggers={"draw", "show", "generate", "create", "picture", "image", "visualize", "illustrate"})
+    router.add("question", rf"\?\s*$|^\s*(?:{_alternation(QUESTION_WORDS)})\b", triggers={"?", *QUESTION_WORDS})
+    return router
+
+
+INTENT_ROUTER = build_default_router()
+
+
+def route_intent(text: str) -> Intent:
+    return INTENT_ROUTER.route(text)
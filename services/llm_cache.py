@@ -0,0 +1,404 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from services.admission import Overloaded
+from services.llm_service import GEMINI_MODEL, FallbackReply, split_sentences
+from services.metrics_service import register_stats_provider
+from services.search_service import normalise_query
+from services.tracing import in_turn_context, mark
+
+logger = logging.getLogger(__name__)
+
+# Cache of LLM replies to turns whose answer doesn't depend on the conversation so far,
+# keyed by intent class, model, persona and the normalised user prompt: "who are you?"
+# asked in any session is answered by Gemini once per TTL. Identical requests already
+# being answered share that one generation, sentence by sentence as it streams. The
+# generation runs apart from the caller, so a barge-in doesn't stop it filling the cache.
+# With LLM_CACHE_SIMILARITY set, a paraphrase of a cached prompt (close enough in a
+# hashed word/trigram vector space) is served the cached reply too.
+
+
+def _parse_ttls(spec: str, defaults: dict) -> dict:
+    ttls = dict(defaults)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        ttls[name.strip()] = float(value)
+    return ttls
+
+
+# Seconds a reply is reused, per intent class (see turn_service.llm_path); 0 turns caching
+# off for a class. Identity answers only change with the persona; web-enhanced answers go
+# stale with the news. Chat replies follow the conversation and are never cached.
+LLM_CACHE_TTLS = _parse_ttls(os.environ.get("LLM_CACHE_TTLS", ""), {"identity": 86400, "question": 300})
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+# Cosine similarity at which a cached prompt's reply is used for a paraphrase (0 = exact
+# prompts only); around 0.9 matches rewordings but not the same question about another place
+LLM_CACHE_SIMILARITY = float(os.environ.get("LLM_CACHE_SIMILARITY", 0))
+# Hashed feature space for prompt vectors
+VECTOR_DIM = 512
+# Rough bookkeeping cost of one entry on top of its key and reply text
+ENTRY_OVERHEAD_BYTES = 200
+
+_NUMBER = re.compile(r"\d+")
+
+
+def reply_key(kind: str, user_prompt: str, persona: str, model: str = GEMINI_MODEL) -> tuple | None:
+    """Cache key for the reply to a turn, or None if replies of its intent class aren't cached."""
+    if kind == "chat" or not LLM_CACHE_TTLS.get(kind):
+        return None
+    prompt = normalise_query(user_prompt)
+    if not prompt:
+        return None
+    persona_digest = hashlib.sha256(persona.encode("utf-8")).hexdigest()[:16]
+    return kind, f"{model}/{persona_digest}", prompt
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class PendingReply:
+    """A reply being generated; every caller that asked for it reads its pieces as they arrive."""
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        # Overloaded, if admission control shed the generation
+        self.error = None
+        self._cond = threading.Condition()
+        self._waiters = []  # (loop, future) per waiting asyncio reader
+
+    def _notify(self):
+        # Caller holds self._cond
+        self._cond.notify_all()
+        for loop, future in self._waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+        self._waiters.clear()
+
+    def append(self, item: str):
+        with self._cond:
+            self.items.append(item)
+            self._notify()
+
+    def finish(self, error: Exception | None = None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._notify()
+
+    def follow(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.items) and not self.done:
+                    self._cond.wait()
+                if index >= len(self.items):
+                    break
+                item = self.items[index]
+            index += 1
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    async def follow_async(self):
+        loop = asyncio.get_running_loop()
+        index = 0
+        while True:
+            waiter = None
+            with self._cond:
+                if index < len(self.items):
+                    item = self.items[index]
+                elif self.done:
+                    break
+                else:
+                    waiter = loop.create_future()
+                    self._waiters.append((loop, waiter))
+            if waiter is not None:
+                await waiter
+                continue
+            index += 1
+            yield item
+        if self.error is not None:
+            raise self.error
+
+
+def _features(prompt: str):
+    """Hashed features of a normalised prompt: its words, and the character trigrams of each word at half weight."""
+    for word in prompt.split():
+        yield zlib.crc32(word.encode("utf-8")) % VECTOR_DIM, 1.0
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            yield zlib.crc32(padded[i:i + 3].encode("utf-8")) % VECTOR_DIM, 0.5
+
+
+class NearDuplicateIndex:
+    """
+    Unit vectors of cached prompts in one matrix, so finding the closest cached prompt is a
+    single matrix-vector product. Only prompts with the same scope (intent class, model and
+    persona) and the same numbers are candidates: "planet 3" never answers "planet 4".
+    """
+
+    def __init__(self, threshold: float, np):
+        self.threshold = threshold
+        self.np = np
+        self._vectors = np.zeros((64, VECTOR_DIM), dtype=np.float32)
+        self._scopes = np.full(64, -1, dtype=np.int64)   # scope id per row, -1 when free
+        self._keys = [None] * 64
+        self._rows = {}
+        self._free = list(range(63, -1, -1))
+        self._scope_ids = {}
+
+    def _vector(self, prompt: str):
+        vector = self.np.zeros(VECTOR_DIM, dtype=self.np.float32)
+        for index, weight in _features(prompt):
+            vector[index] += weight
+        norm = self.np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _grow(self):
+        size = len(self._keys)
+        self._vectors = self.np.concatenate([self._vectors, self.np.zeros_like(self._vectors)])
+        self._scopes = self.np.concatenate([self._scopes, self.np.full(size, -1, dtype=self.np.int64)])
+        self._keys.extend([None] * size)
+        self._free.extend(range(2 * size - 1, size - 1, -1))
+
+    def add(self, key: tuple):
+        if key in self._rows:
+            return
+        if not self._free:
+            self._grow()
+        row = self._free.pop()
+        kind, scope, prompt = key
+        self._vectors[row] = self._vector(prompt)
+        self._scopes[row] = self._scope_ids.setdefault((kind, scope), len(self._scope_ids))
+        self._keys[row] = key
+        self._rows[key] = row
+
+    def remove(self, key: tuple):
+        row = self._rows.pop(key, None)
+        if row is not None:
+            self._scopes[row] = -1
+            self._keys[row] = None
+            self._free.append(row)
+
+    def find(self, key: tuple) -> tuple | None:
+        """The cached key closest to `key` at or above the threshold, if any."""
+        kind, scope, prompt = key
+        scope_id = self._scope_ids.get((kind, scope))
+        if scope_id is None:
+            return None
+        scores = self._vectors @ self._vector(prompt)
+        scores[self._scopes != scope_id] = -1
+        numbers = _NUMBER.findall(prompt)
+        for row in self.np.argsort(scores)[::-1]:
+            if scores[row] < self.threshold:
+                break
+            candidate = self._keys[row]
+            if _NUMBER.findall(candidate[2]) == numbers:
+                return candidate
+        return None
+
+
+def _near_duplicate_index(threshold: float) -> NearDuplicateIndex | None:
+    if not threshold:
+        return None
+    try:
+        import numpy
+    except ImportError:
+        logger.warning("LLM_CACHE_SIMILARITY is set but numpy isn't installed; only exact prompts will hit the LLM cache.")
+        return None
+    return NearDuplicateIndex(threshold, numpy)
+
+
+class LLMCache:
+    """
+    TTL cache of reply_key -> reply text, least recently used entries evicted past
+    `max_bytes`. Concurrent requests for the same key share one generation.
+    """
+
+    def __init__(self, ttls: dict = LLM_CACHE_TTLS, max_bytes: int = LLM_CACHE_MAX_BYTES,
+                 similarity: float = LLM_CACHE_SIMILARITY):
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, reply)
+        self._bytes = 0
+        self._inflight: dict[tuple, PendingReply] = {}
+        self._index = _near_duplicate_index(similarity)
+        self._lock = threading.Lock()
+        self._background = set()
+        self._stats = {"hits": 0, "near_hits": 0, "misses": 0, "coalesced": 0, "failures": 0,
+                       "expired": 0, "evictions": 0}
+
+    @staticmethod
+    def _size(key: tuple, reply: str) -> int:
+        return len(reply.encode("utf-8")) + len(key[2]) + ENTRY_OVERHEAD_BYTES
+
+    def _drop(self, key: tuple):
+        # Caller holds self._lock
+        _expires_at, reply = self._entries.pop(key)
+        self._bytes -= self._size(key, reply)
+        if self._index is not None:
+            self._index.remove(key)
+
+    def _live(self, key: tuple) -> str | None:
+        # Caller holds self._lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            self._stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, key: tuple) -> str | None:
+        """The cached reply for `key`, or for a near-duplicate prompt when those are enabled."""
+        with self._lock:
+            reply = self._live(key)
+            if reply is not None:
+                self._stats["hits"] += 1
+                return reply
+            if self._index is None:
+                return None
+            similar = self._index.find(key)
+            reply = self._live(similar) if similar is not None else None
+            if reply is not None:
+                self._stats["near_hits"] += 1
+                logger.info(f"LLM cache: answering {key[2]!r} with the reply to {similar[2]!r}")
+            return reply
+
+    def put(self, key: tuple, reply: str):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttls[key[0]], reply)
+            self._bytes += self._size(key, reply)
+            if self._index is not None:
+                self._index.add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def claim(self, key: tuple) -> tuple[str | None, PendingReply | None, bool]:
+        """
+        (reply, None, False) on a hit; otherwise (None, pending, owner): the owner must
+        generate the reply into `pending` (see _generate), other callers follow it.
+        """
+        reply = self.get(key)
+        if reply is not None:
+            return reply, None, False
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is not None:
+                self._stats["coalesced"] += 1
+                return None, pending, False
+            pending = self._inflight[key] = PendingReply()
+            self._stats["misses"] += 1
+            return None, pending, True
+
+    def _finish(self, key: tuple, pending: PendingReply, ok: bool, error: Exception | None = None):
+        # A fallback (the LLM failed) is shared with the callers already waiting, but not kept
+        ok = ok and not any(isinstance(item, FallbackReply) for item in pending.items)
+        if ok and pending.items:
+            self.put(key, " ".join(pending.items))
+        with self._lock:
+            self._inflight.pop(key, None)
+            if not ok:
+                self._stats["failures"] += 1
+        pending.finish(error)
+
+    def _generate(self, key: tuple, pending: PendingReply, produce):
+        ok, error = False, None
+        try:
+            for item in produce():
+                if item:
+                    pending.append(item)
+            ok = True
+        except Overloaded as e:
+            error = e
+        except Exception as e:
+            logger.warning(f"LLM reply for {key[2]!r} failed: {e}")
+        finally:
+            self._finish(key, pending, ok, error)
+
+    async def _generate_async(self, key: tuple, pending: PendingReply, produce):
+        ok, error = False, None
+        try:
+            async for item in produce():
+                if item:
+                    pending.append(item)
+            ok = True
+        except Overloaded as e:
+            error = e
+        except Exception as e:
+            logger.warning(f"LLM reply for {key[2]!r} failed: {e}")
+        finally:
+            self._finish(key, pending, ok, error)
+
+    def sentences(self, key: tuple, produce):
+        """
+        The reply for `key` piece by piece: split into sentences on a hit, else as
+        `produce()` (an iterable of sentences, or of one whole reply) yields them. The
+        owner's `produce` runs on its own thread in the caller's turn context.
+        Raises Overloaded if that generation was shed.
+        """
+        reply, pending, owner = self.claim(key)
+        if reply is not None:
+            mark("llm_cache_hit")
+            return iter(_split(reply))
+        if owner:
+            threading.Thread(target=in_turn_context(self._generate), args=(key, pending, produce),
+                             name="llm-cache", daemon=True).start()
+        return pending.follow()
+
+    async def sentences_async(self, key: tuple, produce):
+        """Async counterpart of sentences: `produce()` returns an async iterator and runs as a task."""
+        reply, pending, owner = self.claim(key)
+        if reply is not None:
+            mark("llm_cache_hit")
+            for sentence in _split(reply):
+                yield sentence
+            return
+        if owner:
+            # Owned by the cache entry, not the caller: it completes even if the caller stops reading
+            task = asyncio.ensure_future(self._generate_async(key, pending, produce))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        async for item in pending.follow_async():
+            yield item
+
+    def reply(self, key: tuple, produce) -> str | None:
+        """The whole reply for `key` (None if generation failed); see sentences."""
+        return " ".join(self.sentences(key, produce)) or None
+
+    async def reply_async(self, key: tuple, produce) -> str | None:
+        return " ".join([item async for item in self.sentences_async(key, produce)]) or None
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["inflight"] = len(self._inflight)
+        lookups = stats["hits"] + stats["near_hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round((lookups - stats["misses"]) / lookups, 3) if lookups else None
+        return stats
+
+
+def _split(reply: str) -> list[str]:
+    sentences, rest = split_sentences(reply)
+    if rest.strip():
+        sentences.append(rest.strip())
+    return sentences
+
+
+llm_cache = LLMCache()
+register_stats_provider("llm_cache", llm_cache.stats)
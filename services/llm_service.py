@@ -1,219 +1,253 @@
-import paho.mqtt.publish as publish
-# MQTT settings (set these to your broker info or pass as args)
-MQTT_BROKER = "broker.hivemq.com"  # Or your cloud broker
-MQTT_PORT = 1883
-MQTT_TOPIC = "myhome/esp32/led"  # Use a unique topic per device
-MQTT_USER = None  # Set if needed
-MQTT_PASS = None  # Set if needed
-
-def send_mqtt_command(command: str, topic: str = MQTT_TOPIC, broker: str = MQTT_BROKER, port: int = MQTT_PORT, user: str = MQTT_USER, password: str = MQTT_PASS) -> bool:
-    try:
-        auth = {'username': user, 'password': password} if user and password else None
-        publish.single(topic, command, hostname=broker, port=port, auth=auth)
-        print(f"[send_mqtt_command] Published '{command}' to {topic} at {broker}:{port}")
-        return True
-    except Exception as e:
-        print(f"[send_mqtt_command] MQTT publish failed: {e}")
-        return False
-from bs4 import BeautifulSoup
+import base64
+import logging
+import re
+import webbrowser
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from services.mqtt_service import MQTT_BROKER, MQTT_PORT, MQTT_TOPIC, MQTT_USER, MQTT_PASS, send_mqtt_command
+from services.device_shadow import FAILED, UNCHANGED, device_state, send_device_command
+from services.client_registry import get_gemini_client, get_openai_client
+from services.admission import admission, Overloaded
+from services.tracing import in_turn_context
+from services.search_service import search_web_future, search_web_summary, search_web_summary_async
+from services.intent_router import route_intent
+from services.conversation_memory import ConversationMemory
+from services.service_registry import service_registry
+
+logger = logging.getLogger(__name__)
 
-def search_web_and_enhance_answer(query: str) -> str:
+class FallbackReply(str):
+    """Stand-in reply spoken when the LLM failed; never stored in the LLM cache."""
+
+
+def web_enhanced_prompt(query: str, web_summary: str) -> str:
+    return f"User question: {query}\nWeb search summary: {web_summary}\nAnswer the user's question, using the web info if helpful:"
+
+
+# Hard deadline for a web-enhanced answer (search + LLM) before the LLM-only answer is used
+ENHANCED_ANSWER_BUDGET_SECONDS = 4.0
+_answer_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="answer")
+
+
+def search_web_and_enhance_answer(query: str, gemini_api_key: str, budget: float = ENHANCED_ANSWER_BUDGET_SECONDS) -> str:
     """
     Search the web for the query, extract a summary, and enhance the LLM answer with web info.
+    On a search cache miss an LLM-only answer runs in parallel, and is used if the
+    web-enhanced one isn't ready within `budget` seconds.
     """
-    try:
-        # Use DuckDuckGo for scraping-friendly search
-        search_url = f"https://html.duckduckgo.com/html/?q={requests.utils.quote(query)}"
-        resp = requests.get(search_url, timeout=5, headers={"User-Agent": "Mozilla/5.0"})
-        soup = BeautifulSoup(resp.text, "html.parser")
-        results = soup.find_all('a', class_='result__a', limit=3)
-        snippets = []
-        for a in results:
-            snippet = a.get_text(strip=True)
-            if snippet:
-                snippets.append(snippet)
-        web_summary = " | ".join(snippets) if snippets else "(No web summary found)"
-    except Exception as e:
-        web_summary = f"(Web search failed: {e})"
+    search = search_web_future(query)
+
+    def enhanced():
+        web_summary = search.result()
+        # Enhance LLM answer with web info
+        return query_llm(web_enhanced_prompt(query, web_summary), gemini_api_key) or FallbackReply(f"Web info: {web_summary}")
 
-    # Enhance LLM answer with web info
-    llm_prompt = f"User question: {query}\nWeb search summary: {web_summary}\nAnswer the user's question, using the web info if helpful:"
-    answer = query_llm(llm_prompt)
-    return answer or f"Web info: {web_summary}"
-import requests
+    if search.done():
+        return enhanced()
+    # In the turn's context, so admission control applies the turn's deadline
+    plain = _answer_pool.submit(in_turn_context(query_llm), query, gemini_api_key)
+    enhanced_answer = _answer_pool.submit(in_turn_context(enhanced))
+    try:
+        return enhanced_answer.result(timeout=budget)
+    except FutureTimeout:
+        logger.info(f"Web-enhanced answer missed the {budget}s budget; using the LLM-only answer.")
+    answer = plain.result()
+    return answer or enhanced_answer.result()
 
 # Set your ESP32 IP address here
 ESP32_IP = "192.168.31.241"  # <-- CHANGE THIS to your ESP32's IP
 
+def control_esp32_led(state: str) -> str:
+    """Send an on/off command to the ESP32 LED over MQTT and return feedback text."""
+    print(f"[control_esp32_led] Sending {state.upper()} command via MQTT...")
+    outcome = send_device_command(state, MQTT_TOPIC)
+    if outcome == UNCHANGED:
+        return f"The LED is already {state}."
+    if outcome != FAILED:
+        return f"LED turned {state}! (via MQTT)"
+    return f"Failed to turn {state} LED (MQTT error)"
+
+
+def describe_esp32_led() -> str:
+    """Answer "is the light on?" from the device shadow, without a round trip to the ESP32."""
+    state = device_state(MQTT_TOPIC)
+    if state is None:
+        return "I haven't heard from the LED yet, so I don't know whether it's on."
+    return f"The LED is {state}."
+
+
 def maybe_control_esp32_led(user_prompt: str) -> str | None:
     """
-    If the user prompt is a home automation command, send HTTP request to ESP32 and return feedback string.
+    If the user prompt is a home automation command, send it to the ESP32 and return feedback string.
     """
-    prompt = user_prompt.lower()
-    print(f"[maybe_control_esp32_led] Called with prompt: {prompt}")
-    import re
-    # Regex for any combination of (turn|switch) (on|off) (the)? (led|light)
-    on_patterns = [
-        r"(turn|switch) (on) (the )?(led|light)",
-        r"(led|light) (on)",
-        r"(on) (led|light)"
-    ]
-    off_patterns = [
-        r"(turn|switch) (off) (the )?(led|light)",
-        r"(led|light) (off)",
-        r"(off) (led|light)"
-    ]
-    if any(re.search(p, prompt) for p in on_patterns):
-        print("[maybe_control_esp32_led] Detected ON command, sending MQTT...")
-        ok = send_mqtt_command("on")
-        if ok:
-            return "LED turned on! (via MQTT)"
-        else:
-            return "Failed to turn on LED (MQTT error)"
-    if any(re.search(p, prompt) for p in off_patterns):
-        print("[maybe_control_esp32_led] Detected OFF command, sending MQTT...")
-        ok = send_mqtt_command("off")
-        if ok:
-            return "LED turned off! (via MQTT)"
-        else:
-            return "Failed to turn off LED (MQTT error)"
-    print("[maybe_control_esp32_led] No LED command detected.")
-    return None
-import webbrowser
-import re
+    intent = route_intent(user_prompt)
+    if intent.name != "device_control":
+        return None
+    return control_esp32_led(intent.slots["state"])
+
+
+def open_in_chrome(intent) -> bool:
+    """Open the site or Google search for an open_site/web_search intent in a new browser tab."""
+    if intent.name == "open_site":
+        url = intent.slots["url"]
+    elif intent.name == "web_search":
+        url = f'https://www.google.com/search?q={intent.slots["query"].replace(" ", "+")}'
+    else:
+        return False
+    print(f"[open_in_chrome] Attempting to open URL: {url}")
+    try:
+        webbrowser.open_new_tab(url)
+        print("[open_in_chrome] Browser open command issued.")
+    except Exception as e:
+        print(f"[open_in_chrome] Failed to open browser: {e}")
+    return True
 
 
 def maybe_open_in_chrome(user_prompt: str) -> bool:
     """
     If the user prompt looks like a web search/news/info request, open it in Chrome and return True. Otherwise, return False.
     """
-    # Simple heuristic: look for keywords
-    search_keywords = [
-        r"search for ",
-        r"google ",
-        r"look up ",
-        r"latest news",
-        r"wikipedia ",
-        r"find ",
-        r"open (the )?website",
-        r"show me (the )?news",
-        r"who won",
-        r"what happened",
-        r"current events",
-        r"Open"
-    ]
-    import logging
-    print(f"[maybe_open_in_chrome] Called with prompt: {user_prompt}")
-    prompt = user_prompt.lower().strip()
-    # Direct site redirects
-    site_map = {
-        "youtube": "https://www.youtube.com",
-        "github": "https://www.github.com",
-        "wikipedia": "https://www.wikipedia.org",
-        "gmail": "https://mail.google.com",
-        "google drive": "https://drive.google.com",
-        "reddit": "https://www.reddit.com",
-        "twitter": "https://twitter.com",
-        "facebook": "https://facebook.com",
-        "instagram": "https://instagram.com"
-    }
-    for key, url in site_map.items():
-        if f"open {key}" in prompt or f"open {key} website" in prompt:
-            print(f"[maybe_open_in_chrome] Directly opening {key}: {url}")
-            try:
-                webbrowser.open_new_tab(url)
-                print("[maybe_open_in_chrome] Browser open command issued.")
-            except Exception as e:
-                print(f"[maybe_open_in_chrome] Failed to open browser: {e}")
-            return True
-    # Fallback: Google search
-    search_keywords = [
-        "search for",
-        "google",
-        "look up",
-        "latest news",
-        "find",
-        "show me the news",
-        "who won",
-        "what happened",
-        "current events"
-    ]
-    matched = False
-    for kw in search_keywords:
-        if kw in prompt:
-            matched = True
-            break
-    if matched:
-        query = user_prompt
-        for kw in search_keywords:
-            query = query.replace(kw, '', 1)
-        url = f'https://www.google.com/search?q={query.strip().replace(" ", "+")}'
-        print(f"[maybe_open_in_chrome] Attempting to open URL: {url}")
-        try:
-            webbrowser.open_new_tab(url)
-            print("[maybe_open_in_chrome] Browser open command issued.")
-        except Exception as e:
-            print(f"[maybe_open_in_chrome] Failed to open browser: {e}")
-        return True
-    return False
-import openai
-
-def generate_dalle_image(prompt: str, openai_api_key: str) -> str | None:
+    return open_in_chrome(route_intent(user_prompt))
+
+def generate_dalle_image(prompt: str, openai_api_key: str, model: str = "dall-e-3",
+                         size: str = "1024x1024") -> bytes | None:
     """
-    Generate an image using OpenAI DALL·E API. Returns the image URL.
+    Generate an image with the OpenAI Images API. Returns the PNG bytes (OpenAI's
+    hosted URLs expire, so callers store the image themselves); see services/image_jobs.py.
     """
     try:
-        openai.api_key = openai_api_key
-        response = openai.Image.create(
-            prompt=prompt,
-            n=1,
-            size="512x512",
-            model="dall-e-3"
-        )
-        if response and 'data' in response and len(response['data']) > 0:
-            return response['data'][0]['url']
+        response = get_openai_client(openai_api_key).images.generate(
+            model=model, prompt=prompt, n=1, size=size, response_format="b64_json")
+        if response.data and response.data[0].b64_json:
+            return base64.b64decode(response.data[0].b64_json)
         return None
     except Exception as e:
         logger.error(f"DALL·E Image Generation Error: {e}")
         return None
-def stream_llm_response_chunks(text: str, chunk_size: int = 20):
+# Sentence boundary: terminal punctuation (optionally closed by a quote/bracket) followed by whitespace
+SENTENCE_END = re.compile(r'(?<=[.!?])["\')\]]?\s+')
+# Don't hand TTS tiny fragments like "Sure." on their own; merge them with the next sentence
+MIN_SENTENCE_CHARS = 20
+
+
+def split_sentences(buffer: str) -> tuple[list[str], str]:
+    """Split off the complete sentences in `buffer`. Returns (sentences, remainder)."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(buffer):
+        if match.end() - start < MIN_SENTENCE_CHARS:
+            continue
+        sentences.append(buffer[start:match.end()].strip())
+        start = match.end()
+    return sentences, buffer[start:]
+
+
+def stream_llm_sentences(text, gemini_api_key: str, raise_errors: bool = False):
     """
-    Simulate streaming Gemini response by splitting the response into chunks of N words.
-    Accepts either a string or a list of chat messages.
+    Stream a Gemini response and yield it sentence by sentence as tokens arrive,
+    so TTS can start on the first sentence while the rest is still generating.
+    Accepts a string, a list of chat messages or a ConversationMemory.
+    A failed request ends the reply early, or with `raise_errors` raises instead.
     """
+    request = gemini_request(text)
+    buffer = ''
+    try:
+        gemini_client = get_gemini_client(gemini_api_key)
+        # The slot is held until the stream ends, however slowly it is consumed
+        with admission.admit("llm", gemini_api_key):
+            for chunk in gemini_client.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                **request
+            ):
+                if not chunk.text:
+                    continue
+                buffer += chunk.text
+                sentences, buffer = split_sentences(buffer)
+                yield from sentences
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Gemini LLM streaming Error: {e}")
+        if raise_errors:
+            raise
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def stream_llm_sentences_async(text, gemini_api_key: str, raise_errors: bool = False):
+    """Async counterpart of stream_llm_sentences, on the client's non-blocking `.aio` interface."""
+    request = gemini_request(text)
+    buffer = ''
+    try:
+        gemini_client = get_gemini_client(gemini_api_key)
+        with await admission.admit_async("llm", gemini_api_key):
+            async for chunk in await gemini_client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                **request
+            ):
+                if not chunk.text:
+                    continue
+                buffer += chunk.text
+                sentences, buffer = split_sentences(buffer)
+                for sentence in sentences:
+                    yield sentence
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Gemini LLM streaming Error: {e}")
+        if raise_errors:
+            raise
+    if buffer.strip():
+        yield buffer.strip()
+
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+def build_prompt(text) -> str:
+    if isinstance(text, ConversationMemory):
+        return text.as_text()
+    # If text is a list (chat history), concatenate all messages
     if isinstance(text, list):
-        # Concatenate all user and assistant messages for context
-        prompt = '\n'.join([msg['content'] for msg in text])
-    else:
-        prompt = text
-    full_response = query_llm(prompt)
-    if not full_response:
-        return
-    words = full_response.split()
-    for i in range(0, len(words), chunk_size):
-        yield ' '.join(words[i:i+chunk_size])
-
-
-import os
-from dotenv import load_dotenv
-load_dotenv()
-import logging
-logger = logging.getLogger(__name__)
+        return '\n'.join([msg['content'] for msg in text if 'content' in msg])
+    return str(text)
+
+
+def gemini_request(text) -> dict:
+    """generate_content arguments for a prompt string, message list or ConversationMemory."""
+    if isinstance(text, ConversationMemory):
+        types = service_registry.get("gemini").types
+        # Role-aware: persona and summary as the system instruction, turns as user/model contents
+        return {"contents": text.gemini_contents(),
+                "config": types.GenerateContentConfig(system_instruction=text.system_instruction())}
+    return {"contents": build_prompt(text)}
+
 
-from google import genai
 def query_llm(text: str, gemini_api_key: str) -> str | None:
     try:
-        # If text is a list (chat history), concatenate all messages
-        if isinstance(text, list):
-            prompt = '\n'.join([msg['content'] for msg in text if 'content' in msg])
-        else:
-            prompt = str(text)
-        gemini_client = genai.Client(api_key=gemini_api_key)
-        response = gemini_client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
+        gemini_client = get_gemini_client(gemini_api_key)
+        with admission.admit("llm", gemini_api_key):
+            response = gemini_client.models.generate_content(
+                model=GEMINI_MODEL,
+                **gemini_request(text)
+            )
+        return response.text
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Gemini LLM Error: {e}")
+        return None
+
+
+async def query_llm_async(text, gemini_api_key: str) -> str | None:
+    try:
+        gemini_client = get_gemini_client(gemini_api_key)
+        with await admission.admit_async("llm", gemini_api_key):
+            response = await gemini_client.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                **gemini_request(text)
+            )
         return response.text
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Gemini LLM Error: {e}")
         return None
@@ -0,0 +1,69 @@
+import threading
+from collections import deque
+
+# Rolling window of recent samples per metric; enough for stable p95 without unbounded growth
+MAX_SAMPLES = 1000
+
+
+class LatencyStats:
+    """Rolling latency samples (milliseconds) for one named metric."""
+
+    def __init__(self, max_samples: int = MAX_SAMPLES):
+        self._samples = deque(maxlen=max_samples)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, value_ms: float):
+        with self._lock:
+            self._samples.append(value_ms)
+            self._count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            last = self._samples[-1] if self._samples else None
+            count = self._count
+        if not samples:
+            return {"count": count}
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 1)
+        return {
+            "count": count,
+            "last_ms": round(last, 1),
+            "mean_ms": round(sum(samples) / len(samples), 1),
+            "p50_ms": pct(0.50),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+            "max_ms": round(samples[-1], 1),
+        }
+
+
+_stats: dict[str, LatencyStats] = {}
+_stats_lock = threading.Lock()
+# Other modules' counters (connection pools, caches, ...) reported under their own key
+_providers = {}
+
+
+def record_latency(name: str, value_ms: float):
+    stats = _stats.get(name)
+    if stats is None:
+        with _stats_lock:
+            stats = _stats.setdefault(name, LatencyStats())
+    stats.record(value_ms)
+
+
+def register_stats_provider(name: str, fn):
+    """Include `fn()` under `name` in every metrics snapshot."""
+    _providers[name] = fn
+
+
+def metrics_snapshot() -> dict:
+    with _stats_lock:
+        names = list(_stats)
+    snapshot = {name: _stats[name].snapshot() for name in names}
+    for name, fn in list(_providers.items()):
+        try:
+            snapshot[name] = fn()
+        except Exception as e:
+            snapshot[name] = {"error": str(e)}
+    return snapshot
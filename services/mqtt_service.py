@@ -0,0 +1,315 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+import paho.mqtt.client as mqtt
+from services.metrics_service import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+# MQTT settings (set these to your broker info or pass as args)
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "broker.hivemq.com")  # Or your cloud broker
+MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
+MQTT_TOPIC = "myhome/esp32/led"  # Use a unique topic per device
+MQTT_USER = None  # Set if needed
+MQTT_PASS = None  # Set if needed
+MQTT_KEEPALIVE = 60
+# How long a publish waits for the broker's PUBACK (including a reconnect) before reporting failure
+PUBLISH_TIMEOUT = 5.0
+# Most broker connections kept open besides the configured broker's; the least recently used is closed
+MAX_PUBLISHERS = int(os.environ.get("MQTT_MAX_PUBLISHERS", 8))
+
+_stats = {"connections": 0, "reconnects": 0, "published": 0, "acked": 0, "coalesced": 0, "failed": 0, "received": 0,
+          "evicted": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+class MQTTPublisher:
+    """
+    Long-lived publisher connection to one broker (host, port, credentials).
+
+    paho's network thread keeps the connection alive and reconnects with backoff;
+    QoS 1 messages published while disconnected are queued and sent on reconnect.
+    Each publish returns a Future resolved when the broker acknowledges it.
+
+    The same connection carries subscriptions (see services/device_shadow.py): they
+    are renewed on every reconnect, and incoming messages go to the handlers added
+    with add_message_handler. `connection_epoch` changes on every (re)connect, so
+    state learned from messages can tell whether it may have missed some since.
+
+    Bursts to the same topic are coalesced: while a publish to a topic is waiting
+    for its PUBACK, newer payloads for that topic replace each other and only the
+    latest is sent once the ack arrives. Callers whose payload was superseded get
+    the result of the publish that replaced it.
+    """
+
+    def __init__(self, host: str, port: int = MQTT_PORT, user: str | None = None, password: str | None = None):
+        self.host = host
+        self.port = port
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"voice-agent-{uuid.uuid4().hex[:12]}")
+        if user and password:
+            self._client.username_pw_set(user, password)
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.on_message = self._on_message
+        self._lock = threading.Lock()
+        self._pending = {}         # mid -> (topic, [futures])
+        self._early_acks = set()   # PUBACKs that arrived before we registered the mid
+        self._qos0_mids = set()    # QoS 0 publishes sent whose on_publish hasn't fired yet
+        self._inflight_topics = {} # topic -> mid awaiting PUBACK
+        self._queued = {}          # topic -> (payload, qos, retain, [futures]) waiting behind it
+        self._subscriptions = {}   # topic filter -> qos, renewed on every connect
+        self._message_handlers = []
+        self._connected = threading.Event()
+        self._closed = False
+        self._ever_connected = False
+        self.connection_epoch = 0
+        self._client.connect_async(host, port, keepalive=MQTT_KEEPALIVE)
+        self._client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.warning(f"[mqtt] Connect to {self.host}:{self.port} refused: {reason_code}")
+            return
+        _count("reconnects" if self._ever_connected else "connections")
+        self._ever_connected = True
+        self.connection_epoch += 1
+        # paho leaves Nagle on: a PUBACK for a received message would hold back the next publish for a delayed ACK
+        sock = client.socket()
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connected.set()
+        with self._lock:
+            subscriptions = list(self._subscriptions.items())
+        if subscriptions:
+            client.subscribe(subscriptions)
+        logger.info(f"[mqtt] Connected to {self.host}:{self.port}")
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self._connected.clear()
+        logger.info(f"[mqtt] Disconnected from {self.host}:{self.port} ({reason_code}); will reconnect")
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self._lock:
+            if mid in self._qos0_mids:
+                # Nothing waits on a QoS 0 publish
+                self._qos0_mids.discard(mid)
+                return
+            entry = self._pending.pop(mid, None)
+            if entry is None:
+                self._early_acks.add(mid)
+                return
+            topic, futures = entry
+        self._resolve(futures, not reason_code.is_failure)
+        self._after_ack(topic, mid)
+
+    def _on_message(self, client, userdata, message):
+        _count("received")
+        for handler in self._message_handlers:
+            try:
+                handler(message.topic, message.payload, message.retain)
+            except Exception as e:
+                logger.error(f"[mqtt] Message handler for {message.topic} failed: {e}")
+
+    def _resolve(self, futures, ok: bool):
+        _count("acked" if ok else "failed", len(futures))
+        for future in futures:
+            if not future.done():
+                future.set_result(ok)
+
+    def _after_ack(self, topic: str, mid: int | None):
+        """Release the topic's in-flight slot and send whatever was coalesced behind it."""
+        with self._lock:
+            if self._inflight_topics.get(topic, -1) != mid:
+                return
+            del self._inflight_topics[topic]
+            queued = self._queued.pop(topic, None)
+        if queued is not None:
+            payload, qos, retain, futures = queued
+            self._send(topic, payload, qos, retain, futures)
+
+    def _send(self, topic: str, payload, qos: int, retain: bool, futures: list):
+        _count("published")
+        try:
+            info = self._client.publish(topic, payload, qos=qos, retain=retain)
+        except Exception as e:
+            # paho raises for an invalid topic or an oversized payload; release the topic's slot all the same
+            logger.warning(f"[mqtt] Publish to {topic} failed: {e}")
+            self._resolve(futures, False)
+            if qos > 0:
+                self._after_ack(topic, None)
+            return
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            logger.warning(f"[mqtt] Publish to {topic} failed: {mqtt.error_string(info.rc)}")
+            self._resolve(futures, False)
+            if qos > 0:
+                self._after_ack(topic, None)
+            return
+        if qos == 0:
+            # on_publish may already have fired (and been taken for an early PUBACK), or fires later
+            with self._lock:
+                if info.mid in self._early_acks:
+                    self._early_acks.discard(info.mid)
+                elif info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self._qos0_mids.add(info.mid)
+            self._resolve(futures, True)
+            return
+        with self._lock:
+            self._inflight_topics[topic] = info.mid
+            if info.mid in self._early_acks:
+                self._early_acks.discard(info.mid)
+                acked = True
+            else:
+                self._pending[info.mid] = (topic, futures)
+                acked = False
+        if acked:
+            self._resolve(futures, True)
+            self._after_ack(topic, info.mid)
+
+    def publish(self, topic: str, payload, qos: int = 1, retain: bool = False) -> Future:
+        """Queue a publish; the returned Future resolves to True once the broker acknowledged it."""
+        future = Future()
+        if self._closed:
+            self._resolve([future], False)
+            return future
+        if qos > 0:
+            with self._lock:
+                if topic in self._inflight_topics:
+                    queued = self._queued.get(topic)
+                    futures = queued[3] if queued else []
+                    if queued:
+                        _count("coalesced")
+                    futures.append(future)
+                    self._queued[topic] = (payload, qos, retain, futures)
+                    return future
+                self._inflight_topics[topic] = None
+        self._send(topic, payload, qos, retain, [future])
+        return future
+
+    def publish_sync(self, topic: str, payload, qos: int = 1, retain: bool = False, timeout: float = PUBLISH_TIMEOUT) -> bool:
+        try:
+            return self.publish(topic, payload, qos, retain).result(timeout=timeout)
+        except Exception:
+            logger.warning(f"[mqtt] No acknowledgement for {topic} from {self.host}:{self.port} within {timeout}s")
+            _count("failed")
+            return False
+
+    async def publish_async(self, topic: str, payload, qos: int = 1, retain: bool = False, timeout: float = PUBLISH_TIMEOUT) -> bool:
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self.publish(topic, payload, qos, retain)), timeout)
+        except Exception:
+            logger.warning(f"[mqtt] No acknowledgement for {topic} from {self.host}:{self.port} within {timeout}s")
+            _count("failed")
+            return False
+
+    def add_message_handler(self, handler):
+        """Call handler(topic, payload, retained) for every message received on this connection."""
+        self._message_handlers.append(handler)
+
+    def subscribe(self, topic: str, qos: int = 1):
+        """Subscribe now if connected, and again after every reconnect. Repeat calls are no-ops."""
+        with self._lock:
+            if topic in self._subscriptions:
+                return
+            self._subscriptions[topic] = qos
+        # While disconnected this fails with MQTT_ERR_NO_CONN; _on_connect subscribes then
+        self._client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic: str):
+        """Drop a subscription made with subscribe(); it is no longer renewed on reconnect."""
+        with self._lock:
+            if self._subscriptions.pop(topic, None) is None:
+                return
+        self._client.unsubscribe(topic)
+
+    def is_connected(self) -> bool:
+        return self._connected.is_set()
+
+    def close(self):
+        """Disconnect and stop the network thread; publishes still waiting resolve to False."""
+        self._closed = True
+        self._client.disconnect()
+        self._client.loop_stop()
+        with self._lock:
+            futures = [f for _, fs in self._pending.values() for f in fs]
+            futures += [f for *_, fs in self._queued.values() for f in fs]
+            self._pending.clear()
+            self._queued.clear()
+            self._inflight_topics.clear()
+        self._resolve(futures, False)
+
+
+_publishers = OrderedDict()   # (host, port, user, password) -> MQTTPublisher, least recently used first
+_publishers_lock = threading.Lock()
+_close_handlers = []
+_CONFIGURED = (MQTT_BROKER, MQTT_PORT, MQTT_USER, MQTT_PASS)
+
+
+def add_close_handler(handler):
+    """Call handler(publisher) when a pooled publisher is evicted and closed."""
+    _close_handlers.append(handler)
+
+
+def get_publisher(host: str = MQTT_BROKER, port: int = MQTT_PORT, user: str | None = MQTT_USER,
+                  password: str | None = MQTT_PASS) -> MQTTPublisher:
+    """
+    Shared publisher for this broker and credentials, connected on first use. The
+    configured broker's connection is kept for good; of the others (brokers named in
+    /control-device requests) at most MAX_PUBLISHERS stay open.
+    """
+    key = (host, int(port), user, password)
+    evicted = []
+    with _publishers_lock:
+        publisher = _publishers.get(key)
+        if publisher is None:
+            publisher = _publishers[key] = MQTTPublisher(host, int(port), user, password)
+        _publishers.move_to_end(key)
+        others = [k for k in _publishers if k != _CONFIGURED]
+        for old in others[:max(0, len(others) - MAX_PUBLISHERS)]:
+            evicted.append(_publishers.pop(old))
+    for old in evicted:
+        _count("evicted")
+        logger.info(f"[mqtt] Closing idle connection to {old.host}:{old.port}")
+        for handler in _close_handlers:
+            handler(old)
+        old.close()
+    return publisher
+
+
+def send_mqtt_command(command: str, topic: str = MQTT_TOPIC, broker: str = MQTT_BROKER, port: int = MQTT_PORT, user: str = MQTT_USER, password: str = MQTT_PASS) -> bool:
+    ok = get_publisher(broker, port, user, password).publish_sync(topic, command)
+    if ok:
+        print(f"[send_mqtt_command] Published '{command}' to {topic} at {broker}:{port}")
+    else:
+        print(f"[send_mqtt_command] MQTT publish failed: no acknowledgement from {broker}:{port}")
+    return ok
+
+
+async def send_mqtt_command_async(command: str, topic: str = MQTT_TOPIC, broker: str = MQTT_BROKER, port: int = MQTT_PORT, user: str = MQTT_USER, password: str = MQTT_PASS) -> bool:
+    ok = await get_publisher(broker, port, user, password).publish_async(topic, command)
+    if not ok:
+        logger.warning(f"[send_mqtt_command] MQTT publish failed: no acknowledgement from {broker}:{port}")
+    return ok
+
+
+def mqtt_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    with _publishers_lock:
+        stats["brokers"] = len(_publishers)
+        stats["brokers_connected"] = sum(1 for p in _publishers.values() if p.is_connected())
+    return stats
+
+
+register_stats_provider("mqtt", mqtt_stats)
@@ -0,0 +1,219 @@
+import asyncio
+import html
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from urllib.parse import quote
+from services.client_registry import get_http_session, async_request
+from services.metrics_service import register_stats_provider, record_latency
+
+logger = logging.getLogger(__name__)
+
+# How long a query's snippets are reused; results pages for the same question rarely change faster
+SEARCH_CACHE_TTL = 600
+SEARCH_CACHE_SIZE = 512
+SEARCH_HTTP_TIMEOUT = 5
+# How long a turn waits for web results before answering without them; the search keeps
+# running in the background and fills the cache for the next time the question comes up
+SEARCH_BUDGET_SECONDS = 1.5
+MAX_SNIPPETS = 3
+# DuckDuckGo's HTML endpoint; overridable to point at a local stand-in (see benchmarks/fake_upstreams.py)
+SEARCH_URL = os.environ.get("SEARCH_URL", "https://html.duckduckgo.com/html/")
+NO_RESULTS = "(No web summary found)"
+
+# DuckDuckGo's HTML results: <a rel="nofollow" class="result__a" href="...">Title <b>words</b></a>
+_RESULT_ANCHOR = re.compile(r'<a\b[^>]*\bclass="result__a"[^>]*>(.*?)</a>', re.DOTALL | re.IGNORECASE)
+_TAG = re.compile(r"<[^>]+>")
+_NON_WORD = re.compile(r"[^\w\s]")
+
+_search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="search")
+_background_fetches = set()
+
+
+def normalise_query(query: str) -> str:
+    """Cache key for a query: case, punctuation and spacing don't change the results we want."""
+    return " ".join(_NON_WORD.sub(" ", query.lower()).split())
+
+
+def parse_result_snippets(page: str, limit: int = MAX_SNIPPETS) -> list[str]:
+    """Text of the first `limit` result__a anchors, without building a DOM for the whole page."""
+    snippets = []
+    for match in _RESULT_ANCHOR.finditer(page):
+        snippet = " ".join(html.unescape(_TAG.sub("", match.group(1))).split())
+        if snippet:
+            snippets.append(snippet)
+            if len(snippets) == limit:
+                break
+    return snippets
+
+
+def _search_url(query: str) -> str:
+    # Use DuckDuckGo for scraping-friendly search
+    return f"{SEARCH_URL}?q={quote(query)}"
+
+
+class SearchCache:
+    """
+    TTL cache of normalised query -> summary, with concurrent lookups of the same query
+    sharing one fetch. Failed searches are not cached.
+    """
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, summary)
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "failures": 0, "budget_misses": 0}
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key: str, summary: str):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, summary)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def claim(self, key: str) -> tuple[str | None, Future, bool]:
+        """
+        (cached summary, None, False) on a hit; otherwise (None, future, owner) where the
+        owner must fetch and call finish(); other callers just wait on the future.
+        """
+        summary = self.get(key)
+        if summary is not None:
+            return summary, None, False
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                return None, future, False
+            future = self._inflight[key] = Future()
+            self._stats["misses"] += 1
+            return None, future, True
+
+    def finish(self, key: str, future: Future, summary: str, ok: bool):
+        if ok:
+            self.put(key, summary)
+        with self._lock:
+            self._inflight.pop(key, None)
+            if not ok:
+                self._stats["failures"] += 1
+        future.set_result(summary)
+
+    def count_budget_miss(self):
+        with self._lock:
+            self._stats["budget_misses"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
+
+
+search_cache = SearchCache()
+register_stats_provider("search_cache", search_cache.stats)
+
+
+class FailedSearch(str):
+    """Summary standing in for a search that failed; search_web_summary returns None for it."""
+
+
+def _summarise(page: str) -> str:
+    snippets = parse_result_snippets(page)
+    return " | ".join(snippets) if snippets else NO_RESULTS
+
+
+def _fetch_summary(query: str) -> tuple[str, bool]:
+    started = time.monotonic()
+    try:
+        resp = get_http_session().get(_search_url(query), timeout=SEARCH_HTTP_TIMEOUT, headers={"User-Agent": "Mozilla/5.0"})
+        return _summarise(resp.text), True
+    except Exception as e:
+        return FailedSearch(f"(Web search failed: {e})"), False
+    finally:
+        record_latency("web_search", (time.monotonic() - started) * 1000)
+
+
+async def _fetch_summary_async(query: str) -> tuple[str, bool]:
+    started = time.monotonic()
+    try:
+        resp = await async_request("GET", _search_url(query), timeout=SEARCH_HTTP_TIMEOUT, headers={"User-Agent": "Mozilla/5.0"})
+        return _summarise(resp.text), True
+    except Exception as e:
+        return FailedSearch(f"(Web search failed: {e})"), False
+    finally:
+        record_latency("web_search", (time.monotonic() - started) * 1000)
+
+
+def search_web_future(query: str) -> Future:
+    """Start (or join) a search for the query; the Future resolves to its summary."""
+    key = normalise_query(query)
+    summary, future, owner = search_cache.claim(key)
+    if summary is not None:
+        future = Future()
+        future.set_result(summary)
+        return future
+    if owner:
+        def fetch():
+            summary, ok = _fetch_summary(query)
+            search_cache.finish(key, future, summary, ok)
+        _search_pool.submit(fetch)
+    return future
+
+
+def search_web_summary(query: str, timeout: float | None = None) -> str | None:
+    """
+    Search the web for the query and return a short summary of the top results, or None
+    if the search failed. With `timeout`, also None if the results aren't ready in time
+    (the search carries on).
+    """
+    try:
+        summary = search_web_future(query).result(timeout=timeout)
+    except FutureTimeout:
+        search_cache.count_budget_miss()
+        logger.info(f"Web search for {query!r} missed the {timeout}s budget; answering without it.")
+        return None
+    return None if isinstance(summary, FailedSearch) else summary
+
+
+async def search_web_summary_async(query: str, timeout: float | None = None) -> str | None:
+    key = normalise_query(query)
+    summary, future, owner = search_cache.claim(key)
+    if summary is not None:
+        return summary
+    if owner:
+        async def fetch():
+            summary, ok = FailedSearch("(Web search failed: cancelled)"), False
+            try:
+                summary, ok = await _fetch_summary_async(query)
+            finally:
+                search_cache.finish(key, future, summary, ok)
+        # Owned by the cache entry, not the caller: it completes even if the caller stops waiting
+        task = asyncio.ensure_future(fetch())
+        _background_fetches.add(task)
+        task.add_done_callback(_background_fetches.discard)
+    try:
+        summary = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+    except asyncio.TimeoutError:
+        search_cache.count_budget_miss()
+        logger.info(f"Web search for {query!r} missed the {timeout}s budget; answering without it.")
+        return None
+    return None if isinstance(summary, FailedSearch) else summary
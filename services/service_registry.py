@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import time
+from services.metrics_service import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Backends the start-up warm-up thread builds, comma-separated ("none" for none). The rest are built on first use
+WARMUP_SERVICES = os.environ.get("WARMUP_SERVICES", "gemini,gemini_client,assemblyai_streaming,http,tts_cache")
+
+
+class ServiceRegistry:
+    """
+    Process-wide backends (SDK modules, shared clients, caches), each built once by its
+    factory: on first use, or ahead of it by warm_up() on a background thread. A caller
+    that needs a backend while it is being built waits for that build rather than
+    starting its own. A factory that raises is retried by the next get().
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._locks = {}
+        self._build_ms = {}
+        self._failures = {}
+        self._warmup = None
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory):
+        with self._lock:
+            self._factories[name] = factory
+            self._locks[name] = threading.Lock()
+
+    def get(self, name: str):
+        instance = self._instances.get(name, _MISSING)
+        if instance is not _MISSING:
+            return instance
+        with self._locks[name]:
+            if name in self._instances:
+                return self._instances[name]
+            started = time.monotonic()
+            try:
+                instance = self._factories[name]()
+            except Exception:
+                self._failures[name] = self._failures.get(name, 0) + 1
+                raise
+            self._build_ms[name] = round((time.monotonic() - started) * 1000, 1)
+            self._instances[name] = instance
+        logger.info(f"Service {name} ready in {self._build_ms[name]:.0f} ms ({threading.current_thread().name}).")
+        return instance
+
+    def warm_up(self, names: str = WARMUP_SERVICES) -> threading.Thread | None:
+        """Build the named backends on a background thread; once per process, later calls are no-ops."""
+        with self._lock:
+            if self._warmup is not None:
+                return self._warmup
+            wanted = [name.strip() for name in names.split(",") if name.strip() and name.strip() != "none"]
+            unknown = [name for name in wanted if name not in self._factories]
+            if unknown:
+                logger.warning(f"Unknown WARMUP_SERVICES {unknown}; known: {sorted(self._factories)}")
+            wanted = [name for name in wanted if name in self._factories]
+            if not wanted:
+                return None
+
+            def run():
+                for name in wanted:
+                    try:
+                        self.get(name)
+                    except Exception as e:
+                        logger.warning(f"Warm-up of {name} failed: {e}")
+
+            self._warmup = threading.Thread(target=run, name="warm-up", daemon=True)
+        self._warmup.start()
+        return self._warmup
+
+    def stats(self) -> dict:
+        return {"ready": sorted(self._instances), "build_ms": dict(self._build_ms), "failures": dict(self._failures)}
+
+
+service_registry = ServiceRegistry()
+register_stats_provider("services", service_registry.stats)
+
+
+def _gemini():
+    from google import genai
+    from google.genai import types  # noqa: F401 (request configs use genai.types)
+    return genai
+
+
+def _gemini_client():
+    # Browsers that fill their keys from the server's .env send this one, so its client is ready for them
+    from services.client_registry import get_gemini_client
+    key = os.getenv("GEMINI_API_KEY")
+    return get_gemini_client(key) if key else None
+
+
+def _openai():
+    import openai
+    return openai
+
+
+def _assemblyai():
+    import assemblyai
+    return assemblyai
+
+
+def _assemblyai_streaming():
+    import assemblyai.streaming.v3
+    from assemblyai.streaming.v3 import models  # noqa: F401 (ForceEndpoint)
+    return assemblyai.streaming.v3
+
+
+def _http():
+    from services.client_registry import get_http_session
+    return get_http_session()
+
+
+def _tts_cache():
+    from services.tts_service import prewarm_tts_cache
+    return prewarm_tts_cache(os.getenv("MURF_API_KEY"))
+
+
+def _mqtt():
+    from services.device_shadow import get_shadow
+    return get_shadow()
+
+
+service_registry.register("gemini", _gemini)
+service_registry.register("gemini_client", _gemini_client)
+service_registry.register("openai", _openai)
+service_registry.register("assemblyai", _assemblyai)
+service_registry.register("assemblyai_streaming", _assemblyai_streaming)
+service_registry.register("http", _http)
+service_registry.register("tts_cache", _tts_cache)
+service_registry.register("mqtt", _mqtt)
@@ -0,0 +1,584 @@
+import asyncio
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+from services.admission import Overloaded
+from services.audio_frames import pack_audio_frame
+from services.audio_gate import AudioGate
+from services.conversation_memory import ConversationMemory
+from services.session_store import (decode_state, new_session_id, prefetch_session_state, save_session_state,
+                                    valid_session_id, STORE_TIMEOUT_SECONDS)
+from services.intent_router import route_intent
+from services.speculation import (SPECULATION_STABLE_MS, TIMERS, AsyncSpeculation, Speculation, is_speculable,
+                                  normalise_transcript)
+from services.tracing import TurnTrace, span
+from services.turn_service import (llm_path, process_turn, process_turn_async, speculative_reply,
+                                   speculative_reply_async)
+from services.tts_backends import negotiate_audio_format
+from services.uplink_audio import UplinkDecoder, negotiate_uplink
+
+logger = logging.getLogger(__name__)
+
+PERSONA = {
+    "role": "system",
+    "content": (
+        "You are Buzz Lightyear. If asked your name or who you are, always reply 'I am Buzz Lightyear.' "
+        "Keep your responses short, direct, and helpful, like a personal assistant. Avoid long role-played speeches."
+    )
+}
+
+
+# Session options and their defaults; parse_session_config fills them from the client's first message
+DEFAULT_OPTIONS = {"multi_turn": False, "streaming": False, "binary_audio": False, "vad": True, "debug_timings": False,
+                   "speculative": False, "audio_formats": None, "uplink_codecs": None, "uplink_sample_rate": None,
+                   "session_id": None, "resumable": False}
+
+
+def parse_session_config(first_msg) -> tuple[dict, dict]:
+    """Parse the first WebSocket message into (api_keys, options)."""
+    api_keys = {"assembly": None, "gemini": None, "murf": None, "openai": None}
+    options = dict(DEFAULT_OPTIONS)
+    try:
+        keys = json.loads(first_msg)
+        api_keys["assembly"] = keys.get("assemblyKey")
+        api_keys["gemini"] = keys.get("geminiKey")
+        api_keys["murf"] = keys.get("murfKey")
+        api_keys["openai"] = keys.get("openaiKey")
+        options["multi_turn"] = bool(keys.get("multiTurn"))
+        options["streaming"] = bool(keys.get("streamingReplies"))
+        options["binary_audio"] = bool(keys.get("binaryAudio"))
+        options["vad"] = bool(keys.get("serverVad", True))
+        options["debug_timings"] = bool(keys.get("debugTimings"))
+        options["speculative"] = bool(keys.get("speculativeReplies"))
+        if isinstance(keys.get("audioFormats"), list):
+            options["audio_formats"] = keys["audioFormats"]
+        if isinstance(keys.get("uplinkCodecs"), list):
+            options["uplink_codecs"] = keys["uplinkCodecs"]
+            options["uplink_sample_rate"] = keys.get("uplinkSampleRate")
+        # Clients that send a sessionId (null for a new conversation) can resume on reconnect
+        if "sessionId" in keys:
+            options["resumable"] = True
+            options["session_id"] = keys["sessionId"]
+    except Exception:
+        api_keys = {"assembly": "none", "gemini": "none", "murf": "none", "openai": "none"}
+    return api_keys, options
+
+
+class BaseVoiceSession:
+    """
+    State for one voice WebSocket connection, shared by the threaded and asyncio runtimes.
+    `options` are the client's choices (see DEFAULT_OPTIONS and parse_session_config);
+    the README's Performance Optimization section describes each.
+    """
+
+    def __init__(self, api_keys: dict, options: dict | None = None):
+        options = {**DEFAULT_OPTIONS, **(options or {})}
+        self.api_keys = api_keys
+        self.multi_turn = options["multi_turn"]
+        self.streaming = options["streaming"]
+        self.binary_audio = options["binary_audio"]
+        self.debug_timings = options["debug_timings"]
+        self.speculative = options["speculative"]
+        self.audio_format = negotiate_audio_format(options["audio_formats"])
+        # Decodes inbound audio to 16 kHz PCM16; only clients that asked hear which codec was picked
+        self.uplink = UplinkDecoder(*negotiate_uplink(options["uplink_codecs"], options["uplink_sample_rate"]))
+        self.uplink_negotiated = options["uplink_codecs"] is not None
+        # Latest partial transcript (normalised), its stability timer and the speculation on it
+        self._partial_key = None
+        self._partial_timer = None
+        self._speculation = None
+        self._speculation_closed = False
+        self._speculation_lock = threading.Lock()
+        # History of a resumed conversation is fetched in the background now and decoded on first use.
+        # Only ids the server issued are resumed: one that isn't in the store is replaced then
+        self.resumable = resumable = options["resumable"]
+        session_id = options["session_id"]
+        self.session_id = session_id if resumable and valid_session_id(session_id) else new_session_id()
+        self._stored_state = prefetch_session_state(self.session_id) if self.session_id == session_id else None
+        self._memory = None
+        # Inbound audio passes through a VAD gate before reaching the STT client (see relay_audio)
+        self.audio_gate = AudioGate() if options["vad"] else None
+        self.turn_count = 0
+        self._last_turn_order = -1
+        self._last_turn_at = 0.0
+
+    @property
+    def memory(self) -> ConversationMemory:
+        if self._memory is None:
+            self._memory = self._restore_memory()
+        return self._memory
+
+    def memory_ready(self) -> bool:
+        """False while a resumed conversation's history is still being fetched, i.e. reading `memory` would block."""
+        stored = self._stored_state
+        return self._memory is not None or stored is None or stored.done()
+
+    def _restore_memory(self) -> ConversationMemory:
+        if self._stored_state is not None:
+            try:
+                blob = self._stored_state.result(timeout=STORE_TIMEOUT_SECONDS)
+                state = decode_state(blob) if blob is not None else None
+                if state is not None:
+                    memory = ConversationMemory.from_state(PERSONA, state["memory"])
+                    logger.info(f"Resumed session {self.session_id[:6]}... with {len(memory)} messages")
+                    return memory
+                logger.info(f"Session {self.session_id[:6]}... not in the store; issuing a new id")
+            except Exception as e:
+                logger.warning(f"Session {self.session_id[:6]}... not resumed: {e}")
+            finally:
+                self._stored_state = None
+            # A client-chosen or expired id is never written to: the conversation goes on under a fresh one
+            self.session_id = new_session_id()
+            self.post(self.session_message())
+        return ConversationMemory(PERSONA)
+
+    def session_message(self) -> dict:
+        return {"type": "session", "session_id": self.session_id}
+
+    def _saved_state(self) -> dict | None:
+        """State to persist after a turn; None when there is nothing to save."""
+        if not self.resumable or self._memory is None:
+            return None
+        return {"memory": self._memory.to_state()}
+
+    def _close_audio_gate(self):
+        gate, self.audio_gate = self.audio_gate, None
+        if gate is not None:
+            gate.close()
+
+    def accepts_turns(self) -> bool:
+        return self.multi_turn or self.turn_count == 0
+
+    def is_new_turn(self, turn_order: int) -> bool:
+        """True for STT turns not yet answered (formatted repeats share the turn_order)."""
+        return turn_order > self._last_turn_order
+
+    def _claim_turn(self, turn_order: int) -> int | None:
+        if not self.accepts_turns() or not self.is_new_turn(turn_order):
+            return None
+        self._last_turn_order = turn_order
+        self.turn_count += 1
+        return self.turn_count
+
+    def _new_trace(self, turn_id: int, started_at: float) -> TurnTrace:
+        """Trace for a claimed turn, starting with how long STT took to finalise it."""
+        trace = TurnTrace(turn_id, started_at)
+        # From the end of the user's speech (as seen by the VAD gate) to the final transcript.
+        # close() on another thread may clear the gate, so it is read once
+        gate = self.audio_gate
+        speech_ended_at = gate.last_speech_at if gate is not None else None
+        if speech_ended_at is not None and self._last_turn_at < speech_ended_at < started_at:
+            trace.add("stt_finalise", (started_at - speech_ended_at) * 1000)
+        self._last_turn_at = started_at
+        return trace
+
+    def _on_partial(self, transcript: str, turn_order: int):
+        """Restart the stability timer whenever the partial transcript changes."""
+        key = normalise_transcript(transcript)
+        with self._speculation_lock:
+            if key == self._partial_key or self._speculation_closed:
+                return
+            self._partial_key = key
+            if self._partial_timer is not None:
+                self._partial_timer.cancel()
+            speculation = self._speculation
+            if speculation is not None:
+                self._speculation = None
+                speculation.discard()
+            self._partial_timer = self._call_later(SPECULATION_STABLE_MS / 1000, self._speculate,
+                                                   transcript, key, turn_order)
+
+    def _speculate(self, transcript: str, key: str, turn_order: int):
+        """The partial has been stable for the window: route it and start its reply."""
+        with self._speculation_lock:
+            if (key != self._partial_key or self._speculation is not None or not self.accepts_turns()
+                    or not self.is_new_turn(turn_order) or self.is_answering()):
+                return
+            # Words can sit unchanged while the user is still mid-sentence; with VAD, also
+            # wait until they have been quiet for the same window
+            window = SPECULATION_STABLE_MS / 1000
+            gate = self.audio_gate
+            speech_at = gate.last_speech_at if gate is not None else None
+            quiet = time.monotonic() - speech_at if speech_at is not None else window
+            if quiet < window:
+                self._partial_timer = self._call_later(window - quiet, self._speculate, transcript, key, turn_order)
+                return
+            # Timers of every session share this thread (or the event loop): never wait on the store here
+            if not self.memory_ready():
+                self._partial_timer = self._call_later(window, self._speculate, transcript, key, turn_order)
+                return
+            intent = route_intent(transcript)
+            if is_speculable(intent):
+                self._speculation = self._start_speculation(transcript, intent)
+
+    def _take_speculation(self, transcript: str):
+        """The speculation for a turn that just ended, if it was on the same words (else it is dropped)."""
+        with self._speculation_lock:
+            speculation, self._speculation = self._speculation, None
+            self._partial_key = None
+            if self._partial_timer is not None:
+                self._partial_timer.cancel()
+                self._partial_timer = None
+        if speculation is None:
+            return None
+        if not speculation.matches(transcript):
+            speculation.miss()
+            return None
+        return speculation
+
+    def _close_speculation(self):
+        with self._speculation_lock:
+            self._speculation_closed = True
+            if self._partial_timer is not None:
+                self._partial_timer.cancel()
+            if self._speculation is not None:
+                self._speculation.cancel()
+            self._partial_timer = self._speculation = None
+
+    def on_stt_turn(self, event):
+        """AssemblyAI Turn callback; runs on the STT client's reader thread."""
+        logger.info(f"[WS] {event.transcript} (end_of_turn={event.end_of_turn})")
+        # New speech while an answer is in flight aborts it (barge-in)
+        if event.transcript.strip() and self.is_new_turn(event.turn_order) and self.is_answering():
+            self.barge_in()
+        # Always send partial transcript for live update
+        self.post({
+            "type": "partial",
+            "transcript": event.transcript
+        })
+        # Hand finished turns to the session worker so audio keeps streaming meanwhile
+        if event.end_of_turn and event.transcript.strip():
+            self.submit_turn(event.transcript, event.turn_order)
+        elif self.speculative and event.transcript.strip() and self.is_new_turn(event.turn_order):
+            self.track_partial(event.transcript, event.turn_order)
+
+
+class VoiceSession(BaseVoiceSession):
+    """
+    Threaded session: finished turns are queued to a worker thread so the STT callback
+    thread keeps receiving audio while the previous turn is answered.
+    """
+
+    def __init__(self, send_fn, api_keys: dict, options: dict | None = None):
+        super().__init__(api_keys, options)
+        self._send_fn = send_fn
+        self._send_lock = threading.Lock()
+        self._turns = queue.Queue()
+        self._cancel = None
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="voice-turn-worker", daemon=True)
+        self._worker.start()
+
+    def send(self, message: dict) -> bool:
+        """Send a JSON message to the client; safe to call from any thread."""
+        if self._closed.is_set():
+            return False
+        with self._send_lock, span("socket_send"):
+            try:
+                self._send_fn(json.dumps(message))
+                return True
+            except Exception as e:
+                logger.warning(f"WebSocket send ({message.get('type')}) failed: {e}")
+                return False
+
+    def send_bytes(self, frame: bytes) -> bool:
+        if self._closed.is_set():
+            return False
+        with self._send_lock, span("socket_send"):
+            try:
+                self._send_fn(frame)
+                return True
+            except Exception as e:
+                logger.warning(f"WebSocket send (binary audio) failed: {e}")
+                return False
+
+    def send_audio(self, turn_id: int, seq: int, chunks, mime: str = "audio/mpeg", cancel=None, on_first=None) -> int:
+        """
+        Send one audio clip to the client and return the number of audio bytes sent.
+        Binary clients get each chunk as a frame as soon as it is read from `chunks`;
+        base64 clients get the whole clip in a single audio_chunk message.
+        """
+        if not self.binary_audio:
+            audio = b"".join(chunks)
+            if not audio or (cancel is not None and cancel.is_set()):
+                return 0
+            if on_first is not None:
+                on_first()
+            self.send({
+                "type": "audio_chunk",
+                "audio_b64": base64.b64encode(audio).decode("utf-8"),
+                "audio_mime": mime,
+                "turn": turn_id,
+                "seq": seq
+            })
+            return len(audio)
+        sent = 0
+        previous = None
+        # Hold back one chunk so the clip's last frame can carry the FIN flag
+        for chunk in chunks:
+            if cancel is not None and cancel.is_set():
+                close = getattr(chunks, "close", None)
+                if close is not None:
+                    close()
+                return sent
+            if not chunk:
+                continue
+            if previous is not None:
+                if sent == 0 and on_first is not None:
+                    on_first()
+                if not self.send_bytes(pack_audio_frame(turn_id, seq, mime, previous)):
+                    return sent
+                sent += len(previous)
+            previous = chunk
+        if previous is not None:
+            if sent == 0 and on_first is not None:
+                on_first()
+            if self.send_bytes(pack_audio_frame(turn_id, seq, mime, previous, fin=True)):
+                sent += len(previous)
+        return sent
+
+    post = send
+    track_partial = BaseVoiceSession._on_partial
+
+    def _call_later(self, delay: float, fn, *args):
+        return TIMERS.call_later(delay, fn, *args)
+
+    def _start_speculation(self, transcript: str, intent):
+        memory = self.memory.with_message("user", transcript)
+        return Speculation(transcript, intent, self.memory.revision, lambda: speculative_reply(
+            llm_path(intent), transcript, memory, self.api_keys["gemini"], self.streaming))
+
+    def submit_turn(self, transcript: str, turn_order: int) -> int | None:
+        """
+        Announce a finished turn to the client and queue it for the worker.
+        Returns the turn id, or None if the turn was a duplicate or not accepted.
+        """
+        if self._closed.is_set():
+            return None
+        turn_id = self._claim_turn(turn_order)
+        if turn_id is None:
+            return None
+        trace = self._new_trace(turn_id, time.monotonic())
+        speculation = self._take_speculation(transcript)
+        self.send({"type": "end_of_turn", "transcript": transcript, "turn": turn_id})
+        self._turns.put((turn_id, transcript, threading.Event(), trace, speculation))
+        return turn_id
+
+    def barge_in(self) -> bool:
+        """Abort the answer currently in flight, if any (the user started talking again)."""
+        cancel = self._cancel
+        if cancel is None or cancel.is_set():
+            return False
+        cancel.set()
+        logger.info("Barge-in: cancelling in-flight answer.")
+        self.send({"type": "barge_in"})
+        return True
+
+    def is_answering(self) -> bool:
+        cancel = self._cancel
+        return cancel is not None and not cancel.is_set()
+
+    def close(self):
+        if self._cancel is not None:
+            self._cancel.set()
+        self._close_audio_gate()
+        self.uplink.close()
+        self._close_speculation()
+        self._closed.set()
+        self._turns.put(None)
+
+    def _run(self):
+        while True:
+            item = self._turns.get()
+            if item is None:
+                return
+            turn_id, transcript, cancel, trace, speculation = item
+            if self._closed.is_set():
+                return
+            if speculation is not None and not speculation.confirm(self.memory, trace.started_at):
+                speculation = None
+            self._cancel = cancel
+            failed = False
+            try:
+                with trace:
+                    process_turn(self, turn_id, transcript, cancel, trace.started_at, speculation)
+            except Overloaded as e:
+                failed = True
+                logger.warning(f"Turn {turn_id} shed: {e}")
+                self.send(e.as_message(turn_id))
+            except Exception as e:
+                failed = True
+                logger.error(f"Turn {turn_id} failed: {e}")
+            finally:
+                trace.finish(cancelled=failed or cancel.is_set())
+                cancel.set()
+                self._cancel = None
+            if self.debug_timings:
+                self.send(trace.as_message())
+            state = self._saved_state()
+            if state is not None:
+                save_session_state(self.session_id, state)
+
+
+class AsyncVoiceSession(BaseVoiceSession):
+    """
+    Asyncio session for the ASGI runtime. Turns run as tasks on the event loop, so
+    barge-in simply cancels the task. Methods called from the STT reader thread
+    (post, submit_turn, barge_in) hop onto the loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, websocket, loop, api_keys: dict, options: dict | None = None):
+        super().__init__(api_keys, options)
+        self._ws = websocket
+        self._loop = loop
+        self._send_lock = asyncio.Lock()
+        self._turns = asyncio.Queue()
+        self._task = None
+        self._closed = False
+
+    async def send(self, message: dict) -> bool:
+        if self._closed:
+            return False
+        async with self._send_lock:
+            try:
+                with span("socket_send"):
+                    await self._ws.send_text(json.dumps(message))
+                return True
+            except Exception as e:
+                logger.warning(f"WebSocket send ({message.get('type')}) failed: {e}")
+                return False
+
+    async def send_bytes(self, frame: bytes) -> bool:
+        if self._closed:
+            return False
+        async with self._send_lock:
+            try:
+                with span("socket_send"):
+                    await self._ws.send_bytes(frame)
+                return True
+            except Exception as e:
+                logger.warning(f"WebSocket send (binary audio) failed: {e}")
+                return False
+
+    async def send_audio(self, turn_id: int, seq: int, chunks, mime: str = "audio/mpeg", on_first=None) -> int:
+        """Async counterpart of VoiceSession.send_audio; `chunks` is an async iterator."""
+        if not self.binary_audio:
+            audio = b"".join([chunk async for chunk in chunks])
+            if not audio:
+                return 0
+            if on_first is not None:
+                on_first()
+            await self.send({
+                "type": "audio_chunk",
+                "audio_b64": base64.b64encode(audio).decode("utf-8"),
+                "audio_mime": mime,
+                "turn": turn_id,
+                "seq": seq
+            })
+            return len(audio)
+        sent = 0
+        previous = None
+        # Hold back one chunk so the clip's last frame can carry the FIN flag
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            if previous is not None:
+                if sent == 0 and on_first is not None:
+                    on_first()
+                if not await self.send_bytes(pack_audio_frame(turn_id, seq, mime, previous)):
+                    return sent
+                sent += len(previous)
+            previous = chunk
+        if previous is not None:
+            if sent == 0 and on_first is not None:
+                on_first()
+            if await self.send_bytes(pack_audio_frame(turn_id, seq, mime, previous, fin=True)):
+                sent += len(previous)
+        return sent
+
+    def post(self, message: dict):
+        self._loop.call_soon_threadsafe(lambda: self._loop.create_task(self.send(message)))
+
+    def track_partial(self, transcript: str, turn_order: int):
+        self._loop.call_soon_threadsafe(self._on_partial, transcript, turn_order)
+
+    def _call_later(self, delay: float, fn, *args):
+        return self._loop.call_later(delay, fn, *args)
+
+    def _start_speculation(self, transcript: str, intent):
+        memory = self.memory.with_message("user", transcript)
+        return AsyncSpeculation(transcript, intent, self.memory.revision, speculative_reply_async(
+            llm_path(intent), transcript, memory, self.api_keys["gemini"], self.streaming))
+
+    def submit_turn(self, transcript: str, turn_order: int):
+        started_at = time.monotonic()
+        self._loop.call_soon_threadsafe(self._submit_turn, transcript, turn_order, started_at)
+
+    def _submit_turn(self, transcript: str, turn_order: int, started_at: float):
+        if self._closed:
+            return
+        turn_id = self._claim_turn(turn_order)
+        if turn_id is None:
+            return
+        trace = self._new_trace(turn_id, started_at)
+        speculation = self._take_speculation(transcript)
+        self._loop.create_task(self.send({"type": "end_of_turn", "transcript": transcript, "turn": turn_id}))
+        self._turns.put_nowait((turn_id, transcript, trace, speculation))
+
+    def is_answering(self) -> bool:
+        task = self._task
+        return task is not None and not task.done()
+
+    def barge_in(self):
+        self._loop.call_soon_threadsafe(self._barge_in)
+
+    def _barge_in(self):
+        if not self.is_answering():
+            return
+        self._task.cancel()
+        logger.info("Barge-in: cancelling in-flight answer.")
+        self._loop.create_task(self.send({"type": "barge_in"}))
+
+    async def run(self):
+        """Answer queued turns one at a time until the session closes."""
+        while not self._closed:
+            turn_id, transcript, trace, speculation = await self._turns.get()
+            if not self.memory_ready():
+                # The resumed history is still being fetched; wait for it off the event loop
+                await asyncio.to_thread(lambda: self.memory)
+            if speculation is not None and not speculation.confirm(self.memory, trace.started_at):
+                speculation = None
+            # The task copies the current context, so the trace is current inside the turn only
+            with trace:
+                task = self._task = asyncio.create_task(
+                    process_turn_async(self, turn_id, transcript, trace.started_at, speculation))
+            try:
+                # wait() rather than await: a barge-in cancels the turn, not this loop
+                await asyncio.wait({task})
+            finally:
+                self._task = None
+            error = None if task.cancelled() else task.exception()
+            failed = error is not None
+            if isinstance(error, Overloaded):
+                logger.warning(f"Turn {turn_id} shed: {error}")
+                await self.send(error.as_message(turn_id))
+            elif failed:
+                logger.error(f"Turn {turn_id} failed: {error}")
+            trace.finish(cancelled=failed or task.cancelled())
+            if self.debug_timings:
+                await self.send(trace.as_message())
+            state = self._saved_state()
+            if state is not None:
+                # Encoding and the store round trip stay off the event loop
+                await asyncio.to_thread(save_session_state, self.session_id, state)
+
+    def close(self):
+        self._closed = True
+        self._close_audio_gate()
+        self.uplink.close()
+        self._close_speculation()
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+from services.metrics_service import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+# Where conversation state lives between connections: unset (or "memory") keeps it in this
+# process; redis://[:password@]host:port/db shares it between workers and nodes (Redis, or
+# anything speaking its protocol such as benchmarks/session_store_server.py)
+SESSION_STORE_URL = os.environ.get("SESSION_STORE_URL", "memory")
+# A conversation can be resumed for this long after its last turn
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 3600))
+# The in-process store drops its least recently used sessions past this many
+MAX_LOCAL_SESSIONS = 10000
+# Seconds to wait for the networked store; a slow store costs a resume, never a turn
+STORE_TIMEOUT_SECONDS = float(os.environ.get("SESSION_STORE_TIMEOUT_SECONDS", 1.0))
+STORE_POOL_SIZE = 8
+# Threads that fetch resumed sessions' state from the networked store in the background
+PREFETCH_WORKERS = 4
+KEY_PREFIX = "voice-session:"
+# Version of the persisted state layout
+STATE_VERSION = 1
+
+# The shape of new_session_id()'s ids; whether one was issued is settled by the store
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{22}$")
+
+_counters = {"loads": 0, "resumed": 0, "saves": 0, "errors": 0, "bytes_saved": 0, "load_ms": 0.0, "save_ms": 0.0}
+_counters_lock = threading.Lock()
+
+
+def _count(**changes):
+    with _counters_lock:
+        for name, n in changes.items():
+            _counters[name] += n
+
+
+class SessionStoreError(Exception):
+    pass
+
+
+def new_session_id() -> str:
+    return secrets.token_urlsafe(16)
+
+
+def valid_session_id(session_id) -> bool:
+    return isinstance(session_id, str) and bool(_SESSION_ID.match(session_id))
+
+
+def encode_state(state: dict) -> bytes:
+    """Compact wire form of a session's state: compressed JSON."""
+    return zlib.compress(json.dumps({"v": STATE_VERSION, **state}, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_state(blob: bytes) -> dict | None:
+    state = json.loads(zlib.decompress(blob))
+    return state if state.get("v") == STATE_VERSION else None
+
+
+class MemorySessionStore:
+    """Sessions kept in this process: a reconnect resumes only if it lands on the same worker."""
+
+    name = "memory"
+
+    def __init__(self, ttl: int = SESSION_TTL_SECONDS, max_sessions: int = MAX_LOCAL_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()   # session id -> (expires at, encoded state)
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> bytes | None:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return entry[1]
+
+    def set(self, session_id: str, blob: bytes):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._sessions[session_id] = (time.monotonic() + self.ttl, blob)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions)}
+
+
+class RedisSessionStore:
+    """
+    Sessions in a Redis-protocol server, shared by every worker process and node, so a
+    reconnecting client resumes wherever the load balancer sends it. Speaks just GET and
+    SET with EX (RESP2) over a small pool of blocking sockets, one command in flight
+    per socket; a broken connection is replaced and the command retried once.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl: int = SESSION_TTL_SECONDS, timeout: float = STORE_TIMEOUT_SECONDS,
+                 pool_size: int = STORE_POOL_SIZE):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self.ttl = ttl
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self.connections_opened = 0
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile("rb"))
+        self.connections_opened += 1
+        if self.password:
+            self._command(conn, "AUTH", self.password)
+        if self.db:
+            self._command(conn, "SELECT", str(self.db))
+        return conn
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    @classmethod
+    def _read_reply(cls, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("session store closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise SessionStoreError(rest.decode(errors="replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = reader.read(n + 2)
+            if len(data) != n + 2:
+                raise ConnectionError("session store closed the connection")
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [cls._read_reply(reader) for _ in range(n)]
+        raise SessionStoreError(f"unexpected reply {line[:40]!r}")
+
+    def _command(self, conn, *args):
+        conn[0].sendall(self._encode(*args))
+        return self._read_reply(conn[1])
+
+    def _call(self, *args):
+        for attempt in range(2):
+            try:
+                conn = self._pool.get_nowait()
+                reused = True
+            except queue.Empty:
+                try:
+                    conn = self._connect()
+                except OSError as e:
+                    raise SessionStoreError(f"session store unreachable: {e}") from e
+                reused = False
+            try:
+                reply = self._command(conn, *args)
+            except (OSError, ConnectionError) as e:
+                self._close(conn)
+                # Only a pooled connection may have gone stale; a fresh one failing is real
+                if reused and attempt == 0:
+                    continue
+                raise SessionStoreError(f"session store unreachable: {e}") from e
+            except SessionStoreError:
+                self._release(conn)
+                raise
+            self._release(conn)
+            return reply
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn[1].close()
+            conn[0].close()
+        except OSError:
+            pass
+
+    def get(self, session_id: str) -> bytes | None:
+        return self._call("GET", KEY_PREFIX + session_id)
+
+    def set(self, session_id: str, blob: bytes):
+        self._call("SET", KEY_PREFIX + session_id, blob, "EX", self.ttl)
+
+    def stats(self) -> dict:
+        return {"url": f"redis://{self.host}:{self.port}/{self.db}", "connections_opened": self.connections_opened,
+                "pooled_connections": self._pool.qsize()}
+
+
+def _create_store(url: str = SESSION_STORE_URL):
+    if url in ("", "memory"):
+        return MemorySessionStore()
+    if url.startswith("redis://"):
+        return RedisSessionStore(url)
+    raise ValueError(f"unsupported SESSION_STORE_URL {url!r}")
+
+
+session_store = _create_store()
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def load_session_state(session_id: str) -> bytes | None:
+    """A session's encoded state, or None when it is unknown, expired or the store is unavailable."""
+    started = time.perf_counter()
+    try:
+        blob = session_store.get(session_id)
+    except Exception as e:
+        logger.warning(f"Session store load failed: {e}")
+        _count(errors=1)
+        return None
+    _count(loads=1, resumed=int(blob is not None), load_ms=(time.perf_counter() - started) * 1000)
+    return blob
+
+
+def prefetch_session_state(session_id: str) -> Future:
+    """
+    Start loading a session's encoded state so it is there by the first turn; the
+    in-process store answers at once, the networked one on a background thread.
+    """
+    global _prefetcher
+    if isinstance(session_store, MemorySessionStore):
+        future = Future()
+        future.set_result(load_session_state(session_id))
+        return future
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = ThreadPoolExecutor(PREFETCH_WORKERS, thread_name_prefix="session-store")
+    return _prefetcher.submit(load_session_state, session_id)
+
+
+def save_session_state(session_id: str, state: dict) -> bool:
+    started = time.perf_counter()
+    try:
+        blob = encode_state(state)
+        session_store.set(session_id, blob)
+    except Exception as e:
+        logger.warning(f"Session store save failed: {e}")
+        _count(errors=1)
+        return False
+    _count(saves=1, bytes_saved=len(blob), save_ms=(time.perf_counter() - started) * 1000)
+    return True
+
+
+def session_store_stats() -> dict:
+    with _counters_lock:
+        stats = {k: round(v, 1) if isinstance(v, float) else v for k, v in _counters.items()}
+    stats["backend"] = session_store.name
+    stats["avg_state_bytes"] = round(stats["bytes_saved"] / stats["saves"]) if stats["saves"] else None
+    stats["avg_load_ms"] = round(stats["load_ms"] / stats["loads"], 2) if stats["loads"] else None
+    stats["avg_save_ms"] = round(stats["save_ms"] / stats["saves"], 2) if stats["saves"] else None
+    stats.update(session_store.stats())
+    return stats
+
+
+register_stats_provider("session_store", session_store_stats)
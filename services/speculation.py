@@ -0,0 +1,282 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+from services.admission import Overloaded
+from services.metrics_service import record_latency, register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+# Speculative replies: once a partial transcript has stayed the same for
+# SPECULATION_STABLE_MS, the turn is routed and its LLM reply started right away (no
+# TTS, nothing sent). If the final transcript says the same thing the reply is used as
+# it stands, having had a head start of however long STT took to finalise; otherwise
+# it is cancelled and discarded. Only LLM-answered intents are speculated on, never
+# device or browser actions.
+
+SPECULATION_STABLE_MS = int(os.environ.get("SPECULATION_STABLE_MS", 300))
+# Intents with side effects, or answered without the LLM; these only ever run on the final transcript
+ACTION_INTENTS = ("device_control", "device_state", "open_site", "web_search", "image")
+
+_PUNCTUATION = re.compile(r"[^\w\s']+")
+
+_stats = {"started": 0, "hits": 0, "misses": 0, "discarded": 0, "skipped": 0, "saved_ms_total": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, n: float = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def normalise_transcript(text: str) -> str:
+    """Compare transcripts ignoring case and punctuation (finals are formatted, partials aren't)."""
+    return " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+
+
+def is_speculable(intent) -> bool:
+    """Whether a turn with this intent may be answered ahead of its final transcript."""
+    if intent.name in ACTION_INTENTS:
+        _count("skipped")
+        return False
+    return True
+
+
+def speculation_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["saved_ms_total"] = round(stats["saved_ms_total"], 1)
+    stats["hit_rate"] = round(stats["hits"] / stats["started"], 3) if stats["started"] else None
+    stats["stable_ms"] = SPECULATION_STABLE_MS
+    return stats
+
+
+register_stats_provider("speculation", speculation_stats)
+
+
+class BaseSpeculation:
+    """A reply started from a stable partial transcript; its output is buffered until the turn ends."""
+
+    def __init__(self, text: str, intent, revision: int):
+        self.text = text
+        self.key = normalise_transcript(text)
+        self.intent = intent
+        # History revision the prompt was built from; any change since makes it stale
+        self.revision = revision
+        self.started_at = time.monotonic()
+        self.ready_at = None
+        self.turn_started_at = None
+        # Overloaded, if admission control shed the reply
+        self.error = None
+        self._items = []
+
+    def matches(self, transcript: str) -> bool:
+        return self.key == normalise_transcript(transcript)
+
+    def confirm(self, memory, turn_started_at: float) -> bool:
+        """
+        Called when the turn starts: True (a hit) if the history is still what the reply was
+        based on. A reply that was shed is a miss, so the turn gets its own attempt.
+        """
+        if memory.revision != self.revision or self.error is not None:
+            self.miss()
+            return False
+        self.turn_started_at = turn_started_at
+        _count("hits")
+        return True
+
+    def miss(self):
+        self.cancel()
+        _count("misses")
+
+    def discard(self):
+        """The partial changed before the turn ended."""
+        self.cancel()
+        _count("discarded")
+
+    def _append(self, item):
+        if self.ready_at is None:
+            self.ready_at = time.monotonic()
+        self._items.append(item)
+
+    def _record_saved(self):
+        # Without speculation the first output would have come this much later
+        saved_ms = max(0.0, (min(self.ready_at, self.turn_started_at) - self.started_at) * 1000)
+        record_latency("speculation_saved", saved_ms)
+        _count("saved_ms_total", saved_ms)
+
+    def cancel(self):
+        raise NotImplementedError
+
+
+class Speculation(BaseSpeculation):
+    """Threaded runtime: `produce()` (returning an iterable of sentences, or one whole reply) runs on its own thread."""
+
+    def __init__(self, text: str, intent, revision: int, produce):
+        super().__init__(text, intent, revision)
+        self._done = False
+        self._cancelled = False
+        self._cond = threading.Condition()
+        _count("started")
+        threading.Thread(target=self._run, args=(produce,), name="speculation", daemon=True).start()
+
+    def _run(self, produce):
+        try:
+            items = produce()
+            try:
+                for item in items:
+                    with self._cond:
+                        if self._cancelled:
+                            break
+                        self._append(item)
+                        self._cond.notify_all()
+            finally:
+                close = getattr(items, "close", None)
+                if close is not None:
+                    close()
+        except Overloaded as e:
+            self.error = e
+        except Exception as e:
+            logger.warning(f"Speculative reply for '{self.text}' failed: {e}")
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def results(self):
+        """Sentences produced so far, then the rest as they arrive; closing it cancels the speculation."""
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self._items) and not self._done and not self._cancelled:
+                        self._cond.wait()
+                    if index >= len(self._items):
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    item = self._items[index]
+                if index == 0:
+                    self._record_saved()
+                index += 1
+                yield item
+        finally:
+            self.cancel()
+
+    def result(self):
+        """The whole reply of a non-streamed speculation (None if it failed)."""
+        results = self.results()
+        try:
+            return next(results, None)
+        finally:
+            results.close()
+
+
+class AsyncSpeculation(BaseSpeculation):
+    """Asyncio runtime: `produce` (an async iterator of sentences, or of one whole reply) runs as a task."""
+
+    def __init__(self, text: str, intent, revision: int, produce):
+        super().__init__(text, intent, revision)
+        self._changed = asyncio.Event()
+        _count("started")
+        self._task = asyncio.get_running_loop().create_task(self._run(produce))
+
+    async def _run(self, produce):
+        try:
+            async for item in produce:
+                self._append(item)
+                self._changed.set()
+        except Overloaded as e:
+            self.error = e
+        except Exception as e:
+            logger.warning(f"Speculative reply for '{self.text}' failed: {e}")
+        finally:
+            self._changed.set()
+
+    def cancel(self):
+        self._task.cancel()
+
+    async def results(self):
+        index = 0
+        try:
+            while True:
+                while index >= len(self._items) and not self._task.done():
+                    self._changed.clear()
+                    await self._changed.wait()
+                if index >= len(self._items):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                if index == 0:
+                    self._record_saved()
+                index += 1
+                yield self._items[index - 1]
+        finally:
+            self.cancel()
+
+    async def result(self):
+        results = self.results()
+        try:
+            return await anext(results, None)
+        finally:
+            await results.aclose()
+
+
+class _TimerHandle:
+    __slots__ = ("fn", "args", "cancelled")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerThread:
+    """
+    call_later for the threaded runtime: one thread runs every session's timers (partials
+    arrive several times a second per session, too often for a threading.Timer each).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay: float, fn, *args) -> _TimerHandle:
+        handle = _TimerHandle(fn, args)
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), handle))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="speculation-timers", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return handle
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _due, _seq, handle = heapq.heappop(self._heap)
+            if handle.cancelled:
+                continue
+            try:
+                handle.fn(*handle.args)
+            except Exception as e:
+                logger.error(f"Speculation timer failed: {e}")
+
+
+TIMERS = TimerThread()
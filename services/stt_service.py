@@ -1,19 +1,28 @@
-aai.settings.api_key = os.getenv("ASSEMBLYAI_API_KEY")
-
-import assemblyai as aai
 import logging
-import io
+from typing import BinaryIO
+from services.client_registry import get_assemblyai_client
+from services.service_registry import service_registry
+
 logger = logging.getLogger(__name__)
 
-def transcribe_audio(audio_bytes: io.BytesIO, assembly_api_key: str) -> str | None:
+
+def transcribe_file(audio: str | BinaryIO, assembly_api_key: str) -> str:
+    """
+    Transcribe a recording with AssemblyAI's pre-recorded API and return the text.
+    `audio` is a file path or a binary file object; either way the upload is streamed
+    from it rather than read into memory first. Raises on failure.
+    """
+    aai = service_registry.get("assemblyai")
+    transcriber = aai.Transcriber(client=get_assemblyai_client(assembly_api_key))
+    transcript = transcriber.transcribe(audio)
+    if transcript.error:
+        raise RuntimeError(transcript.error)
+    return transcript.text or ""
+
+
+def transcribe_audio(audio: str | BinaryIO, assembly_api_key: str) -> str | None:
     try:
-        aai.settings.api_key = assembly_api_key
-        transcriber = aai.Transcriber()
-        transcript = transcriber.transcribe(audio_bytes)
-        if transcript.error:
-            logger.error(f"AssemblyAI transcription error: {transcript.error}")
-            return None
-        return transcript.text
+        return transcribe_file(audio, assembly_api_key)
     except Exception as e:
         logger.error(f"AssemblyAI STT Error: {e}")
         return None
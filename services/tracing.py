@@ -0,0 +1,200 @@
+import contextvars
+import functools
+import logging
+import threading
+import time
+from services.metrics_service import record_latency
+
+logger = logging.getLogger(__name__)
+
+# The trace of the turn being answered in the current thread / asyncio task. Threads
+# started for a turn must be given a copy of the context (see in_turn_context).
+_current_trace = contextvars.ContextVar("turn_trace", default=None)
+
+
+class TurnTrace:
+    """
+    Per-stage timings for one voice turn, measured from the moment its transcript was final.
+
+    Stages are accumulated: a stage entered several times in one turn (e.g. one Murf
+    request per sentence) reports its total time and how often it ran. Marks are points
+    in time (e.g. first audio sent) as offsets from the start of the turn. Entering the
+    trace as a context manager makes it current, so span() calls anywhere below record
+    into it (asyncio tasks created inside inherit it); finish() closes it.
+    """
+
+    __slots__ = ("turn_id", "started_at", "stages", "marks", "finished_ms", "_token", "_lock")
+
+    def __init__(self, turn_id: int, started_at: float | None = None):
+        self.turn_id = turn_id
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.stages = {}  # name -> [total_ms, count]
+        self.marks = {}
+        self.finished_ms = None
+        self._token = None
+        # Streamed replies record from the TTS pool and sentence producer threads too
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, ms: float):
+        with self._lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                self.stages[stage] = [ms, 1]
+            else:
+                totals[0] += ms
+                totals[1] += 1
+
+    def mark(self, name: str):
+        """Record when `name` first happened in this turn."""
+        if name not in self.marks:
+            self.marks[name] = (time.monotonic() - self.started_at) * 1000
+
+    def __enter__(self):
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_trace.reset(self._token)
+        self._token = None
+        return False
+
+    def finish(self, cancelled: bool = False):
+        """Close the trace and feed its stages into the latency histograms (once)."""
+        if self.finished_ms is not None:
+            return
+        self.finished_ms = (time.monotonic() - self.started_at) * 1000
+        with self._lock:
+            stages = [(stage, ms) for stage, (ms, _count) in self.stages.items()]
+        for stage, ms in stages:
+            record_latency(f"stage_{stage}", ms)
+        # Barge-in cuts a turn short; its total would skew the histogram
+        if not cancelled:
+            record_latency("turn_total", self.finished_ms)
+        logger.info(f"Turn {self.turn_id} timings: {self.summary()}")
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {name: {"ms": round(ms, 1), "count": count} for name, (ms, count) in self.stages.items()}
+        return {
+            "total_ms": round(self.finished_ms, 1) if self.finished_ms is not None else None,
+            "stages": stages,
+            "marks": {name: round(ms, 1) for name, ms in self.marks.items()},
+        }
+
+    def as_message(self) -> dict:
+        """The `turn_timings` debug message sent to clients that asked for it."""
+        return {"type": "turn_timings", "turn": self.turn_id, **self.summary()}
+
+
+class _Span:
+    __slots__ = ("trace", "stage", "started")
+
+    def __init__(self, trace: TurnTrace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add(self.stage, (time.perf_counter() - self.started) * 1000)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def current_trace() -> TurnTrace | None:
+    return _current_trace.get()
+
+
+def span(stage: str):
+    """Time a block as `stage` of the current turn; a shared no-op outside of a turn."""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, stage)
+
+
+def mark(name: str):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.mark(name)
+
+
+def in_turn_context(fn):
+    """
+    Bind `fn` to a copy of the caller's context, so spans it records on another thread
+    land in the same trace. Each copy can only run once at a time: bind per task.
+    """
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def timed_iter(iterable, stage: str, first_mark: str | None = None):
+    """
+    Iterate `iterable`, adding the time spent waiting for each item to `stage` of the
+    current turn. The trace is looked up now, so the result may be consumed on any thread.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return iter(iterable)
+    return _timed(trace, iter(iterable), stage, first_mark)
+
+
+def _timed(trace: TurnTrace, it, stage: str, first_mark: str | None):
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                trace.add(stage, (time.perf_counter() - started) * 1000)
+                return
+            trace.add(stage, (time.perf_counter() - started) * 1000)
+            if first_mark is not None:
+                trace.mark(first_mark)
+                first_mark = None
+            yield item
+    finally:
+        close = getattr(it, "close", None)
+        if close is not None:
+            close()
+
+
+def timed_aiter(iterable, stage: str, first_mark: str | None = None):
+    """Async counterpart of timed_iter."""
+    trace = _current_trace.get()
+    if trace is None:
+        return iterable
+    return _atimed(trace, iterable.__aiter__(), stage, first_mark)
+
+
+async def _atimed(trace: TurnTrace, it, stage: str, first_mark: str | None):
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = await it.__anext__()
+            except StopAsyncIteration:
+                trace.add(stage, (time.perf_counter() - started) * 1000)
+                return
+            trace.add(stage, (time.perf_counter() - started) * 1000)
+            if first_mark is not None:
+                trace.mark(first_mark)
+                first_mark = None
+            yield item
+    finally:
+        aclose = getattr(it, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -1,49 +1,267 @@
-# transcriber.py
-aai.settings.api_key = os.getenv("ASSEMBLYAI_API_KEY")
+import logging
+import os
+import threading
+import time
+from collections import deque
+from services.metrics_service import record_latency, register_stats_provider
+from services.service_registry import service_registry
 
-import assemblyai as aai
-from assemblyai.streaming.v3 import (
-    StreamingClient, StreamingClientOptions,
-    StreamingParameters, StreamingSessionParameters,
-    StreamingEvents, BeginEvent, TurnEvent,
-    TerminationEvent, StreamingError
-)
+logger = logging.getLogger(__name__)
 
+API_HOST = os.environ.get("ASSEMBLYAI_STREAMING_HOST", "streaming.assemblyai.com")
+SAMPLE_RATE = 16000
+# Pre-connected sessions kept per API key. A streaming session is billed while it is open,
+# so the pool is small, only refilled when a session is handed out, and idle sessions
+# are closed after POOL_IDLE_SECONDS. STT_POOL_SIZE=0 disables pre-warming.
+POOL_SIZE = int(os.environ.get("STT_POOL_SIZE", 1))
+POOL_IDLE_SECONDS = float(os.environ.get("STT_POOL_IDLE_SECONDS", 30))
+# Audio received before the session is live is held here (oldest dropped beyond this)
+RING_BUFFER_SECONDS = 10
+RING_BUFFER_BYTES = RING_BUFFER_SECONDS * SAMPLE_RATE * 2
 
-def on_begin(self, event: BeginEvent):
-    print(f"Session started: {event.id}")
+_stats = {"hits": 0, "misses": 0, "connects": 0, "connect_failures": 0, "expired": 0, "dead": 0, "buffer_dropped_bytes": 0}
+_stats_lock = threading.Lock()
 
 
-def on_turn(self, event: TurnEvent):
-    print(f"{event.transcript} (end_of_turn={event.end_of_turn})")
-    if event.end_of_turn and not event.turn_is_formatted:
-        params = StreamingSessionParameters(format_turns=True)
-        self.set_params(params)
+def _count(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
 
 
-def on_termination(self, event: TerminationEvent):
-    print(f"Session terminated after {event.audio_duration_seconds} s")
+def _sdk():
+    """assemblyai.streaming.v3, imported on first use (or by the start-up warm-up)."""
+    return service_registry.get("assemblyai_streaming")
 
 
-def on_error(self, error: StreamingError):
-    print("Error:", error)
+def _params():
+    return _sdk().StreamingParameters(sample_rate=SAMPLE_RATE, format_turns=True)
 
 
-class AssemblyAIStreamingTranscriber:
-    def __init__(self, assembly_api_key, sample_rate=16000):
-        self.client = StreamingClient(
-            StreamingClientOptions(
-                api_key=assembly_api_key, api_host="streaming.assemblyai.com")
-        )
-        self.client.on(StreamingEvents.Begin, on_begin)
-        self.client.on(StreamingEvents.Turn, on_turn)
-        self.client.on(StreamingEvents.Termination, on_termination)
-        self.client.on(StreamingEvents.Error, on_error)
-        self.client.connect(StreamingParameters(
-            sample_rate=sample_rate, format_turns=False))
+class _PooledClient:
+    """A connected StreamingClient whose events go to whichever transcriber currently owns it."""
 
-    def stream_audio(self, audio_chunk: bytes):
-        self.client.stream(audio_chunk)
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.owner = None
+        self.alive = True
+        self.idle_since = None
+        sdk = _sdk()
+        self.client = sdk.StreamingClient(sdk.StreamingClientOptions(api_key=api_key or "none", api_host=API_HOST))
+        self.client.on(sdk.StreamingEvents.Turn, self._on_turn)
+        self.client.on(sdk.StreamingEvents.Termination, self._on_closed)
+        self.client.on(sdk.StreamingEvents.Error, self._on_closed)
+
+    def connect(self):
+        started = time.monotonic()
+        try:
+            self.client.connect(_params())
+        except Exception:
+            self.alive = False
+            _count("connect_failures")
+            raise
+        _count("connects")
+        record_latency("stt_connect", (time.monotonic() - started) * 1000)
+
+    def _on_turn(self, _client, event):
+        owner = self.owner
+        if owner is not None:
+            owner.on_turn(event)
+
+    def _on_closed(self, _client, event):
+        if self.alive:
+            logger.info(f"[stt] Streaming session closed: {event}")
+        self.alive = False
+
+    def close(self):
+        self.alive = False
+        self.owner = None
+        try:
+            self.client.disconnect(terminate=True)
+        except Exception as e:
+            logger.warning(f"[stt] Disconnect failed: {e}")
+
+
+class STTConnectionPool:
+    """Per-API-key pools of pre-connected AssemblyAI streaming sessions."""
+
+    def __init__(self, size: int = POOL_SIZE, idle_seconds: float = POOL_IDLE_SECONDS):
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self._idle: dict[str, deque] = {}
+        self._connecting: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def take(self, api_key: str) -> _PooledClient | None:
+        """A live idle session for this key, or None. Either way the pool is topped up."""
+        pooled = None
+        with self._lock:
+            idle = self._idle.get(api_key)
+            while idle:
+                candidate = idle.popleft()
+                if candidate.alive:
+                    pooled = candidate
+                    break
+                _count("dead")
+        _count("hits" if pooled else "misses")
+        self.fill(api_key)
+        return pooled
+
+    def fill(self, api_key: str):
+        """Connect sessions in the background until `size` are idle or connecting for this key."""
+        if self.size <= 0 or not api_key:
+            return
+        with self._lock:
+            wanted = self.size - len(self._idle.get(api_key, ())) - self._connecting.get(api_key, 0)
+            if wanted <= 0:
+                return
+            self._connecting[api_key] = self._connecting.get(api_key, 0) + wanted
+        for _ in range(wanted):
+            threading.Thread(target=self._connect_one, args=(api_key,), name="stt-prewarm", daemon=True).start()
+        self._start_reaper()
+
+    def _connect_one(self, api_key: str):
+        pooled = _PooledClient(api_key)
+        try:
+            pooled.connect()
+        except Exception as e:
+            logger.warning(f"[stt] Pre-warm connect failed: {e}")
+            pooled = None
+        with self._lock:
+            self._connecting[api_key] -= 1
+            if pooled is not None:
+                pooled.idle_since = time.monotonic()
+                self._idle.setdefault(api_key, deque()).append(pooled)
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap, name="stt-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(min(5.0, self.idle_seconds))
+            expired = []
+            now = time.monotonic()
+            with self._lock:
+                for api_key, idle in list(self._idle.items()):
+                    keep = deque(p for p in idle if p.alive and now - p.idle_since < self.idle_seconds)
+                    expired.extend(p for p in idle if p not in keep)
+                    if keep:
+                        self._idle[api_key] = keep
+                    else:
+                        del self._idle[api_key]
+            for pooled in expired:
+                _count("expired" if pooled.alive else "dead")
+                pooled.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = sum(len(v) for v in self._idle.values())
+            connecting = sum(self._connecting.values())
+        with _stats_lock:
+            stats = dict(_stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        stats.update(idle=idle, connecting=connecting, pool_size=self.size)
+        return stats
+
+
+stt_pool = STTConnectionPool()
+register_stats_provider("stt_pool", stt_pool.stats)
+
+
+class StreamingTranscriber:
+    """
+    One voice session's AssemblyAI streaming connection.
+
+    Takes a pre-connected session from the pool when one is idle; otherwise connects
+    in the background. Audio streamed before the session is live is kept in a ring
+    buffer and flushed, in order, once it is. `on_turn(event)` receives TurnEvents.
+    """
+
+    def __init__(self, api_key: str, on_turn, pool: STTConnectionPool = stt_pool):
+        self.on_turn = on_turn
+        self._lock = threading.Lock()
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        self._live = False
+        self._closed = False
+        self._opened_at = time.monotonic()
+        self.ready = threading.Event()
+        self._pooled = pool.take(api_key)
+        if self._pooled is not None:
+            self._pooled.owner = self
+            self._go_live()
+        else:
+            self._pooled = _PooledClient(api_key)
+            self._pooled.owner = self
+            threading.Thread(target=self._connect, name="stt-connect", daemon=True).start()
+
+    def _connect(self):
+        try:
+            self._pooled.connect()
+        except Exception as e:
+            logger.error(f"[stt] Could not connect streaming session: {e}")
+            with self._lock:
+                self._buffer.clear()
+                self._buffered_bytes = 0
+            self.ready.set()
+            return
+        self._go_live()
+
+    def _go_live(self):
+        with self._lock:
+            if not self._closed:
+                while self._buffer:
+                    self._pooled.client.stream(self._buffer.popleft())
+                self._buffered_bytes = 0
+                self._live = True
+                record_latency("stt_ready", (time.monotonic() - self._opened_at) * 1000)
+        self.ready.set()
+
+    @property
+    def live(self) -> bool:
+        return self._live
+
+    def stream(self, data: bytes):
+        with self._lock:
+            if self._live:
+                self._pooled.client.stream(data)
+                return
+            if self._closed or not self._pooled.alive:
+                return
+            self._buffer.append(data)
+            self._buffered_bytes += len(data)
+            while self._buffered_bytes > RING_BUFFER_BYTES and len(self._buffer) > 1:
+                dropped = self._buffer.popleft()
+                self._buffered_bytes -= len(dropped)
+                _count("buffer_dropped_bytes", len(dropped))
+
+    def force_endpoint(self):
+        """Ask AssemblyAI to finalise the current turn now (no-op until the session is live)."""
+        with self._lock:
+            if not self._live:
+                return
+            # The SDK has no public method for this message yet; its writer thread sends whatever is queued
+            write_queue = getattr(self._pooled.client, "_write_queue", None)
+            if write_queue is not None:
+                write_queue.put(_sdk().models.ForceEndpoint())
 
     def close(self):
-        self.client.disconnect(terminate=True)
\ No newline at end of file
+        """Terminate the session (blocks until the SDK's threads finish, so run off the event loop)."""
+        with self._lock:
+            self._closed = True
+            self._live = False
+            self._buffer.clear()
+        if not self.ready.is_set():
+            # Still connecting: let the connect thread finish before tearing down
+            self.ready.wait(timeout=20)
+        self._pooled.close()
+
+
+def open_transcriber(api_key: str, on_turn) -> StreamingTranscriber:
+    return StreamingTranscriber(api_key, on_turn)
+
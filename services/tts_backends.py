@@ -0,0 +1,179 @@
+import logging
+import os
+from services.client_registry import get_http_session, async_request
+from services.tracing import span, timed_iter, timed_aiter
+
+logger = logging.getLogger(__name__)
+
+# TTS backends turn text into an iterator of audio byte chunks in a given AudioFormat.
+# TTS_BACKEND picks one:
+#   murf-stream  Murf's /v1/speech/stream; one request whose body is the audio, relayed
+#                as it is synthesised (default)
+#   murf         /v1/speech/generate, then a second request to download the audioFile
+TTS_BACKEND = os.environ.get("TTS_BACKEND", "murf-stream")
+MURF_API_URL = os.environ.get("MURF_API_URL", "https://api.murf.ai/v1/speech/generate")
+MURF_STREAM_URL = os.environ.get("MURF_STREAM_URL", "https://api.murf.ai/v1/speech/stream")
+# Output format. Speech needs far less than Murf's 44.1 kHz default: 24 kHz mono MP3 is
+# about half the bytes and sounds the same through a laptop speaker.
+TTS_FORMAT = os.environ.get("TTS_FORMAT", "MP3")
+TTS_SAMPLE_RATE = int(os.environ.get("TTS_SAMPLE_RATE", 24000))
+TTS_CHANNELS = int(os.environ.get("TTS_CHANNELS", 1))
+# Relay size for streamed downloads; roughly a quarter second of 128 kbit/s MP3
+STREAM_CHUNK_BYTES = 4096
+
+MIME_TYPES = {"MP3": "audio/mpeg", "WAV": "audio/wav", "FLAC": "audio/flac", "OGG": "audio/ogg"}
+
+
+class AudioFormat:
+    """Encoding asked of the TTS provider; `cache_format` keeps clips of different encodings apart in the TTS cache."""
+
+    def __init__(self, fmt: str = TTS_FORMAT, sample_rate: int = TTS_SAMPLE_RATE, channels: int = TTS_CHANNELS):
+        self.fmt = fmt.upper()
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    @property
+    def mime(self) -> str:
+        if self.fmt == "PCM":
+            # Raw signed 16-bit little-endian samples; the client needs the rate to play them
+            return f"audio/pcm;rate={self.sample_rate};channels={self.channels}"
+        return MIME_TYPES.get(self.fmt, "application/octet-stream")
+
+    @property
+    def cache_format(self) -> str:
+        return f"{self.fmt}/{self.sample_rate}/{self.channels}"
+
+    def murf_params(self) -> dict:
+        return {"format": self.fmt, "sampleRate": self.sample_rate,
+                "channelType": "MONO" if self.channels == 1 else "STEREO"}
+
+    def __repr__(self):
+        return f"AudioFormat({self.cache_format})"
+
+
+DEFAULT_AUDIO_FORMAT = AudioFormat()
+
+
+def _download_chunks(res):
+    with res:
+        yield from res.iter_content(chunk_size=STREAM_CHUNK_BYTES)
+
+
+async def _relay_async(res):
+    try:
+        async for chunk in res.aiter_bytes(STREAM_CHUNK_BYTES):
+            yield chunk
+    finally:
+        await res.aclose()
+
+
+class TTSBackend:
+    """
+    `open(text, api_key, voice_id, audio_format)` starts synthesis and returns an iterator
+    of audio chunks (None when the provider gave no audio); `open_async` returns an async
+    iterator. Both raise on HTTP errors.
+    """
+
+    name = ""
+    formats: tuple[str, ...] = ()
+
+    def open(self, text: str, api_key: str, voice_id: str, audio_format: AudioFormat):
+        raise NotImplementedError
+
+    async def open_async(self, text: str, api_key: str, voice_id: str, audio_format: AudioFormat):
+        raise NotImplementedError
+
+
+class MurfStreamBackend(TTSBackend):
+    """One round-trip: the response body is the audio, forwarded chunk by chunk as Murf produces it."""
+
+    name = "murf-stream"
+    formats = ("MP3", "WAV", "PCM")
+
+    def _payload(self, text: str, voice_id: str, audio_format: AudioFormat) -> dict:
+        return {"text": text, "voiceId": voice_id, **audio_format.murf_params()}
+
+    def open(self, text: str, api_key: str, voice_id: str, audio_format: AudioFormat):
+        with span("murf_stream"):
+            res = get_http_session().post(MURF_STREAM_URL, headers={"api-key": api_key},
+                                          json=self._payload(text, voice_id, audio_format), stream=True)
+        if not res.ok:
+            res.close()
+        res.raise_for_status()
+        # Time spent waiting on Murf, not on the client consuming it
+        return timed_iter(_download_chunks(res), "murf_stream")
+
+    async def open_async(self, text: str, api_key: str, voice_id: str, audio_format: AudioFormat):
+        with span("murf_stream"):
+            res = await async_request("POST", MURF_STREAM_URL, headers={"api-key": api_key},
+                                      json=self._payload(text, voice_id, audio_format), stream=True)
+        if res.is_error:
+            await res.aclose()
+        res.raise_for_status()
+        return timed_aiter(_relay_async(res), "murf_stream")
+
+
+class MurfGenerateBackend(TTSBackend):
+    """Two round-trips: speech/generate returns an audioFile URL, which is then downloaded."""
+
+    name = "murf"
+    formats = ("MP3", "WAV", "FLAC", "OGG", "PCM")
+
+    def _payload(self, text: str, voice_id: str, audio_format: AudioFormat) -> dict:
+        return {"text": text, "voiceId": voice_id, **audio_format.murf_params()}
+
+    def _audio_file(self, res) -> str | None:
+        res.raise_for_status()
+        audio_file = res.json().get("audioFile")
+        if not audio_file:
+            logger.error("MURF Error: No audioFile in response")
+        return audio_file
+
+    def open(self, text: str, api_key: str, voice_id: str, audio_format: AudioFormat):
+        with span("murf_generate"):
+            res = get_http_session().post(MURF_API_URL, headers={"api-key": api_key},
+                                          json=self._payload(text, voice_id, audio_format))
+        audio_file = self._audio_file(res)
+        if not audio_file:
+            return None
+        with span("murf_download"):
+            audio_res = get_http_session().get(audio_file, stream=True)
+        audio_res.raise_for_status()
+        return timed_iter(_download_chunks(audio_res), "murf_download")
+
+    async def open_async(self, text: str, api_key: str, voice_id: str, audio_format: AudioFormat):
+        with span("murf_generate"):
+            res = await async_request("POST", MURF_API_URL, headers={"api-key": api_key},
+                                      json=self._payload(text, voice_id, audio_format))
+        audio_file = self._audio_file(res)
+        if not audio_file:
+            return None
+        with span("murf_download"):
+            audio_res = await async_request("GET", audio_file, stream=True)
+        if audio_res.is_error:
+            await audio_res.aclose()
+        audio_res.raise_for_status()
+        return timed_aiter(_relay_async(audio_res), "murf_download")
+
+
+TTS_BACKENDS = {backend.name: backend for backend in (MurfStreamBackend(), MurfGenerateBackend())}
+
+
+def get_tts_backend(name: str | None = None) -> TTSBackend:
+    name = name or TTS_BACKEND
+    backend = TTS_BACKENDS.get(name)
+    if backend is None:
+        raise ValueError(f"Unknown TTS_BACKEND {name!r}; expected one of {', '.join(TTS_BACKENDS)}")
+    return backend
+
+
+def negotiate_audio_format(accepted=None, backend: TTSBackend | None = None) -> AudioFormat:
+    """
+    The first format in the client's `audioFormats` list (most preferred first) that the
+    backend can produce, at the configured sample rate; the default format otherwise.
+    """
+    backend = backend or get_tts_backend()
+    for fmt in accepted or ():
+        if isinstance(fmt, str) and fmt.upper() in backend.formats:
+            return AudioFormat(fmt, DEFAULT_AUDIO_FORMAT.sample_rate, DEFAULT_AUDIO_FORMAT.channels)
+    return DEFAULT_AUDIO_FORMAT
@@ -0,0 +1,319 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from services.admission import Overloaded
+from services.metrics_service import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get("TTS_CACHE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static", "generated")
+# In-memory tier budget; a short Murf MP3 line is ~20-60 KB
+MAX_MEMORY_BYTES = 32 * 1024 * 1024
+# Disk tier budget; least recently written files are removed past it
+MAX_DISK_BYTES = 256 * 1024 * 1024
+# A trim goes down to this share of the budget, so the directory is listed again only after ~10% more is written
+TRIM_TO = 0.9
+FORMAT_EXTENSIONS = {"MP3": "mp3", "WAV": "wav", "FLAC": "flac", "OGG": "ogg", "PCM": "pcm"}
+
+
+def cache_key(text: str, voice_id: str, fmt: str) -> str:
+    return hashlib.sha256(f"{voice_id}\0{fmt}\0{text}".encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """
+    Content-addressed cache of synthesised audio keyed by (text, voiceId, format), where
+    format includes the sample rate and channels the clip was synthesised with.
+
+    Lookups go memory LRU -> disk (static/generated/<sha256>.<ext>) -> fetch.
+    Concurrent misses for the same key share a single fetch.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_memory_bytes: int = MAX_MEMORY_BYTES,
+                 max_disk_bytes: int = MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._inflight: dict[str, Future] = {}
+        # Running estimate of the disk tier's size (None until first measured); the
+        # directory is only listed and trimmed once it goes over max_disk_bytes
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "fetch_failures": 0}
+
+    def _path(self, key: str, fmt: str) -> str:
+        # `fmt` may carry encoding settings after the format name, e.g. "MP3/24000/1"
+        extension = FORMAT_EXTENSIONS.get(fmt.split("/", 1)[0].upper(), "bin")
+        return os.path.join(self.cache_dir, f"{key}.{extension}")
+
+    def _remember(self, key: str, audio: bytes):
+        # Caller holds self._lock
+        if len(audio) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._stats["evictions"] += 1
+
+    def _read_disk(self, path: str) -> bytes | None:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"TTS cache read failed for {path}: {e}")
+            return None
+
+    def _write_disk(self, path: str, audio: bytes):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(audio)
+            os.replace(tmp, path)
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += len(audio)
+                due = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+            if due:
+                self._trim_disk()
+        except OSError as e:
+            logger.warning(f"TTS cache write failed for {path}: {e}")
+
+    def _trim_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if len(name.split(".", 1)[0]) != 64 or name.endswith(".tmp"):
+                continue  # only manage our own content-addressed files
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes * TRIM_TO:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    def get(self, text: str, voice_id: str, fmt: str) -> bytes | None:
+        """Return cached audio without fetching."""
+        key = cache_key(text, voice_id, fmt)
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return audio
+        audio = self._read_disk(self._path(key, fmt))
+        if audio is not None:
+            with self._lock:
+                self._stats["disk_hits"] += 1
+                self._remember(key, audio)
+        return audio
+
+    def claim(self, text: str, voice_id: str, fmt: str):
+        """
+        Look up a clip for a caller that is about to fetch it. Returns one of:
+        (audio, None, None) on a hit; (None, future, None) when another caller is already
+        fetching it (wait on the future; it resolves to None if that fetch failed or was
+        closed early); (None, None, finish) when the caller must fetch and then call
+        finish(audio or None) exactly once.
+        """
+        audio = self.get(text, voice_id, fmt)
+        if audio is not None:
+            return audio, None, None
+        key = cache_key(text, voice_id, fmt)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                return None, future, None
+            future = self._inflight[key] = Future()
+            self._stats["misses"] += 1
+
+        def finish(audio):
+            try:
+                if audio:
+                    with self._lock:
+                        self._remember(key, audio)
+                    self._write_disk(self._path(key, fmt), audio)
+                else:
+                    with self._lock:
+                        self._stats["fetch_failures"] += 1
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                future.set_result(audio)
+
+        return None, None, finish
+
+    def get_or_fetch(self, text: str, voice_id: str, fmt: str, fetch, retry: bool = True) -> bytes | None:
+        """Return cached audio, or call `fetch()` once (shared by concurrent callers) and cache the result."""
+        audio, future, finish = self.claim(text, voice_id, fmt)
+        if audio is not None:
+            return audio
+        if future is not None:
+            audio = future.result()
+            if audio is None and retry:
+                # The shared fetch failed: fetch it ourselves
+                return self.get_or_fetch(text, voice_id, fmt, fetch, retry=False)
+            return audio
+        audio = None
+        try:
+            audio = fetch()
+        finally:
+            finish(audio)
+        return audio
+
+    def open_stream(self, text: str, voice_id: str, fmt: str, opener, retry: bool = True) -> "AudioStream":
+        """
+        Like get_or_fetch, but for relaying audio as it downloads: `opener()` starts the
+        request and returns an iterator of byte chunks. The returned stream yields those
+        chunks and caches the complete audio once the last chunk has been read.
+        A caller that waited on another's stream opens its own if that one didn't complete
+        (e.g. its session barged in), rather than playing silence.
+        """
+        audio, future, finish = self.claim(text, voice_id, fmt)
+        if audio is not None:
+            return AudioStream([audio])
+        if future is not None:
+            fallback = (lambda: self.open_stream(text, voice_id, fmt, opener, retry=False)) if retry else None
+            return AudioStream(_wait_for(future, fallback))
+        try:
+            chunks = opener()
+        except Overloaded:
+            # Shed by admission control: the caller tells the client rather than going quiet
+            finish(None)
+            raise
+        except Exception as e:
+            logger.error(f"TTS stream open failed: {e}")
+            chunks = None
+        if chunks is None:
+            finish(None)
+            return AudioStream([])
+        return AudioStream(chunks, on_complete=finish)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memory_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else None
+        return stats
+
+
+def _wait_for(future: Future, fallback=None):
+    audio = future.result()
+    if audio:
+        yield audio
+    elif fallback is not None:
+        yield from fallback()
+
+
+class AudioStream:
+    """
+    Iterator over the byte chunks of one synthesised clip. `on_complete` receives the
+    full audio after the last chunk, or None if the stream failed or was closed early.
+    """
+
+    def __init__(self, chunks, on_complete=None):
+        self._chunks = iter(chunks)
+        self._on_complete = on_complete
+        self._parts = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._complete(b"".join(self._parts))
+            raise
+        except Exception as e:
+            logger.error(f"TTS audio stream failed: {e}")
+            self.close()
+            raise StopIteration
+        if self._on_complete is not None:
+            self._parts.append(chunk)
+        return chunk
+
+    def read(self) -> bytes:
+        return b"".join(self)
+
+    def _complete(self, audio: bytes | None):
+        on_complete, self._on_complete = self._on_complete, None
+        if on_complete is not None:
+            on_complete(audio or None)
+
+    def close(self):
+        close = getattr(self._chunks, "close", None)
+        if close is not None:
+            close()
+        self._complete(None)
+
+    def __del__(self):
+        self.close()
+
+
+class AsyncAudioStream:
+    """AudioStream for asyncio callers: wraps an async iterator of byte chunks."""
+
+    def __init__(self, chunks, on_complete=None):
+        self._chunks = chunks.__aiter__()
+        self._on_complete = on_complete
+        self._parts = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self._complete(b"".join(self._parts))
+            raise
+        except Exception as e:
+            logger.error(f"TTS audio stream failed: {e}")
+            await self.aclose()
+            raise StopAsyncIteration
+        if self._on_complete is not None:
+            self._parts.append(chunk)
+        return chunk
+
+    def _complete(self, audio: bytes | None):
+        on_complete, self._on_complete = self._on_complete, None
+        if on_complete is not None:
+            on_complete(audio or None)
+
+    async def aclose(self):
+        aclose = getattr(self._chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        self._complete(None)
+
+    def __del__(self):
+        self._complete(None)
+
+
+tts_cache = TTSCache()
+register_stats_provider("tts_cache", tts_cache.stats)
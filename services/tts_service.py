@@ -1,44 +1,181 @@
 
-import requests
 import logging
+import asyncio
 import base64
+import os
+import threading
+from services.tts_cache import tts_cache, AudioStream, AsyncAudioStream
+from services.tts_backends import AudioFormat, DEFAULT_AUDIO_FORMAT, get_tts_backend
+from services.admission import admission, held_until_done, held_until_done_async, Overloaded
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def murf_tts(text: str, murf_api_key: str) -> str | None:
-    """Text to speech using Murf API. Returns the base64-encoded audio file content."""
+DEFAULT_VOICE_ID = os.environ.get("TTS_VOICE_ID", "en-US-natalie")
+# Lines the assistant speaks verbatim; synthesised once and served from the TTS cache
+CANNED_REPLIES = [
+    "LED turned on! (via MQTT)",
+    "LED turned off! (via MQTT)",
+    "Failed to turn on LED (MQTT error)",
+    "Failed to turn off LED (MQTT error)",
+    "Opened web search in your browser.",
+    "I am Buzz Lightyear.",
+    "Sure, I'm drawing that now. It will appear on screen shortly.",
+    "Here is the picture.",
+]
+
+
+def murf_tts_bytes(text: str, murf_api_key: str, voice_id: str = DEFAULT_VOICE_ID,
+                   audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT) -> bytes | None:
+    """Synthesise `text` with Murf and return the raw audio bytes (no caching)."""
     if not murf_api_key:
         logger.error("MURF Error: API key not found")
         return None
-    headers = {"api-key": murf_api_key}
-    payload = {"text": text, "voiceId": "en-US-natalie"}
     try:
-        res = requests.post("https://api.murf.ai/v1/speech/generate", headers=headers, json=payload)
-        res.raise_for_status()
-        data = res.json()
-        audio_file = data.get("audioFile")
-        if not audio_file:
-            logger.error("MURF Error: No audioFile in response")
-            return None
-        # Download the audio file and return base64-encoded content
-        audio_res = requests.get(audio_file)
-        audio_res.raise_for_status()
-        b64_full = base64.b64encode(audio_res.content).decode('utf-8')
-        return b64_full
+        with admission.admit("tts", murf_api_key):
+            chunks = get_tts_backend().open(text, murf_api_key, voice_id, audio_format)
+            return b"".join(chunks) if chunks is not None else None
     except Exception as e:
         logger.error(f"MURF TTS Error: {e}")
         return None
-def murf_tts_chunked(text: str, murf_api_key: str):
+
+
+def _open_admitted(text: str, murf_api_key: str, voice_id: str, audio_format: AudioFormat):
+    """Backend stream for `text`, holding a TTS admission slot until it has been read or closed."""
+    ticket = admission.admit("tts", murf_api_key)
+    try:
+        chunks = get_tts_backend().open(text, murf_api_key, voice_id, audio_format)
+    except BaseException:
+        ticket.release()
+        raise
+    if chunks is None:
+        ticket.release()
+        return None
+    return held_until_done(chunks, ticket)
+
+
+async def _open_admitted_async(text: str, murf_api_key: str, voice_id: str, audio_format: AudioFormat):
+    ticket = await admission.admit_async("tts", murf_api_key)
+    try:
+        chunks = await get_tts_backend().open_async(text, murf_api_key, voice_id, audio_format)
+    except BaseException:
+        ticket.release()
+        raise
+    if chunks is None:
+        ticket.release()
+        return None
+    return held_until_done_async(chunks, ticket)
+
+
+def open_murf_audio(text: str, murf_api_key: str, voice_id: str = DEFAULT_VOICE_ID,
+                    audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT) -> AudioStream:
     """
-    Fetch the Murf audio URL, download the full audio, and yield base64-encoded file as a single chunk.
+    Start synthesising `text` and return an iterator over the audio bytes as they arrive,
+    without buffering the whole file. Cached lines are served from the TTS cache.
+    Raises Overloaded when admission control sheds the request.
     """
-    audio_url = murf_tts(text, murf_api_key)
-    if not audio_url:
-        return
+    text = text.strip()
+    fmt = audio_format.cache_format
+    if not murf_api_key:
+        audio = tts_cache.get(text, voice_id, fmt)
+        if audio is None:
+            logger.error("MURF Error: API key not found")
+        return AudioStream([audio] if audio else [])
+    return tts_cache.open_stream(text, voice_id, fmt,
+                                 lambda: _open_admitted(text, murf_api_key, voice_id, audio_format))
+
+
+async def _aiter_bytes(*chunks):
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+async def open_murf_audio_async(text: str, murf_api_key: str, voice_id: str = DEFAULT_VOICE_ID,
+                                audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT) -> AsyncAudioStream:
+    """Async counterpart of open_murf_audio: the request runs on the event loop, audio is relayed as it arrives."""
+    text = text.strip()
+    fmt = audio_format.cache_format
+    if not murf_api_key:
+        audio = tts_cache.get(text, voice_id, fmt)
+        if audio is None:
+            logger.error("MURF Error: API key not found")
+        return AsyncAudioStream(_aiter_bytes(audio))
+    audio, future, finish = tts_cache.claim(text, voice_id, fmt)
+    if future is not None:
+        audio = await asyncio.wrap_future(future)
+        if audio is None:
+            # That synthesis failed or its session barged in: synthesise the line here rather than play silence
+            audio, future, finish = tts_cache.claim(text, voice_id, fmt)
+            if future is not None:
+                audio = await asyncio.wrap_future(future)
+    if finish is None:
+        return AsyncAudioStream(_aiter_bytes(audio))
     try:
-        r = requests.get(audio_url)
-        r.raise_for_status()
-        b64_full = base64.b64encode(r.content).decode('utf-8')
-        yield b64_full
-    except Exception as e:
-        logger.error(f"Murf TTS chunked fetch error: {e}")
+        chunks = await _open_admitted_async(text, murf_api_key, voice_id, audio_format)
+    except BaseException as e:
+        finish(None)
+        if not isinstance(e, Exception) or isinstance(e, Overloaded):
+            raise
+        logger.error(f"MURF TTS Error: {e}")
+        return AsyncAudioStream(_aiter_bytes())
+    if chunks is None:
+        finish(None)
+        return AsyncAudioStream(_aiter_bytes())
+    return AsyncAudioStream(chunks, on_complete=finish)
+
+
+def murf_tts_cached(text: str, murf_api_key: str, voice_id: str = DEFAULT_VOICE_ID,
+                    audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT) -> bytes | None:
+    """Raw audio for `text`, served from the TTS cache when this line was synthesised before."""
+    text = text.strip()
+    fmt = audio_format.cache_format
+    if not murf_api_key:
+        # Cached lines can still be served without a key
+        return tts_cache.get(text, voice_id, fmt)
+    return tts_cache.get_or_fetch(text, voice_id, fmt,
+                                  lambda: murf_tts_bytes(text, murf_api_key, voice_id, audio_format))
+
+
+def murf_tts(text: str, murf_api_key: str) -> str | None:
+    """Text to speech using Murf API. Returns the base64-encoded audio file content."""
+    audio = murf_tts_cached(text, murf_api_key)
+    if not audio:
+        if not murf_api_key:
+            logger.error("MURF Error: API key not found")
+        return None
+    return base64.b64encode(audio).decode('utf-8')
+
+
+_prewarmed = threading.Event()
+
+
+def prewarm_tts_cache(murf_api_key: str | None, lines=CANNED_REPLIES):
+    """Make sure the canned replies are cached; lines already on disk are just loaded into memory."""
+    warmed = 0
+    for line in lines:
+        if murf_tts_cached(line, murf_api_key):
+            warmed += 1
+    logger.info(f"TTS cache pre-warmed {warmed}/{len(lines)} canned replies.")
+    if warmed == len(lines):
+        _prewarmed.set()
+    return warmed
+
+
+def prewarm_tts_cache_async(murf_api_key: str | None):
+    if _prewarmed.is_set():
+        return
+    threading.Thread(target=prewarm_tts_cache, args=(murf_api_key,), name="tts-prewarm", daemon=True).start()
+
+
+def murf_tts_chunked(text: str, murf_api_key: str, audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT):
+    """Yield the audio for `text` base64-encoded, one piece per chunk as it arrives (each piece decodes on its own)."""
+    pending = b""
+    for chunk in open_murf_audio(text, murf_api_key, audio_format=audio_format):
+        pending += chunk
+        # Encode whole 3-byte groups so no piece ends in padding
+        cut = len(pending) - len(pending) % 3
+        if cut:
+            yield base64.b64encode(pending[:cut]).decode("utf-8")
+            pending = pending[cut:]
+    if pending:
+        yield base64.b64encode(pending).decode("utf-8")
@@ -0,0 +1,421 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from services.llm_service import (
+    query_llm, open_in_chrome, search_web_and_enhance_answer, control_esp32_led, describe_esp32_led,
+    stream_llm_sentences, search_web_summary, web_enhanced_prompt,
+    query_llm_async, stream_llm_sentences_async, search_web_summary_async,
+)
+from services.intent_router import route_intent
+from services.llm_cache import llm_cache, reply_key
+from services.search_service import SEARCH_BUDGET_SECONDS
+from services.tts_service import open_murf_audio, open_murf_audio_async
+from services.metrics_service import record_latency
+from services.admission import Overloaded
+from services.conversation_memory import ConversationMemory
+from services.image_jobs import start_image_job
+from services.tracing import span, mark, in_turn_context, timed_iter, timed_aiter
+
+logger = logging.getLogger(__name__)
+
+# Shared by all sessions: synthesises sentences of streamed replies ahead of playback
+TTS_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tts")
+
+
+def llm_path(intent) -> str:
+    """Which LLM path answers a turn: 'identity', 'question' (web-enhanced) or 'chat'."""
+    # Intents without an action of their own (e.g. image requests) are answered as chat
+    return intent.name if intent.name in ("identity", "question") else "chat"
+
+
+def standalone_prompt(user_prompt: str, memory) -> ConversationMemory:
+    """The persona and this prompt alone, without the session's history."""
+    prompt = ConversationMemory({"content": memory.persona})
+    prompt.add("user", user_prompt)
+    return prompt
+
+
+def reply_prompt(kind: str, user_prompt: str, memory) -> tuple:
+    """
+    Prompt for an LLM reply, and whether the reply may be shared with other sessions:
+    identity turns use the persona and prompt alone, questions are web-enhanced (within
+    the search budget), the rest (and questions whose search is late or failed) use the history.
+    """
+    if kind == "identity":
+        return standalone_prompt(user_prompt, memory), True
+    if kind == "question":
+        with span("web_search"):
+            web_summary = search_web_summary(user_prompt, timeout=SEARCH_BUDGET_SECONDS)
+        if web_summary:
+            return web_enhanced_prompt(user_prompt, web_summary), True
+    return memory, False
+
+
+async def reply_prompt_async(kind: str, user_prompt: str, memory) -> tuple:
+    if kind == "identity":
+        return standalone_prompt(user_prompt, memory), True
+    if kind == "question":
+        with span("web_search"):
+            web_summary = await search_web_summary_async(user_prompt, timeout=SEARCH_BUDGET_SECONDS)
+        if web_summary:
+            return web_enhanced_prompt(user_prompt, web_summary), True
+    return memory, False
+
+
+def shared_reply_key(kind: str, user_prompt: str, memory, shareable: bool) -> tuple | None:
+    """LLM cache key for a reply; None for replies built from the session's history, which are never shared."""
+    return reply_key(kind, user_prompt, memory.persona) if shareable else None
+
+
+def reply_sentences(kind: str, user_prompt: str, memory, gemini_api_key: str):
+    """
+    Sentences of a streamed LLM reply. Replies that don't depend on the session's history
+    are answered from the LLM cache (see services/llm_cache.py) where their intent class
+    allows, or share a reply already being generated for the same prompt.
+    """
+    prompt, shareable = reply_prompt(kind, user_prompt, memory)
+    key = shared_reply_key(kind, user_prompt, memory, shareable)
+    if key is None:
+        return stream_llm_sentences(prompt, gemini_api_key)
+    return llm_cache.sentences(key, lambda: stream_llm_sentences(prompt, gemini_api_key, raise_errors=True))
+
+
+def _full_reply(kind: str, user_prompt: str, memory, gemini_api_key: str) -> str | None:
+    if kind == "question":
+        return search_web_and_enhance_answer(user_prompt, gemini_api_key)
+    return query_llm(standalone_prompt(user_prompt, memory) if kind == "identity" else memory, gemini_api_key)
+
+
+def full_reply(kind: str, user_prompt: str, memory, gemini_api_key: str) -> str | None:
+    """Whole (non-streamed) LLM reply for an identity, question or chat turn, from the LLM cache where allowed."""
+    # Search and answer run concurrently for questions, so they share one stage. Cached
+    # paths don't read the history: identity uses the persona, questions web-enhanced or LLM-only
+    with span("web_search_llm" if kind == "question" else "llm"):
+        key = reply_key(kind, user_prompt, memory.persona)
+        if key is None:
+            return _full_reply(kind, user_prompt, memory, gemini_api_key)
+        return llm_cache.reply(key, lambda: [_full_reply(kind, user_prompt, memory, gemini_api_key)])
+
+
+def speculative_reply(kind: str, user_prompt: str, memory, gemini_api_key: str, streaming: bool):
+    """What a Speculation buffers (see services/speculation.py): the reply's sentences, or the whole reply."""
+    if streaming:
+        return reply_sentences(kind, user_prompt, memory, gemini_api_key)
+    return [full_reply(kind, user_prompt, memory, gemini_api_key)]
+
+
+async def _generate_reply_async(prompt, gemini_api_key: str, streaming: bool, raise_errors: bool = False):
+    if streaming:
+        async for sentence in stream_llm_sentences_async(prompt, gemini_api_key, raise_errors):
+            yield sentence
+    else:
+        yield await query_llm_async(prompt, gemini_api_key)
+
+
+async def speculative_reply_async(kind: str, user_prompt: str, memory, gemini_api_key: str, streaming: bool):
+    """
+    Async counterpart of speculative_reply, also used for turns answered without speculation:
+    the reply's sentences, or the whole reply as one item, from the LLM cache where allowed.
+    """
+    prompt, shareable = await reply_prompt_async(kind, user_prompt, memory)
+    key = shared_reply_key(kind, user_prompt, memory, shareable)
+    if key is None:
+        replies = _generate_reply_async(prompt, gemini_api_key, streaming)
+    else:
+        def produce():
+            return _generate_reply_async(prompt, gemini_api_key, streaming, raise_errors=True)
+        if not streaming:
+            yield await llm_cache.reply_async(key, produce)
+            return
+        replies = llm_cache.sentences_async(key, produce)
+    async for reply in replies:
+        yield reply
+
+
+def _record_ttfa(session, turn_id: int, started_at: float | None, mode: str) -> float | None:
+    if started_at is None:
+        return None
+    ttfa_ms = (time.monotonic() - started_at) * 1000
+    record_latency(f"ttfa_{mode}", ttfa_ms)
+    mark("first_audio")
+    logger.info(f"Turn {turn_id} time-to-first-audio ({mode}): {ttfa_ms:.0f} ms")
+    return round(ttfa_ms, 1)
+
+
+def stream_reply(session, turn_id: int, sentences, cancel, started_at: float | None = None) -> str:
+    """
+    Speak a reply sentence by sentence. Sentences are read from `sentences` on a
+    producer thread and synthesis starts on TTS_POOL as soon as each completes; audio is
+    relayed to the client strictly in sentence order. Returns the text that was spoken.
+    Raises Overloaded if admission control sheds the LLM stream or a sentence's TTS.
+    """
+    pending = queue.Queue()
+    spoken = []
+    shed = []
+
+    def produce():
+        try:
+            for sentence in sentences:
+                if cancel.is_set():
+                    break
+                spoken.append(sentence)
+                session.send({"type": "assistant_chunk", "text": sentence + " ", "turn": turn_id})
+                pending.put(TTS_POOL.submit(in_turn_context(open_murf_audio), sentence, session.api_keys["murf"],
+                                             audio_format=session.audio_format))
+        except Overloaded as e:
+            shed.append(e)
+            cancel.set()
+        except Exception as e:
+            logger.error(f"Turn {turn_id} sentence stream failed: {e}")
+        finally:
+            pending.put(None)
+
+    threading.Thread(target=in_turn_context(produce), name="llm-sentences", daemon=True).start()
+    ttfa = {}
+    def on_first_audio():
+        if not ttfa:
+            ttfa["ms"] = _record_ttfa(session, turn_id, started_at, "streaming")
+    seq = 0
+    while True:
+        future = pending.get()
+        if future is None:
+            break
+        try:
+            audio = future.result()
+        except Overloaded as e:
+            # Stop the rest of the reply like a barge-in would, then report it
+            shed.append(e)
+            cancel.set()
+            continue
+        if cancel.is_set():
+            audio.close()
+            continue
+        if session.send_audio(turn_id, seq, audio, session.audio_format.mime, cancel=cancel, on_first=on_first_audio):
+            seq += 1
+    ttfa_ms = ttfa.get("ms")
+    if shed:
+        raise shed[0]
+    if cancel.is_set():
+        logger.info(f"Turn {turn_id} cancelled during streaming.")
+        return " ".join(spoken)
+    session.send({"type": "audio_done", "turn": turn_id, "ttfa_ms": ttfa_ms})
+    logger.info(f"Streamed {seq} audio chunks for turn {turn_id}.")
+    return " ".join(spoken)
+
+
+def process_turn(session, turn_id: int, user_prompt: str, cancel, started_at: float | None = None,
+                 speculation=None) -> None:
+    """
+    Answer one finished user turn: device control, browser search, image job or LLM reply, then TTS.
+    `cancel` is a threading.Event set on barge-in; checked between the slow stages.
+    `started_at` is the monotonic time the turn ended, used for time-to-first-audio.
+    `speculation` is a reply already started from the partial transcript (see
+    services/speculation.py); its intent and LLM output are used instead of new ones.
+    """
+    memory = session.memory
+    api_keys = session.api_keys
+    memory.add("user", user_prompt)
+    if speculation is not None:
+        intent = speculation.intent
+    else:
+        with span("intent"):
+            intent = route_intent(user_prompt)
+    led_feedback, opened = _device_or_browser_action(intent)
+    if intent.name == "image":
+        led_feedback = _image_action(session, turn_id, intent)
+    tts_text = None
+    if led_feedback:
+        session.send({"type": "assistant_chunk", "text": led_feedback, "turn": turn_id})
+        logger.info("Sent LED feedback to client.")
+        tts_text = led_feedback
+    elif opened:
+        session.send({"type": "web_search_opened", "turn": turn_id})
+        logger.info("Sent web_search_opened to client.")
+        tts_text = "Opened web search in your browser."
+    else:
+        kind = llm_path(intent)
+        if session.streaming:
+            if speculation is not None:
+                logger.info("Streaming the speculative answer...")
+                sentences = speculation.results()
+            else:
+                logger.info(f"Streaming Gemini response ({kind})...")
+                sentences = reply_sentences(kind, user_prompt, memory, api_keys["gemini"])
+                if cancel.is_set():
+                    return
+            sentences = timed_iter(sentences, "llm", "llm_first_sentence")
+            llm_response = stream_reply(session, turn_id, sentences, cancel, started_at)
+            logger.info(f"[LLM streamed response]: {llm_response}")
+            if llm_response and not cancel.is_set():
+                memory.add("assistant", llm_response)
+            return
+        if speculation is not None:
+            with span("llm"):
+                llm_response = speculation.result()
+        else:
+            logger.info(f"Getting full Gemini response ({kind})...")
+            llm_response = full_reply(kind, user_prompt, memory, api_keys["gemini"])
+        logger.info(f"[LLM full response ({kind})]: {llm_response}")
+        if cancel.is_set():
+            logger.info(f"Turn {turn_id} cancelled after LLM.")
+            return
+        if llm_response:
+            memory.add("assistant", llm_response)
+        session.send({"type": "assistant_chunk", "text": llm_response, "turn": turn_id})
+        logger.info("Sent assistant_chunk to client.")
+        tts_text = llm_response
+    # Call TTS only if tts_text is set
+    if tts_text and not cancel.is_set():
+        ttfa = {}
+        def on_first_audio():
+            ttfa["ms"] = _record_ttfa(session, turn_id, started_at, "full")
+        audio = open_murf_audio(tts_text, api_keys["murf"], audio_format=session.audio_format)
+        sent = session.send_audio(turn_id, 0, audio, session.audio_format.mime, cancel=cancel, on_first=on_first_audio)
+        if cancel.is_set():
+            logger.info(f"Turn {turn_id} cancelled during audio send.")
+            return
+        logger.info(f"Audio sent to client. Bytes: {sent}")
+        session.send({"type": "audio_done", "turn": turn_id, "ttfa_ms": ttfa.get("ms")})
+        logger.info("Sent audio_done to client.")
+        logger.info("Finished streaming all chunks.")
+
+
+def _device_or_browser_action(intent) -> tuple[str | None, bool]:
+    """Run the side effect of a device_control/open_site/web_search intent: (LED feedback, browser opened)."""
+    if intent.name == "device_control":
+        with span("device_action"):
+            return control_esp32_led(intent.slots["state"]), False
+    if intent.name == "device_state":
+        with span("device_state"):
+            return describe_esp32_led(), False
+    if intent.name in ("open_site", "web_search"):
+        with span("browser_open"):
+            return None, open_in_chrome(intent)
+    return None, False
+
+
+def _image_action(session, turn_id: int, intent) -> str | None:
+    """
+    Start the image job for an image intent; the result is pushed to the client when
+    ready. Returns the line to speak meanwhile, or None (answered as chat) without an OpenAI key.
+    """
+    with span("image_job"):
+        job = start_image_job(session, turn_id, intent.text)
+    if job is None:
+        return None
+    return "Here is the picture." if job.cached else "Sure, I'm drawing that now. It will appear on screen shortly."
+
+
+async def stream_reply_async(session, turn_id: int, sentences, started_at: float | None = None) -> str:
+    """
+    Async counterpart of stream_reply: sentences come from an async iterator, each
+    starts its Murf request as a task right away, and audio is relayed in order.
+    Barge-in cancels the calling task; pending synthesis tasks are cancelled with it.
+    """
+    pending = asyncio.Queue()
+    spoken = []
+    shed = []
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                spoken.append(sentence)
+                await session.send({"type": "assistant_chunk", "text": sentence + " ", "turn": turn_id})
+                pending.put_nowait(asyncio.create_task(open_murf_audio_async(sentence, session.api_keys["murf"],
+                                                                              audio_format=session.audio_format)))
+        except Overloaded as e:
+            shed.append(e)
+        except Exception as e:
+            logger.error(f"Turn {turn_id} sentence stream failed: {e}")
+        finally:
+            pending.put_nowait(None)
+
+    ttfa = {}
+    def on_first_audio():
+        if not ttfa:
+            ttfa["ms"] = _record_ttfa(session, turn_id, started_at, "streaming")
+    producer = asyncio.create_task(produce())
+    seq = 0
+    task = None
+    try:
+        while True:
+            task = await pending.get()
+            if task is None:
+                break
+            if await session.send_audio(turn_id, seq, await task, session.audio_format.mime, on_first=on_first_audio):
+                seq += 1
+    finally:
+        producer.cancel()
+        if task is not None:
+            task.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()
+    if shed:
+        raise shed[0]
+    await session.send({"type": "audio_done", "turn": turn_id, "ttfa_ms": ttfa.get("ms")})
+    logger.info(f"Streamed {seq} audio chunks for turn {turn_id}.")
+    return " ".join(spoken)
+
+
+async def process_turn_async(session, turn_id: int, user_prompt: str, started_at: float | None = None,
+                             speculation=None) -> None:
+    """Async counterpart of process_turn for AsyncVoiceSession; outbound calls don't block the loop."""
+    memory = session.memory
+    api_keys = session.api_keys
+    memory.add("user", user_prompt)
+    if speculation is not None:
+        intent = speculation.intent
+    else:
+        with span("intent"):
+            intent = route_intent(user_prompt)
+    led_feedback, opened = None, False
+    if intent.name in ("device_control", "device_state", "open_site", "web_search"):
+        # Device and browser actions are blocking calls; keep them off the event loop
+        led_feedback, opened = await asyncio.to_thread(_device_or_browser_action, intent)
+    elif intent.name == "image":
+        led_feedback = _image_action(session, turn_id, intent)
+    if led_feedback:
+        await session.send({"type": "assistant_chunk", "text": led_feedback, "turn": turn_id})
+        tts_text = led_feedback
+    elif opened:
+        await session.send({"type": "web_search_opened", "turn": turn_id})
+        tts_text = "Opened web search in your browser."
+    else:
+        kind = llm_path(intent)
+        if session.streaming:
+            if speculation is not None:
+                sentences = speculation.results()
+            else:
+                sentences = speculative_reply_async(kind, user_prompt, memory, api_keys["gemini"], True)
+            sentences = timed_aiter(sentences, "llm", "llm_first_sentence")
+            llm_response = await stream_reply_async(session, turn_id, sentences, started_at)
+            logger.info(f"[LLM streamed response]: {llm_response}")
+            if llm_response:
+                memory.add("assistant", llm_response)
+            return
+        if speculation is not None:
+            with span("llm"):
+                llm_response = await speculation.result()
+        else:
+            # As in full_reply: a question's web search happens inside this stage
+            with span("web_search_llm" if kind == "question" else "llm"):
+                replies = speculative_reply_async(kind, user_prompt, memory, api_keys["gemini"], False)
+                llm_response = await anext(replies, None)
+        logger.info(f"[LLM response ({kind})]: {llm_response}")
+        if not llm_response:
+            return
+        memory.add("assistant", llm_response)
+        await session.send({"type": "assistant_chunk", "text": llm_response, "turn": turn_id})
+        tts_text = llm_response
+    ttfa = {}
+    def on_first_audio():
+        ttfa["ms"] = _record_ttfa(session, turn_id, started_at, "full")
+    audio = await open_murf_audio_async(tts_text, api_keys["murf"], audio_format=session.audio_format)
+    sent = await session.send_audio(turn_id, 0, audio, session.audio_format.mime, on_first=on_first_audio)
+    logger.info(f"Audio sent to client. Bytes: {sent}")
+    await session.send({"type": "audio_done", "turn": turn_id, "ttfa_ms": ttfa.get("ms")})
@@ -0,0 +1,480 @@
+import logging
+import math
+import struct
+import threading
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from services.metrics_service import register_stats_provider
+
+try:
+    import opuslib
+except Exception:  # ImportError, or opuslib's own error when libopus itself is missing
+    opuslib = None
+
+logger = logging.getLogger(__name__)
+
+# What the VAD gate and the STT session expect: 16 kHz mono PCM16 little-endian
+TARGET_RATE = 16000
+# Uplink codecs this server decodes; clients list the ones they can send in `uplinkCodecs`.
+# Opus (WebM/Opus from MediaRecorder) needs the optional opuslib bindings and libopus.
+UPLINK_CODECS = ("pcm", "ulaw", "adpcm") + (("opus",) if opuslib is not None else ())
+# Capture rates accepted from clients (the browser's native AudioContext rate, usually 44.1 or 48 kHz)
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 96000
+# Resampler FIR length per output sample (per polyphase branch), scaled up by the decimation factor
+RESAMPLER_TAPS = 32
+# Passband edge as a fraction of the lower Nyquist frequency, and the Kaiser window's beta (~60 dB stopband)
+RESAMPLER_BANDWIDTH = 0.9
+RESAMPLER_BETA = 6.0
+# Output samples filtered per gather when the ratio isn't an integer decimation
+RESAMPLER_BLOCK = 256
+# Longest Opus frame (120 ms) at the decode rate
+OPUS_MAX_FRAME = TARGET_RATE * 120 // 1000
+# Blocks are buffered until complete; anything this big isn't a microphone stream
+MAX_WEBM_BLOCK_BYTES = 1 << 20
+# ADPCM messages start with the encoder state: predictor (int16), step index (uint8), and
+# a flags byte whose low bit says the last nibble is padding (odd sample count)
+ADPCM_HEADER = struct.Struct("<hBB")
+# Vectorised ADPCM decoding restarts once per clamp hit; beyond this many it decodes sample by sample
+MAX_CLAMP_PASSES = 16
+
+_IMA_STEPS = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428,
+    4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350,
+    22385, 24623, 27086, 29794, 32767], dtype=np.int32)
+_IMA_INDEX_ADJUST = np.array([-1, -1, -1, -1, 2, 4, 6, 8] * 2, dtype=np.int32)
+_IMA_MAX_INDEX = len(_IMA_STEPS) - 1
+
+_EMPTY = np.zeros(0, dtype=np.int16)
+
+_totals = {"sessions": 0, "messages": 0, "bytes_in": 0, "bytes_out": 0, "decode_ms": 0.0}
+_codec_sessions = {}
+_totals_lock = threading.Lock()
+
+
+def negotiate_uplink(accepted=None, sample_rate=None) -> tuple[str, int]:
+    """
+    The first codec in the client's `uplinkCodecs` list (most preferred first) that this
+    server decodes, and the rate its samples arrive at; raw 16 kHz PCM otherwise.
+    """
+    codec = next((c.lower() for c in accepted or () if isinstance(c, str) and c.lower() in UPLINK_CODECS), "pcm")
+    if codec == "opus":
+        # Opus is decoded straight to the target rate whatever the capture rate was
+        return codec, TARGET_RATE
+    if isinstance(sample_rate, (int, float)) and MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+        return codec, int(sample_rate)
+    return codec, TARGET_RATE
+
+
+def _ulaw_table() -> np.ndarray:
+    """G.711 μ-law byte -> PCM16."""
+    codes = ~np.arange(256, dtype=np.uint8)
+    exponent = (codes >> 4) & 0x07
+    magnitude = ((((codes & 0x0F).astype(np.int32) << 3) + 0x84) << exponent) - 0x84
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+_ULAW_DECODE = _ulaw_table()
+
+
+def decode_ulaw(data: bytes) -> np.ndarray:
+    return _ULAW_DECODE[np.frombuffer(data, dtype=np.uint8)]
+
+
+def encode_ulaw(samples: np.ndarray) -> bytes:
+    """PCM16 -> G.711 μ-law (as the browser client encodes it; used by the benchmarks)."""
+    x = samples.astype(np.int32) >> 2
+    magnitude = np.minimum(np.abs(x), 8158) + 33
+    exponent = np.maximum(np.floor(np.log2(magnitude)).astype(np.int32) - 5, 0)
+    mantissa = (magnitude >> (exponent + 1)) & 0x0F
+    return (~(np.where(x < 0, 0x80, 0) | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+
+def _ima_diffs() -> np.ndarray:
+    """Signed predictor change for every (step index, code) pair, flattened as index * 16 + code."""
+    steps = _IMA_STEPS[:, None]
+    codes = np.arange(16)
+    diffs = (steps >> 3) + (codes >> 2 & 1) * steps + (codes >> 1 & 1) * (steps >> 1) + (codes & 1) * (steps >> 2)
+    return np.where(codes & 8, -diffs, diffs).astype(np.int32).ravel()
+
+
+_IMA_DIFFS = _ima_diffs()
+
+
+def _clamped_cumsum(steps: np.ndarray, start: int, low: int, high: int) -> np.ndarray | None:
+    """
+    x[n] = clip(x[n-1] + steps[n], low, high), x[-1] = start, in NumPy passes; None when
+    the upper bound binds too often for that to pay off. The lower clamp has a closed form
+    (x[n] = S[n] - min(low - start, min(S[..n])) + low, S being the unclamped sum); each
+    time the upper one binds the rest is recomputed from there.
+    """
+    out = np.empty(len(steps), dtype=np.int32)
+    pos = 0
+    for _ in range(MAX_CLAMP_PASSES):
+        running = np.cumsum(steps[pos:], dtype=np.int32)
+        x = running - np.minimum(np.minimum.accumulate(running), low - start) + low
+        over = np.flatnonzero(x > high)
+        if not over.size:
+            out[pos:] = x
+            return out
+        end = pos + over[0]
+        out[pos:end] = x[:over[0]]
+        out[end] = start = high
+        pos = end + 1
+        if pos == len(steps):
+            return out
+    return None
+
+
+def decode_adpcm(data: bytes) -> np.ndarray:
+    """
+    One uplink ADPCM message: the encoder state (ADPCM_HEADER) followed by IMA ADPCM
+    codes, two per byte, low nibble first. Each message decodes on its own, so a dropped
+    or reordered one can't corrupt the rest of the stream.
+
+    IMA ADPCM looks sequential (every code moves the step index and the predictor), but
+    both are clamped running sums: the step index of the per-code index adjustments, and
+    the predictor of table lookups keyed by (step index, code). So the whole message
+    decodes in a few NumPy passes; only near full-scale noise, where the clamps keep
+    binding, takes the sample-by-sample path.
+    """
+    if len(data) < ADPCM_HEADER.size:
+        return _EMPTY
+    predictor, index, flags = ADPCM_HEADER.unpack_from(data)
+    packed = np.frombuffer(data, dtype=np.uint8, offset=ADPCM_HEADER.size)
+    if not packed.size or index > _IMA_MAX_INDEX:
+        return _EMPTY
+    codes = np.empty(2 * len(packed), dtype=np.int32)
+    codes[0::2] = packed & 0x0F
+    codes[1::2] = packed >> 4
+    if flags & 1:
+        codes = codes[:-1]
+    indices_after = _clamped_cumsum(_IMA_INDEX_ADJUST.take(codes), index, 0, _IMA_MAX_INDEX)
+    if indices_after is None:
+        return _decode_adpcm_sequential(predictor, index, codes)
+    # Each code is scaled by the step in force before it
+    keys = np.empty_like(codes)
+    keys[0] = index
+    keys[1:] = indices_after[:-1]
+    keys = keys * 16 + codes
+    samples = _clamped_cumsum(_IMA_DIFFS.take(keys), predictor, -32768, 32767)
+    if samples is None:
+        return _decode_adpcm_sequential(predictor, index, codes)
+    return samples.astype(np.int16)
+
+
+def _decode_adpcm_sequential(predictor: int, index: int, codes: np.ndarray) -> np.ndarray:
+    steps = _IMA_STEPS.tolist()
+    adjust = _IMA_INDEX_ADJUST.tolist()
+    out = np.empty(len(codes), dtype=np.int16)
+    for i, code in enumerate(codes.tolist()):
+        step = steps[index]
+        diff = step >> 3
+        if code & 4:
+            diff += step
+        if code & 2:
+            diff += step >> 1
+        if code & 1:
+            diff += step >> 2
+        predictor = max(-32768, min(32767, predictor - diff if code & 8 else predictor + diff))
+        index = max(0, min(_IMA_MAX_INDEX, index + adjust[code]))
+        out[i] = predictor
+    return out
+
+
+class AdpcmEncoder:
+    """IMA ADPCM encoder producing uplink messages (the browser's, in Python; used by the benchmarks)."""
+
+    def __init__(self):
+        self.predictor = 0
+        self.index = 0
+
+    def encode(self, samples: np.ndarray) -> bytes:
+        steps = _IMA_STEPS.tolist()
+        adjust = _IMA_INDEX_ADJUST.tolist()
+        header = ADPCM_HEADER.pack(self.predictor, self.index, len(samples) & 1)
+        predictor, index = self.predictor, self.index
+        codes = []
+        for sample in samples.tolist():
+            step = steps[index]
+            diff = sample - predictor
+            code = 8 if diff < 0 else 0
+            diff = abs(diff)
+            delta = step >> 3
+            if diff >= step:
+                code |= 4
+                diff -= step
+                delta += step
+            if diff >= step >> 1:
+                code |= 2
+                diff -= step >> 1
+                delta += step >> 1
+            if diff >= step >> 2:
+                code |= 1
+                delta += step >> 2
+            predictor = max(-32768, min(32767, predictor - delta if code & 8 else predictor + delta))
+            index = max(0, min(_IMA_MAX_INDEX, index + adjust[code]))
+            codes.append(code)
+        if len(codes) % 2:
+            codes.append(0)
+        self.predictor, self.index = predictor, index
+        packed = np.array(codes, dtype=np.uint8)
+        return header + (packed[0::2] | packed[1::2] << 4).tobytes()
+
+
+class Resampler:
+    """
+    Streaming polyphase resampler (Kaiser-windowed sinc) from the client's capture rate to
+    TARGET_RATE. Input arrives in arbitrary chunks; the filter history and the output
+    position carry over, so the output is the same as resampling the whole stream at once.
+    Each chunk is filtered in NumPy: with an integer decimation factor (48 -> 16 kHz) every
+    output sample uses the same taps over a strided view of the input, a single einsum;
+    other ratios (44.1 -> 16 kHz) gather each output's window and filter branch.
+    """
+
+    def __init__(self, from_rate: int, to_rate: int = TARGET_RATE):
+        g = math.gcd(from_rate, to_rate)
+        self.up, self.down = to_rate // g, from_rate // g
+        self.taps = RESAMPLER_TAPS * max(1, math.ceil(self.down / self.up))
+        n = self.up * self.taps
+        # Cutoff in cycles per sample at the upsampled rate
+        cutoff = 0.5 * RESAMPLER_BANDWIDTH / max(self.up, self.down)
+        t = np.arange(n) - (n - 1) / 2
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(n, RESAMPLER_BETA) * self.up
+        # Branch p holds taps p, p + up, p + 2*up, ...; reversed so they line up with an ascending window
+        self._branches = np.ascontiguousarray(prototype.reshape(self.taps, self.up).T[:, ::-1], dtype=np.float32)
+        self._history = np.zeros(self.taps - 1, dtype=np.float32)
+        self._received = 0
+        self._next_output = 0
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        x = np.concatenate((self._history, samples.astype(np.float32)))
+        self._received += len(samples)
+        # Outputs whose newest input sample has arrived
+        last = (self._received * self.up - 1) // self.down
+        first, self._next_output = self._next_output, last + 1
+        self._history = x[len(x) - (self.taps - 1):]
+        if last < first:
+            return _EMPTY
+        # Position in x of the oldest input sample each output's window needs
+        offset = self._received - len(x) + self.taps - 1
+        windows = sliding_window_view(x, self.taps)
+        if self.up == 1:
+            start = first * self.down - offset
+            y = np.einsum("nk,k->n", windows[start:start + (last - first) * self.down + 1:self.down], self._branches[0])
+        else:
+            positions = np.arange(first, last + 1, dtype=np.int64) * self.down
+            starts, branches = positions // self.up - offset, positions % self.up
+            y = np.empty(len(positions), dtype=np.float32)
+            # Gathered in blocks that stay in cache
+            for i in range(0, len(y), RESAMPLER_BLOCK):
+                block = slice(i, i + RESAMPLER_BLOCK)
+                y[block] = np.einsum("nk,nk->n", windows[starts[block]], self._branches[branches[block]])
+        return np.clip(np.rint(y), -32768, 32767).astype(np.int16)
+
+
+class WebMDemuxer:
+    """
+    Incremental WebM (Matroska) demuxer for a single audio track, as produced by
+    MediaRecorder: feed it the stream in arbitrary chunks and it returns the frames of the
+    blocks completed so far. Segment and Cluster may have unknown sizes (live streams), so
+    container elements are entered rather than measured; everything else but the track's
+    codec private data and the blocks is skipped.
+    """
+
+    _CONTAINERS = {0x18538067, 0x1F43B675, 0x1654AE6B, 0xAE, 0xA0}  # Segment, Cluster, Tracks, TrackEntry, BlockGroup
+    _BLOCKS = {0xA3, 0xA1}  # SimpleBlock, Block
+    _CODEC_PRIVATE = 0x63A2
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._skip = 0
+        self.codec_private = None
+
+    @staticmethod
+    def _vint(data, pos: int, keep_marker: bool):
+        """EBML variable-length integer at pos -> (value, length, all value bits set); None if incomplete."""
+        if pos >= len(data):
+            return None
+        first = data[pos]
+        length = 9 - first.bit_length()
+        if length > 8:
+            raise ValueError("invalid EBML variable-length integer")
+        if pos + length > len(data):
+            return None
+        value = first if keep_marker else first & (0xFF >> length)
+        for byte in data[pos + 1:pos + length]:
+            value = value << 8 | byte
+        return value, length, value == (1 << 7 * length) - 1
+
+    def feed(self, data: bytes) -> list[bytes]:
+        self._buffer += data
+        try:
+            return self._parse()
+        except ValueError:
+            # Not a stream we can resynchronise on; drop what is buffered
+            self._buffer.clear()
+            self._skip = 0
+            raise
+
+    def _parse(self) -> list[bytes]:
+        frames = []
+        pos = 0
+        buffer = self._buffer
+        while True:
+            if self._skip:
+                skipped = min(self._skip, len(buffer) - pos)
+                pos += skipped
+                self._skip -= skipped
+                if self._skip:
+                    break
+            element_id = self._vint(buffer, pos, keep_marker=True)
+            size = element_id and self._vint(buffer, pos + element_id[1], keep_marker=False)
+            if not size:
+                break
+            element_id, header = element_id[0], element_id[1] + size[1]
+            if element_id in self._CONTAINERS:
+                pos += header
+                continue
+            if size[2]:
+                raise ValueError(f"unknown-size WebM element {element_id:#x}")
+            if element_id in self._BLOCKS or element_id == self._CODEC_PRIVATE:
+                if size[0] > MAX_WEBM_BLOCK_BYTES:
+                    raise ValueError(f"{size[0]} byte WebM block")
+                if pos + header + size[0] > len(buffer):
+                    break
+                payload = bytes(buffer[pos + header:pos + header + size[0]])
+                if element_id == self._CODEC_PRIVATE:
+                    self.codec_private = payload
+                else:
+                    frame = self._block_frame(payload)
+                    if frame:
+                        frames.append(frame)
+                pos += header + size[0]
+            else:
+                pos += header
+                self._skip = size[0]
+        del buffer[:pos]
+        return frames
+
+    def _block_frame(self, block: bytes) -> bytes | None:
+        # Track number, int16 timecode, flags; then the frame (MediaRecorder doesn't lace audio)
+        track = self._vint(block, 0, keep_marker=False)
+        if track is None or len(block) < track[1] + 3:
+            return None
+        if block[track[1] + 2] & 0x06:
+            logger.warning("Laced WebM block skipped")
+            return None
+        return block[track[1] + 3:]
+
+    @property
+    def channels(self) -> int:
+        # OpusHead: magic (8 bytes), version, channel count, ...
+        if self.codec_private and self.codec_private.startswith(b"OpusHead") and len(self.codec_private) > 9:
+            return self.codec_private[9]
+        return 1
+
+
+class WebMOpusDecoder:
+    """Opus packets from a MediaRecorder WebM stream, decoded (and downmixed) to TARGET_RATE mono."""
+
+    def __init__(self):
+        self._demuxer = WebMDemuxer()
+        self._decoder = None
+
+    def decode(self, data: bytes) -> np.ndarray:
+        out = []
+        for packet in self._demuxer.feed(data):
+            channels = self._demuxer.channels
+            if self._decoder is None:
+                self._decoder = opuslib.Decoder(TARGET_RATE, channels)
+            pcm = np.frombuffer(self._decoder.decode(packet, OPUS_MAX_FRAME), dtype="<i2")
+            if channels > 1:
+                pcm = pcm.reshape(-1, channels).mean(axis=1).astype(np.int16)
+            out.append(pcm)
+        return np.concatenate(out) if out else _EMPTY
+
+
+class UplinkDecoder:
+    """
+    Turns one session's inbound audio messages, in the negotiated codec and capture rate,
+    into the 16 kHz PCM16 the VAD gate and the STT session expect. Raw 16 kHz PCM (what
+    clients that don't negotiate send) passes through untouched.
+    """
+
+    def __init__(self, codec: str = "pcm", sample_rate: int = TARGET_RATE):
+        self.codec = codec
+        self.sample_rate = sample_rate
+        if codec == "opus":
+            self._decode = WebMOpusDecoder().decode
+        else:
+            self._decode = {"pcm": self._decode_pcm, "ulaw": decode_ulaw, "adpcm": decode_adpcm}[codec]
+        self._resampler = Resampler(sample_rate) if sample_rate != TARGET_RATE else None
+        self._pcm_remainder = b""
+        self.stats = {"messages": 0, "bytes_in": 0, "bytes_out": 0, "decode_ms": 0.0}
+        with _totals_lock:
+            _totals["sessions"] += 1
+            _codec_sessions[codec] = _codec_sessions.get(codec, 0) + 1
+
+    def _decode_pcm(self, data: bytes) -> np.ndarray:
+        data = self._pcm_remainder + data
+        usable = len(data) & ~1
+        self._pcm_remainder = data[usable:]
+        return np.frombuffer(data, dtype="<i2", count=usable // 2)
+
+    def as_message(self) -> dict:
+        return {"type": "uplink", "codec": self.codec, "sample_rate": self.sample_rate}
+
+    def decode(self, data):
+        """16 kHz PCM16 bytes for one inbound message (possibly empty while a container frame is incomplete)."""
+        if not isinstance(data, bytes):
+            return data
+        if self.codec == "pcm" and self._resampler is None:
+            pcm = data
+            elapsed_ms = 0.0
+        else:
+            started = time.perf_counter()
+            try:
+                samples = self._decode(data)
+            except Exception as e:
+                logger.warning(f"Uplink {self.codec} message dropped: {e}")
+                samples = _EMPTY
+            if self._resampler is not None and samples.size:
+                samples = self._resampler.process(samples)
+            pcm = samples.astype("<i2", copy=False).tobytes()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["messages"] += 1
+        self.stats["bytes_in"] += len(data)
+        self.stats["bytes_out"] += len(pcm)
+        self.stats["decode_ms"] += elapsed_ms
+        return pcm
+
+    def summary(self) -> dict:
+        stats = {k: round(v, 1) if isinstance(v, float) else v for k, v in self.stats.items()}
+        stats["codec"] = self.codec
+        stats["sample_rate"] = self.sample_rate
+        stats["wire_ratio"] = round(self.stats["bytes_in"] / self.stats["bytes_out"], 3) if self.stats["bytes_out"] else None
+        return stats
+
+    def close(self):
+        """Fold this session's counters into the process totals and log them."""
+        with _totals_lock:
+            for key, value in self.stats.items():
+                _totals[key] += value
+        logger.info(f"Session uplink: {self.summary()}")
+
+
+def uplink_stats() -> dict:
+    with _totals_lock:
+        stats = {k: round(v, 1) if isinstance(v, float) else v for k, v in _totals.items()}
+        stats["codecs"] = dict(_codec_sessions)
+    # Uplink bytes received per byte of 16 kHz PCM16 they decode to
+    stats["wire_ratio"] = round(stats["bytes_in"] / stats["bytes_out"], 3) if stats["bytes_out"] else None
+    stats["decode_us_per_message"] = round(stats["decode_ms"] * 1000 / stats["messages"]) if stats["messages"] else None
+    return stats
+
+
+register_stats_provider("uplink", uplink_stats)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.device_shadow import valid_topic
+
+
+@pytest.mark.parametrize("topic", ["myhome/esp32/led", "a", "home/living room/lamp"])
+def test_concrete_topics_are_accepted(topic):
+    assert valid_topic(topic)
+
+
+@pytest.mark.parametrize("topic", ["", "#", "home/#", "home/+/led", "home\0led", "x" * 257, None, 42])
+def test_wildcard_empty_and_overlong_topics_are_rejected(topic):
+    assert not valid_topic(topic)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.intent_router import route_intent
+
+
+@pytest.mark.parametrize("text", [
+    "Can you draw me a cat?",
+    "Could you generate an image of a sunset?",
+    "Would you show me a picture of a lighthouse?",
+    "Draw me a dragon",
+])
+def test_image_requests_phrased_as_questions(text):
+    assert route_intent(text).name == "image"
+
+
+@pytest.mark.parametrize("text", [
+    "How do I draw a cat?",
+    "How can I create an image in Photoshop?",
+    "What is the capital of Australia?",
+])
+def test_questions_about_images_stay_questions(text):
+    assert route_intent(text).name == "question"
+
+
+@pytest.mark.parametrize("text, state", [
+    ("turn on the lights", "on"),
+    ("Switch off the lights.", "off"),
+    ("turn off the lights please", "off"),
+    ("light on", "on"),
+])
+def test_device_commands(text, state):
+    intent = route_intent(text)
+    assert intent.name == "device_control"
+    assert intent.slots["state"] == state